@@ -0,0 +1,378 @@
+"""
+Library of the question and SPARQL query pairs verified against the knowledge graph.
+
+Every generated query that returned rows is recorded with its question, the resolved entities, the
+number of rows and the query latency, once per endpoint and question (asking the question again
+replaces its query by the last verified one). The pairs of the questions most similar to a new one
+are given as examples to the generation and improvement prompts of the SPARQL tool, and the pair of
+the same question asked again is answered without generating a query (see `QueryLibrary.lookup`).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app.core.graph_management.result_cache import normalize_query
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+parent_dir = Path(__file__).resolve().parents[3]
+default_library_dir = parent_dir / "graphs" / "query_library"
+
+# Columns of a pair, in the order of the arguments of `VerifiedQuery`
+_PAIR_COLUMNS = "question, entities, query, row_count, latency_seconds, verified_at, verifications"
+
+
+def get_query_library_dir() -> Path:
+    """Library directory, overridable with the METABOT_QUERY_LIBRARY_DIR environment variable."""
+    return Path(os.getenv("METABOT_QUERY_LIBRARY_DIR", default_library_dir))
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normalizes a question or its entities so that texts differing only by case, whitespace or
+    final punctuation are identical.
+
+    Args:
+        text (str): The question.
+
+    Returns:
+        str: The normalized question.
+    """
+    return re.sub(r"\s+", " ", text).strip().rstrip("?!. ").lower()
+
+
+def _similarities(
+    vectorizer: TfidfVectorizer, matrix, documents: int, text: str
+) -> np.ndarray:
+    """
+    Cosine similarities of a text with the rows of a TF-IDF matrix. The words of the text missing from
+    the vocabulary of the vectorizer, fitted on `documents` texts, count in its norm with the IDF of a
+    word of no text: "which features were not detected" is then less similar to "which features were
+    detected" than its known words alone.
+    """
+    counts = Counter(vectorizer.build_analyzer()(text))
+    vocabulary = vectorizer.vocabulary_
+    idf = vectorizer.idf_
+    known = sum((n * idf[vocabulary[word]]) ** 2 for word, n in counts.items() if word in vocabulary)
+    if not known:
+        return np.zeros(matrix.shape[0])
+    # Smoothed IDF of scikit-learn for a word of no document
+    unknown_idf = np.log(1 + documents) + 1
+    unknown = sum((n * unknown_idf) ** 2 for word, n in counts.items() if word not in vocabulary)
+    scores = (matrix @ vectorizer.transform([text]).T).toarray().ravel()
+    return scores * np.sqrt(known / (known + unknown))
+
+
+class VerifiedQuery:
+    """A question and the query that answered it with rows."""
+
+    def __init__(
+        self,
+        question: str,
+        entities: str,
+        query: str,
+        row_count: int,
+        latency_seconds: float,
+        verified_at: float,
+        verifications: int = 1,
+    ) -> None:
+        self.question = question
+        self.entities = entities
+        self.query = query
+        self.row_count = row_count
+        self.latency_seconds = latency_seconds
+        self.verified_at = verified_at
+        # Number of times the question was answered with rows
+        self.verifications = verifications
+
+    def __repr__(self) -> str:
+        return f"VerifiedQuery({self.question!r}, rows={self.row_count})"
+
+
+class QueryLibrary:
+    """
+    Stores the verified pairs in a sqlite database shared by the processes using the same library
+    directory, and retrieves them by TF-IDF similarity of their question and entities.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        """
+        Args:
+            path (Optional[Path]): The sqlite database, `library.sqlite3` of the library directory by default.
+        """
+        self.path = Path(path) if path else get_query_library_dir() / "library.sqlite3"
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # TF-IDF index of the pairs of each endpoint, with the fingerprint of the pairs it was fitted on
+        self._indexes: Dict[str, Tuple[Tuple[int, int], List[str], TfidfVectorizer, object]] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS verified_queries (
+                        key TEXT PRIMARY KEY,
+                        endpoint TEXT NOT NULL,
+                        question TEXT NOT NULL,
+                        entities TEXT NOT NULL,
+                        query TEXT NOT NULL,
+                        row_count INTEGER NOT NULL,
+                        latency_seconds REAL NOT NULL,
+                        verified_at REAL NOT NULL,
+                        verifications INTEGER NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS verified_queries_endpoint "
+                    "ON verified_queries (endpoint)"
+                )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(endpoint_url: str, question: str, entities: str) -> str:
+        """Key of a pair: hash of the endpoint and of the normalized question and entities."""
+        digest = hashlib.sha256(
+            f"{endpoint_url}\0{normalize_question(question)}\0{normalize_question(entities)}".encode(
+                "utf-8"
+            )
+        )
+        return digest.hexdigest()
+
+    def record(
+        self,
+        endpoint_url: str,
+        question: str,
+        entities: str,
+        query: str,
+        row_count: int,
+        latency_seconds: float,
+    ) -> bool:
+        """
+        Records the query that answered a question. A pair already recorded for the question is
+        replaced and its number of verifications incremented.
+
+        Args:
+            endpoint_url (str): The endpoint the query was sent to.
+            question (str): The question of the user.
+            entities (str): The resolved entities of the question.
+            query (str): The query that returned the rows.
+            row_count (int): Number of rows returned, the query is not recorded without rows.
+            latency_seconds (float): Time taken by the endpoint to answer.
+
+        Returns:
+            bool: Whether the pair was recorded.
+        """
+        if row_count <= 0 or not question.strip():
+            return False
+        key = self.key(endpoint_url, question, entities)
+        with self._lock:
+            try:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        """
+                        INSERT INTO verified_queries VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+                        ON CONFLICT (key) DO UPDATE SET
+                            query = excluded.query,
+                            row_count = excluded.row_count,
+                            latency_seconds = excluded.latency_seconds,
+                            verified_at = excluded.verified_at,
+                            verifications = verifications + 1
+                        """,
+                        (
+                            key,
+                            endpoint_url,
+                            question.strip(),
+                            entities.strip(),
+                            query.strip(),
+                            row_count,
+                            latency_seconds,
+                            time.time(),
+                        ),
+                    )
+            except sqlite3.Error as e:
+                logger.warning("Could not write to the query library %s: %s", self.path, e)
+                return False
+        logger.info("Verified query recorded in the library for question %s", key[:12])
+        return True
+
+    def _index(self, conn: sqlite3.Connection, endpoint_url: str):
+        """TF-IDF index of the pairs of an endpoint, fitted again when pairs were added."""
+        fingerprint = conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM verified_queries WHERE endpoint = ?",
+            (endpoint_url,),
+        ).fetchone()
+        cached = self._indexes.get(endpoint_url)
+        if cached is not None and cached[0] == fingerprint:
+            return cached
+        entries = conn.execute(
+            "SELECT key, question, entities FROM verified_queries WHERE endpoint = ?",
+            (endpoint_url,),
+        ).fetchall()
+        if not entries:
+            return None
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform(
+            [f"{question} {entities}" for _, question, entities in entries]
+        )
+        cached = self._indexes[endpoint_url] = (
+            fingerprint,
+            [key for key, _, _ in entries],
+            vectorizer,
+            matrix.tocsr(),
+        )
+        return cached
+
+    def similar(
+        self,
+        endpoint_url: str,
+        question: str,
+        entities: str = "",
+        k: int = 3,
+        min_similarity: float = 0.0,
+    ) -> List[Tuple[VerifiedQuery, float]]:
+        """
+        Finds the verified pairs whose question and entities are the most similar to a new question.
+        Pairs with the same query as a more similar one are skipped.
+
+        Args:
+            endpoint_url (str): The endpoint the question is asked on.
+            question (str): The question.
+            entities (str): The resolved entities of the question.
+            k (int): Maximum number of pairs returned.
+            min_similarity (float): Minimum cosine similarity of the returned pairs.
+
+        Returns:
+            List[Tuple[VerifiedQuery, float]]: The pairs and their similarity, most similar first.
+        """
+        if k <= 0:
+            return []
+        with self._lock:
+            try:
+                conn = self._connect()
+                index = self._index(conn, endpoint_url)
+                if index is None:
+                    return []
+                _, keys, vectorizer, matrix = index
+                scores = _similarities(vectorizer, matrix, len(keys), f"{question} {entities}")
+                ranked = [i for i in np.argsort(-scores, kind="stable") if scores[i] > min_similarity]
+                results = []
+                seen_queries = set()
+                for i in ranked:
+                    entry = conn.execute(
+                        f"SELECT {_PAIR_COLUMNS} FROM verified_queries WHERE key = ?", (keys[i],)
+                    ).fetchone()
+                    if entry is None:
+                        continue
+                    normalized = normalize_query(entry[2])
+                    if normalized in seen_queries:
+                        continue
+                    seen_queries.add(normalized)
+                    results.append((VerifiedQuery(*entry), float(scores[i])))
+                    if len(results) == k:
+                        break
+            except sqlite3.Error as e:
+                logger.warning("Ignoring the query library %s: %s", self.path, e)
+                return []
+        return results
+
+    def lookup(
+        self,
+        endpoint_url: str,
+        question: str,
+        entities: str = "",
+        min_similarity: float = 0.9,
+    ) -> Optional[Tuple[VerifiedQuery, float]]:
+        """
+        Finds the verified pair of the same question: the pair recorded for the normalized question
+        and entities, or else the pair of the most similar question (TF-IDF cosine similarity of the
+        questions alone, the words missing from the recorded questions counting against it) asked with
+        the same entities.
+
+        Args:
+            endpoint_url (str): The endpoint the question is asked on.
+            question (str): The question.
+            entities (str): The resolved entities of the question.
+            min_similarity (float): Minimum similarity of the questions, above 1 for exact matches only.
+
+        Returns:
+            Optional[Tuple[VerifiedQuery, float]]: The pair and the similarity of its question, 1.0 for
+            an exact match, or None if no pair matches.
+        """
+        with self._lock:
+            try:
+                conn = self._connect()
+                entry = conn.execute(
+                    f"SELECT {_PAIR_COLUMNS} FROM verified_queries WHERE key = ?",
+                    (self.key(endpoint_url, question, entities),),
+                ).fetchone()
+                if entry is not None:
+                    return VerifiedQuery(*entry), 1.0
+                if min_similarity > 1:
+                    return None
+                index = self._index(conn, endpoint_url)
+                if index is None:
+                    return None
+                normalized_entities = normalize_question(entities)
+                candidates = [
+                    entry
+                    for entry in conn.execute(
+                        f"SELECT {_PAIR_COLUMNS} FROM verified_queries WHERE endpoint = ?",
+                        (endpoint_url,),
+                    )
+                    if normalize_question(entry[1]) == normalized_entities
+                ]
+            except sqlite3.Error as e:
+                logger.warning("Ignoring the query library %s: %s", self.path, e)
+                return None
+        if not candidates:
+            return None
+        _, keys, vectorizer, _ = index
+        questions = vectorizer.transform([entry[0] for entry in candidates])
+        # A word of the question missing from every recorded question, such as "not" or "many",
+        # lowers the similarity instead of being ignored
+        scores = _similarities(vectorizer, questions, len(keys), question)
+        best = int(np.argmax(scores))
+        if scores[best] < min_similarity:
+            return None
+        return VerifiedQuery(*candidates[best]), float(scores[best])
+
+    def __len__(self) -> int:
+        with self._lock:
+            try:
+                return self._connect().execute("SELECT COUNT(*) FROM verified_queries").fetchone()[0]
+            except sqlite3.Error as e:
+                logger.warning("Could not read the query library %s: %s", self.path, e)
+                return 0
+
+    def clear(self) -> None:
+        """Removes all the verified pairs."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM verified_queries")
+            self._indexes.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
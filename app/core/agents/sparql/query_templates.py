@@ -0,0 +1,378 @@
+"""
+Parameterized SPARQL templates answering the common question shapes without generating a query.
+
+The templates of `app/data/query_templates.json` declare typed slots, written `<SlotName>` in their
+query like the placeholders of `queries.json`. A question is matched to the template whose example
+questions are the most similar (TF-IDF cosine similarity) among the templates whose slots are all
+filled by the question and its resolved entities, that use every entity of the question, and that
+declare the intents (count, negation, comparison) of the question. The slots are then replaced by the
+values found, so the same question always gives the same query.
+
+Usage:
+    python -m app.core.agents.sparql.query_templates --question "..." --entities "..."
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import re
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+TEMPLATES_PATH = Path(__file__).resolve().parents[3] / "data" / "query_templates.json"
+
+_PLACEHOLDER = re.compile(r"<([A-Za-z][A-Za-z0-9_]*)>")
+_IRI = re.compile(r"https?://[^\s<>\"'{}|\\^`,;]+")
+_IONIZATION_MODE = re.compile(r"\b(pos|positive|neg|negative)\b", re.IGNORECASE)
+_NUMBER = re.compile(r"(?<![\w.])(\d+(?:\.\d+)?)(\s*%)?(?!\w|\.\d)")
+# ChEMBL activity types, by lower-case name, as the literals of `ns2:activity_type`
+ACTIVITY_TYPES = {
+    name.lower(): name
+    for name in (
+        "IC50", "EC50", "AC50", "GI50", "CC50", "LC50", "LD50", "ED50", "Ki", "Kd", "MIC", "Potency"
+    )
+}
+_ACTIVITY_TYPE = re.compile(r"\b(" + "|".join(ACTIVITY_TYPES) + r")\b", re.IGNORECASE)
+_ACTIVITY_UNIT = re.compile(
+    r"(?<![A-Za-z])(pM|nM|uM|µM|mM|[nuµm]g/m[lL]|[nuµm]mol)\b|\b(nanomolar|micromolar|millimolar)\b"
+)
+
+# Words changing what a question asks for, that the TF-IDF similarity barely weighs: a template
+# answers a question using them only if it declares their intent
+INTENTS: Dict[str, re.Pattern] = {
+    "count": re.compile(r"\b(how many|how much|number of|count\w*|total)\b", re.IGNORECASE),
+    "negation": re.compile(
+        r"\b(not|no|none|never|without|except|excluding|lacking|missing)\b|n't\b", re.IGNORECASE
+    ),
+    "comparison": re.compile(
+        r"\b(above|below|over|under|exceed\w*|more than|less than|fewer than|at least|at most|"
+        r"between|greater|higher|lower|larger|smaller)\b",
+        re.IGNORECASE,
+    ),
+    # Annotation probabilities, only the templates filtering on them answer these questions
+    "probability": re.compile(r"\b(probabilit\w*|confiden\w*|scores?|likely)\b", re.IGNORECASE),
+}
+
+
+class QueryTemplateError(ValueError):
+    """A template definition that cannot be used."""
+
+
+def _entity_iris(entities: str) -> List[str]:
+    """IRIs of the resolved entities, without the punctuation of the sentence that follows them."""
+    return [iri.rstrip(".)") for iri in _IRI.findall(entities)]
+
+
+def _iri_values(pattern: str) -> Callable[[str, str], List[str]]:
+    """Extractor of the IRIs of the entities matching a pattern, written as SPARQL IRIs."""
+    compiled = re.compile(pattern)
+
+    def extract(question: str, entities: str) -> List[str]:
+        return [f"<{iri}>" for iri in _entity_iris(entities) if compiled.fullmatch(iri)]
+
+    return extract
+
+
+def _ionization_modes(question: str, entities: str) -> List[str]:
+    """Ionization modes named in the question, as the literals of `ns1:has_ionization`."""
+    return [f'"{mode.lower()[:3]}"' for mode in _IONIZATION_MODE.findall(question)]
+
+
+def _activity_types(question: str, entities: str) -> List[str]:
+    """ChEMBL activity types named in the question, as the literals of `ns2:activity_type`."""
+    return [f'"{ACTIVITY_TYPES[name.lower()]}"' for name in _ACTIVITY_TYPE.findall(question)]
+
+
+def _activity_units(question: str, entities: str) -> List[str]:
+    """Units of the activity values named in the question, as written in the question."""
+    return [f'"{unit or name}"' for unit, name in _ACTIVITY_UNIT.findall(question)]
+
+
+# Extractors of the values of the entity slots, by slot type. The number slots are filled from the
+# question by `_numbers` instead, with the bounds of the slot. A question naming a value of a type
+# that a template has no slot for is not answered by the template
+SLOT_TYPES: Dict[str, Callable[[str, str], List[str]]] = {
+    "taxon": _iri_values(r"http://www\.wikidata\.org/entity/Q\d+"),
+    "npc_class": _iri_values(r"https://enpkg\.commons-lab\.org/kg/npc_\w+"),
+    "chembl_target": _iri_values(r"https://www\.ebi\.ac\.uk/chembl/target_report_card/CHEMBL\d+"),
+    "ionization_mode": _ionization_modes,
+    "activity_type": _activity_types,
+    "activity_unit": _activity_units,
+}
+NUMBER_SLOT_TYPE = "number"
+
+
+def _numbers(question: str, minimum: Optional[float], maximum: Optional[float]) -> List[str]:
+    """Numbers of the question within bounds, percentages being converted to fractions."""
+    values = []
+    for digits, percent in _NUMBER.findall(question):
+        value = float(digits) / 100 if percent else float(digits)
+        if (minimum is None or value >= minimum) and (maximum is None or value <= maximum):
+            values.append(str(int(value)) if value.is_integer() else repr(value))
+    return values
+
+
+def _unique(values: List[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+def question_intents(question: str) -> Set[str]:
+    """
+    Returns:
+        Set[str]: The intents of `INTENTS` expressed by the words of the question.
+    """
+    return {intent for intent, pattern in INTENTS.items() if pattern.search(question)}
+
+
+class QueryTemplate:
+    """A SPARQL query with typed slots, and example questions it answers."""
+
+    def __init__(
+        self,
+        template_id: str,
+        query: str,
+        slots: Dict[str, Dict],
+        questions: List[str],
+        description: str = "",
+        intents: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Args:
+            template_id (str): Identifier of the template, reported in the tool output.
+            query (str): The query, with a `<SlotName>` placeholder for each slot.
+            slots (Dict[str, Dict]): Type of each slot (`type`, one of `SLOT_TYPES` or "number"),
+                with the `min` and `max` bounds of the number slots.
+            questions (List[str]): Example questions answered by the template.
+            description (str): What the query returns.
+            intents (Optional[List[str]]): The intents of `INTENTS` the query answers, e.g. "count"
+                for a query counting the features.
+
+        Raises:
+            QueryTemplateError: If the slots do not match the placeholders of the query, a slot type
+            is unknown or used by several slots, an intent is unknown, or the template has no example
+            question or an example question with an intent it does not declare.
+        """
+        self.id = template_id
+        self.query = query
+        self.slots = slots
+        self.questions = questions
+        self.description = description
+        self.intents = set(intents or [])
+
+        placeholders = set(_PLACEHOLDER.findall(query))
+        if placeholders != set(slots):
+            raise QueryTemplateError(
+                f"Template {template_id}: the placeholders {sorted(placeholders)} of the query do not "
+                f"match the slots {sorted(slots)}."
+            )
+        types = [slot.get("type") for slot in slots.values()]
+        for slot_type in types:
+            if slot_type not in SLOT_TYPES and slot_type != NUMBER_SLOT_TYPE:
+                raise QueryTemplateError(f"Template {template_id}: unknown slot type {slot_type!r}.")
+        if len(set(types)) != len(types):
+            # The values found in a question could not be assigned to the slots unambiguously
+            raise QueryTemplateError(f"Template {template_id}: several slots have the same type.")
+        if not questions:
+            raise QueryTemplateError(f"Template {template_id}: no example question.")
+        unknown = self.intents - set(INTENTS)
+        if unknown:
+            raise QueryTemplateError(f"Template {template_id}: unknown intents {sorted(unknown)}.")
+        for question in questions:
+            undeclared = question_intents(question) - self.intents
+            if undeclared:
+                raise QueryTemplateError(
+                    f"Template {template_id}: the example question {question!r} has the intents "
+                    f"{sorted(undeclared)} the template does not declare."
+                )
+
+    @property
+    def entity_types(self) -> set:
+        return {slot["type"] for slot in self.slots.values() if slot["type"] != NUMBER_SLOT_TYPE}
+
+    def slot_values(
+        self, question: str, found: Dict[str, List[str]]
+    ) -> Optional[Dict[str, str]]:
+        """
+        Assigns a value to each slot.
+
+        Args:
+            question (str): The question, searched for the numbers.
+            found (Dict[str, List[str]]): The distinct values of each entity slot type in the question.
+
+        Returns:
+            Optional[Dict[str, str]]: The value of each slot, None if a slot has no value or several.
+        """
+        values = {}
+        for name, slot in self.slots.items():
+            if slot["type"] == NUMBER_SLOT_TYPE:
+                candidates = _unique(_numbers(question, slot.get("min"), slot.get("max")))
+            else:
+                candidates = found.get(slot["type"], [])
+            if len(candidates) != 1:
+                return None
+            values[name] = candidates[0]
+        return values
+
+    def fill(self, values: Dict[str, str]) -> str:
+        """
+        Args:
+            values (Dict[str, str]): The SPARQL term of each slot.
+
+        Returns:
+            str: The query with its placeholders replaced by the values.
+        """
+        return _PLACEHOLDER.sub(lambda match: values[match.group(1)], self.query)
+
+    def __repr__(self) -> str:
+        return f"QueryTemplate({self.id!r})"
+
+
+class TemplateMatch:
+    """A template matched to a question, with the values of its slots and the filled query."""
+
+    def __init__(
+        self, template: QueryTemplate, values: Dict[str, str], query: str, similarity: float
+    ) -> None:
+        self.template = template
+        self.values = values
+        self.query = query
+        self.similarity = similarity
+
+    def __repr__(self) -> str:
+        return f"TemplateMatch({self.template.id!r}, similarity={self.similarity:.2f})"
+
+
+class TemplateEngine:
+    """Matches questions and their resolved entities to the templates and fills them."""
+
+    def __init__(self, templates: List[QueryTemplate], min_similarity: float = 0.5) -> None:
+        """
+        Args:
+            templates (List[QueryTemplate]): The templates, the first ones win ties.
+            min_similarity (float): Minimum similarity of a question with the example questions of
+                a template for the template to be used.
+        """
+        self.templates = templates
+        self.min_similarity = min_similarity
+        # The stop words are kept, they include words such as "how", "not" or "above"
+        self._vectorizer = TfidfVectorizer()
+        self._question_matrix = self._vectorizer.fit_transform(
+            [question for template in templates for question in template.questions]
+        )
+        # Rows of the example questions of each template in the matrix
+        self._rows = []
+        start = 0
+        for template in templates:
+            self._rows.append(slice(start, start + len(template.questions)))
+            start += len(template.questions)
+
+    @classmethod
+    def from_file(cls, path: Path = TEMPLATES_PATH, min_similarity: float = 0.5) -> TemplateEngine:
+        """
+        Loads the templates of a JSON file with a `templates` list.
+
+        Raises:
+            QueryTemplateError: If a template is invalid.
+        """
+        with open(path, encoding="utf-8") as file:
+            definitions = json.load(file)["templates"]
+        try:
+            templates = [
+                QueryTemplate(
+                    definition["id"],
+                    definition["query"],
+                    definition.get("slots", {}),
+                    definition.get("questions", []),
+                    definition.get("description", ""),
+                    definition.get("intents", []),
+                )
+                for definition in definitions
+            ]
+        except KeyError as e:
+            raise QueryTemplateError(f"Template definition without {e} in {path}") from e
+        return cls(templates, min_similarity)
+
+    @staticmethod
+    def find_entities(question: str, entities: str) -> Dict[str, List[str]]:
+        """
+        Returns:
+            Dict[str, List[str]]: The distinct values of each entity slot type in a question and its
+            resolved entities, as SPARQL terms.
+        """
+        found = {}
+        for slot_type, extract in SLOT_TYPES.items():
+            values = _unique(extract(question, entities))
+            if values:
+                found[slot_type] = values
+        return found
+
+    def match(self, question: str, entities: str = "") -> Optional[TemplateMatch]:
+        """
+        Finds the template answering a question and fills it.
+
+        A template is a candidate when each of its slots gets exactly one value, each entity of the
+        question fills one of its slots, and it declares the intents of the question (a list of
+        features does not answer "how many features" nor "which features were not annotated"): a
+        template would otherwise ignore part of the question. The candidate with the most similar
+        example question is used, when the similarity reaches `min_similarity`.
+
+        Args:
+            question (str): The question of the user.
+            entities (str): The resolved entities of the question, with their IRIs.
+
+        Returns:
+            Optional[TemplateMatch]: The match, None if no template answers the question.
+        """
+        found = self.find_entities(question, entities)
+        known = {value.strip("<>") for values in found.values() for value in values}
+        unknown = [iri for iri in _entity_iris(entities) if iri not in known]
+        if unknown:
+            logger.debug("No template uses the entities %s", unknown)
+            return None
+
+        intents = question_intents(question)
+        vector = self._vectorizer.transform([question])
+        similarities = (self._question_matrix @ vector.T).toarray().ravel()
+        best = None
+        for template, rows in zip(self.templates, self._rows):
+            if not set(found) <= template.entity_types or not intents <= template.intents:
+                continue
+            values = template.slot_values(question, found)
+            if values is None:
+                continue
+            similarity = float(similarities[rows].max())
+            if similarity >= self.min_similarity and (best is None or similarity > best.similarity):
+                best = TemplateMatch(template, values, template.fill(values), similarity)
+        if best is not None:
+            logger.info(
+                "Question matched to template %s (similarity %.2f)", best.template.id, best.similarity
+            )
+        return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--templates", type=Path, default=TEMPLATES_PATH)
+    parser.add_argument("--question", required=True)
+    parser.add_argument("--entities", default="")
+    parser.add_argument("--min-similarity", type=float, default=0.5)
+    args = parser.parse_args()
+
+    engine = TemplateEngine.from_file(args.templates, args.min_similarity)
+    match = engine.match(args.question, args.entities)
+    if match is None:
+        print("No template matches the question.")
+        return
+    print(f"Template {match.template.id} (similarity {match.similarity:.2f})")
+    print(match.query)
+
+
+if __name__ == "__main__":
+    main()
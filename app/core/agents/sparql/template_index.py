@@ -0,0 +1,365 @@
+"""
+Persistent TF-IDF index of the SPARQL query templates of `app/data/queries.json`.
+
+The vectorizer and the template matrix are built once and saved next to the templates
+(`queries.index.json` and `queries.index.npz`), then reloaded as long as the checksum of the templates
+file matches. Lookups only vectorize the searched query and multiply it with the template matrix.
+
+Usage:
+    python -m app.core.agents.sparql.template_index --query "SELECT ?feature WHERE { ... }" --top-k 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+QUERIES_PATH = Path(__file__).resolve().parents[3] / "data" / "queries.json"
+
+# Version of the saved index, an index saved with another version is rebuilt
+INDEX_FORMAT_VERSION = 2
+
+# Tokens of TfidfVectorizer with its default token_pattern and lowercase=True
+_TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def templates_checksum(queries_path: Path) -> str:
+    """SHA-256 of the templates file."""
+    return hashlib.sha256(Path(queries_path).read_bytes()).hexdigest()
+
+
+def _write_atomically(path: Path, content: bytes) -> None:
+    """Writes a file through a temporary file of its directory, so readers never see a partial file."""
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    ) as temp_file:
+        temp_file.write(content)
+        temp_path = Path(temp_file.name)
+    try:
+        temp_path.chmod(0o644)
+        os.replace(temp_path, path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _append_templates(text: str, templates: List[Dict]) -> str:
+    """
+    Appends templates to the `queries` list of a templates file without reformatting the templates
+    already in it. Files whose list is not the last value of the object are written again as a whole.
+    """
+    content = json.loads(text)
+    expected = content["queries"] + templates
+    end = text.rfind("]")
+    head = text[:end].rstrip()
+    entries = ",".join(
+        "\n" + "\n".join("    " + line for line in json.dumps(t, indent=2).splitlines())
+        for t in templates
+    )
+    separator = "" if head.endswith("[") else ","
+    appended = head + separator + entries + "\n  " + text[end:]
+    try:
+        if json.loads(appended)["queries"] == expected:
+            return appended
+    except (ValueError, KeyError):
+        pass
+    content["queries"] = expected
+    return json.dumps(content, indent=2)
+
+
+def index_paths(queries_path: Path) -> Tuple[Path, Path]:
+    """Metadata and matrix files of the index of a templates file."""
+    queries_path = Path(queries_path)
+    return (
+        queries_path.with_suffix(".index.json"),
+        queries_path.with_suffix(".index.npz"),
+    )
+
+
+class TemplateIndex:
+    """
+    TF-IDF vectors of query templates, compared by cosine similarity. The rows are L2-normalized, so
+    the similarities are the products of the template matrix with the searched vector.
+
+    Templates added with `add` are vectorized with the vocabulary and the IDF weights of the last
+    fit, without refitting: terms missing from the vocabulary are ignored. `build` refits on all the
+    templates.
+    """
+
+    def __init__(
+        self,
+        templates: List[Dict],
+        vocabulary: Dict[str, int],
+        idf: np.ndarray,
+        matrix: sparse.csr_matrix,
+        checksum: str = "",
+        queries_path: Optional[Path] = None,
+    ) -> None:
+        """
+        Args:
+            templates (List[Dict]): The templates, with their `query`, in the order of the matrix rows.
+            vocabulary (Dict[str, int]): Column of each term.
+            idf (np.ndarray): IDF weight of each column.
+            matrix (sparse.csr_matrix): Normalized TF-IDF vector of each template.
+            checksum (str): Checksum of the templates file the index was built from.
+            queries_path (Optional[Path]): Templates file, updated by `add` with the index files.
+        """
+        self.templates = templates
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+        self.checksum = checksum
+        self.queries_path = Path(queries_path) if queries_path else None
+
+    @classmethod
+    def build(
+        cls,
+        templates: List[Dict],
+        checksum: str = "",
+        queries_path: Optional[Path] = None,
+    ) -> TemplateIndex:
+        """
+        Fits the vectorizer on the templates.
+
+        Args:
+            templates (List[Dict]): The templates, with their `query`.
+            checksum (str): Checksum of the templates file.
+            queries_path (Optional[Path]): Templates file.
+
+        Returns:
+            TemplateIndex: The index.
+        """
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform([template["query"] for template in templates])
+        vocabulary = {term: int(column) for term, column in vectorizer.vocabulary_.items()}
+        return cls(templates, vocabulary, vectorizer.idf_, matrix.tocsr(), checksum, queries_path)
+
+    @classmethod
+    def load(cls, queries_path: Path = QUERIES_PATH) -> TemplateIndex:
+        """
+        Loads the index saved next to a templates file, or builds and saves it when it is missing,
+        was built from another version of the templates or cannot be read, e.g. a truncated file.
+
+        Args:
+            queries_path (Path): The templates file, a JSON object with a `queries` list.
+
+        Returns:
+            TemplateIndex: The index.
+        """
+        queries_path = Path(queries_path)
+        content = queries_path.read_bytes()
+        checksum = hashlib.sha256(content).hexdigest()
+        templates = json.loads(content)["queries"]
+        metadata_path, matrix_path = index_paths(queries_path)
+        try:
+            metadata = json.loads(metadata_path.read_text(encoding="utf-8"))
+            if (
+                metadata.get("format_version") == INDEX_FORMAT_VERSION
+                and metadata.get("checksum") == checksum
+            ):
+                with np.load(matrix_path) as arrays:
+                    matrix = sparse.csr_matrix(
+                        (arrays["data"], arrays["indices"], arrays["indptr"]),
+                        shape=tuple(arrays["shape"]),
+                    )
+                    idf = arrays["idf"]
+                    matrix_checksum = str(arrays["checksum"])
+                # The matrix may come from another save than the metadata if a save was interrupted
+                if (
+                    matrix_checksum == checksum
+                    and matrix.shape == (len(templates), len(metadata["vocabulary"]))
+                    and len(idf) == matrix.shape[1]
+                ):
+                    return cls(templates, metadata["vocabulary"], idf, matrix, checksum, queries_path)
+            logger.info("Template index of %s is outdated, rebuilding it", queries_path)
+        except Exception as e:
+            # Any unreadable index, e.g. a truncated archive, is rebuilt
+            logger.info("No usable template index for %s (%s), building it", queries_path, e)
+
+        index = cls.build(templates, checksum, queries_path)
+        try:
+            index.save()
+        except OSError as e:
+            logger.warning("Could not save the template index of %s: %s", queries_path, e)
+        return index
+
+    def save(self) -> None:
+        """
+        Writes the index next to its templates file. Both files are written atomically and hold the
+        checksum of the templates, so that `load` rebuilds the index instead of pairing the files of
+        two different saves.
+        """
+        metadata_path, matrix_path = index_paths(self.queries_path)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape),
+            idf=self.idf,
+            checksum=np.array(self.checksum),
+        )
+        _write_atomically(matrix_path, buffer.getvalue())
+        metadata = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "checksum": self.checksum,
+            "vocabulary": self.vocabulary,
+        }
+        _write_atomically(metadata_path, json.dumps(metadata).encode("utf-8"))
+
+    def _weights(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Columns and normalized TF-IDF weights of the terms of a text found in the vocabulary."""
+        counts = Counter(
+            self.vocabulary[token]
+            for token in _TOKEN_PATTERN.findall(text.lower())
+            if token in self.vocabulary
+        )
+        columns = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        weights *= self.idf[columns]
+        norm = np.sqrt(weights @ weights)
+        if norm > 0:
+            weights /= norm
+        return columns, weights
+
+    def vectorize(self, text: str) -> sparse.csr_matrix:
+        """
+        Computes the TF-IDF vector of a text like the fitted `TfidfVectorizer.transform` would.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            sparse.csr_matrix: The normalized vector, a 1 x vocabulary size matrix.
+        """
+        columns, weights = self._weights(text)
+        order = np.argsort(columns)
+        return sparse.csr_matrix(
+            (weights[order], columns[order], np.array([0, len(columns)])),
+            shape=(1, len(self.idf)),
+        )
+
+    def search(self, query: str, k: int = 1) -> List[Tuple[Dict, float]]:
+        """
+        Finds the templates most similar to a query.
+
+        Args:
+            query (str): The query, e.g. a generated SPARQL query.
+            k (int): Number of templates returned.
+
+        Returns:
+            List[Tuple[Dict, float]]: The templates and their cosine similarity, most similar first.
+        """
+        if not self.templates or k <= 0:
+            return []
+        columns, weights = self._weights(query)
+        # The product of a sparse matrix with a dense vector is much faster than with a sparse one
+        vector = np.zeros(len(self.idf))
+        vector[columns] = weights
+        scores = self.matrix @ vector
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.lexsort((best, -scores[best]))]
+        return [(self.templates[i], float(scores[i])) for i in best]
+
+    def add(self, templates: List[Dict]) -> None:
+        """
+        Adds templates without refitting the vectorizer. When the index belongs to a templates file,
+        the templates are appended to the file, keeping the formatting of the templates already in
+        it, and the index is saved with its new checksum.
+
+        Args:
+            templates (List[Dict]): The templates, with their `query`. Those without an `id` get the
+                next free integer.
+        """
+        next_id = 1 + max(
+            (t["id"] for t in self.templates if isinstance(t.get("id"), int)), default=0
+        )
+        added = []
+        for template in templates:
+            if "id" not in template:
+                template = {"id": next_id, **template}
+                next_id += 1
+            added.append(template)
+        rows = [self.vectorize(template["query"]) for template in added]
+        self.matrix = sparse.vstack([self.matrix, *rows], format="csr")
+        self.templates = self.templates + added
+
+        if self.queries_path is not None:
+            text = _append_templates(self.queries_path.read_text(encoding="utf-8"), added)
+            _write_atomically(self.queries_path, text.encode("utf-8"))
+            self.checksum = templates_checksum(self.queries_path)
+            self.save()
+
+
+# Template indexes loaded in the process, by templates file, with the fingerprint of the file
+_template_indexes: Dict[str, Tuple[Tuple[int, int], TemplateIndex]] = {}
+_template_indexes_lock = threading.Lock()
+
+
+def get_template_index(queries_path: Path = QUERIES_PATH) -> TemplateIndex:
+    """
+    Returns the index of a templates file, loaded once per process and loaded again when the file
+    changes on disk.
+
+    Args:
+        queries_path (Path): The templates file.
+
+    Returns:
+        TemplateIndex: The shared index.
+    """
+    stat = Path(queries_path).stat()
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    key = str(queries_path)
+    with _template_indexes_lock:
+        cached = _template_indexes.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = _template_indexes[key] = (fingerprint, TemplateIndex.load(queries_path))
+        return cached[1]
+
+
+def clear_template_indexes() -> None:
+    """Drops the loaded template indexes."""
+    with _template_indexes_lock:
+        _template_indexes.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--queries", type=Path, default=QUERIES_PATH)
+    parser.add_argument("--query", type=str, help="Query to look up once the index is built.")
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    index = TemplateIndex.load(args.queries)
+    print(f"{len(index.templates)} templates, {len(index.vocabulary)} terms")
+    if args.query:
+        start = time.perf_counter()
+        results = index.search(args.query, args.top_k)
+        elapsed = time.perf_counter() - start
+        for template, score in results:
+            print(f"{score:.3f}  template {template.get('id')}")
+        print(f"Lookup in {elapsed * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 import csv
+import itertools
 import json
 import os
 import re
 import tempfile
-from typing import Dict
+import threading
+import time
+from typing import Dict, Iterator, List, Set, Tuple
 from pathlib import Path
 
 from langchain.chains.llm import LLMChain
@@ -15,7 +18,17 @@ from langchain.tools import BaseTool
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
 
-from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.RdfGraphCustom import RdfGraph, sparql_config_path
+from app.core.graph_management.schema_validator import SchemaDiagnostic
+from app.core.graph_management.sparql_store import (
+    QueryCancellation,
+    SparqlServerError,
+    SparqlSyntaxError,
+    SparqlTimeoutError,
+)
+from app.core.agents.sparql.query_library import QueryLibrary, VerifiedQuery
+from app.core.agents.sparql.query_templates import TemplateEngine, TemplateMatch
+from app.core.agents.sparql.template_index import QUERIES_PATH, get_template_index
 from app.core.utils import token_counter
 from app.core.session import setup_logger, create_user_session
 from app.core.memory.database_manager import tools_database
@@ -24,9 +37,6 @@ from typing import Optional
 
 # new imports for similarity search
 import json
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
 
 from langchain.callbacks.manager import (
     CallbackManagerForToolRun,
@@ -121,6 +131,10 @@ This example demonstrates incorrect use of properties:
 ex:SomeBook a ex:Book ;
     ex:hasName "Some Book Title" .
 Thus, avoid using properties with the classes and objects that are not associated with them.
+
+Verified examples: the following queries returned results for similar questions on this knowledge graph. Follow their structure when it fits the question, but use the entities of the question:
+{examples}
+
 Schema:
 {schema}
 
@@ -134,7 +148,7 @@ The question is:
 
 
 SPARQL_GENERATION_SELECT_PROMPT = PromptTemplate(
-    input_variables=["schema", "entities", "question"],
+    input_variables=["schema", "entities", "question", "examples"],
     template=SPARQL_GENERATION_SELECT_TEMPLATE,
 )
 
@@ -182,6 +196,9 @@ Include only necessary variables that are directly referenced in the query. Do n
 SPARQL query for you to correct:
 {generated_sparql}
 
+Errors found by checking the query against the schema:
+{diagnostics}
+
 The schema is:
 {schema}
 
@@ -190,14 +207,107 @@ Additional entities:
 
 Example of right SPARQL query:
 {template_query}
+
+Verified queries of similar questions:
+{examples}
 """
 
 SPARQL_IMPROVEMENT_PROMPT = PromptTemplate(
-    input_variables=["generated_sparql", "schema", "entities", "template_query"],
+    input_variables=[
+        "generated_sparql", "schema", "entities", "template_query", "diagnostics", "examples"
+    ],
     template=SPARQL_IMPROVEMENT_TEMPLATE,
 )
 
 
+SPARQL_REFORMULATION_TEMPLATE = """Task: Rewrite a SPARQL query that is too expensive to run. The query below is correct, but it is estimated to compute about {estimated_cost} intermediate results and to return about {estimated_rows} rows, which would time out on the knowledge graph endpoint.
+
+Rewrite it so that it answers the same question with far fewer intermediate results:
+1. Use the IRIs of the additional entities (taxon, class, target...) as objects of the triples instead of matching them with literal values or FILTER clauses.
+2. Remove the triples and variables that are not needed to answer the question.
+3. Prefer aggregates (COUNT, SAMPLE...) when the question asks for numbers rather than lists.
+4. Keep the properties and classes of the original query, which follow the schema.
+
+Output Format: Your response should consist solely of the SPARQL query. Do not include any markdown syntax (e.g., triple backticks), preamble words (like "sparql"), or any other text outside the SPARQL query itself.
+
+The question is:
+{question}
+
+Additional entities:
+{entities}
+
+SPARQL query to rewrite:
+{generated_sparql}
+"""
+
+SPARQL_REFORMULATION_PROMPT = PromptTemplate(
+    input_variables=["question", "entities", "generated_sparql", "estimated_cost", "estimated_rows"],
+    template=SPARQL_REFORMULATION_TEMPLATE,
+)
+
+
+# FAISS index of the schema nodes searched by `search_nodes`
+SCHEMA_NODE_INDEX_PATH = Path(__file__).resolve().parents[3] / "data" / "faiss_db"
+
+# Schema node indexes loaded in the process, by (index directory, OpenAI key), with the fingerprint of
+# their files when they were loaded
+_schema_node_indexes: Dict[Tuple[str, Optional[str]], Tuple[Tuple, FAISS]] = {}
+_schema_node_indexes_lock = threading.Lock()
+
+
+def _index_fingerprint(db_path: Path) -> Tuple:
+    """Name, modification time and size of the files of an index directory."""
+    try:
+        return tuple(
+            sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in db_path.iterdir()
+                if entry.is_file()
+            )
+        )
+    except OSError:
+        return ()
+
+
+def load_schema_node_index(
+    db_path: Path = SCHEMA_NODE_INDEX_PATH, openai_key: Optional[str] = None
+) -> FAISS:
+    """
+    Returns the FAISS index of the schema nodes, loaded from disk the first time it is needed and then
+    shared by every session and tool instance of the process. The index is loaded again when its files
+    change on disk.
+
+    Args:
+        db_path (Path): Directory of the index, written by `FAISS.save_local`.
+        openai_key (Optional[str]): OpenAI key of the embeddings client, the environment one if None.
+
+    Returns:
+        FAISS: The index, with the embeddings client used to embed the searched queries.
+    """
+    key = (str(db_path), openai_key)
+    fingerprint = _index_fingerprint(db_path)
+    # Held while loading, so that concurrent searches wait for one load instead of loading it each
+    with _schema_node_indexes_lock:
+        cached = _schema_node_indexes.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        embedding_kwargs = {"api_key": openai_key} if openai_key else {}
+        db = FAISS.load_local(
+            str(db_path), OpenAIEmbeddings(**embedding_kwargs), allow_dangerous_deserialization=True
+        )
+        _schema_node_indexes[key] = (fingerprint, db)
+        logger.info(
+            "%s schema node index from %s", "Reloaded" if cached else "Loaded", db_path
+        )
+        return db
+
+
+def clear_schema_node_indexes() -> None:
+    """Drops the loaded schema node indexes, the next searches load them again."""
+    with _schema_node_indexes_lock:
+        _schema_node_indexes.clear()
+
+
 class SparqlInput(BaseModel):
     question: str = Field(description="the original question from the user")
     entities: str = Field(
@@ -205,6 +315,29 @@ class SparqlInput(BaseModel):
     )
 
 
+# Cancellation tokens of the questions being answered, keyed by session ID
+_session_cancellations: Dict[Optional[str], Set[QueryCancellation]] = {}
+_session_cancellations_lock = threading.Lock()
+
+
+def cancel_session_queries(session_id: Optional[str]) -> int:
+    """
+    Cancels the SPARQL queries of the questions a session is answering, e.g. when the user stops
+    the question or interrupts the CLI. The next questions of the session are not affected.
+
+    Args:
+        session_id (Optional[str]): The session whose queries are cancelled.
+
+    Returns:
+        int: The number of questions whose queries were cancelled.
+    """
+    with _session_cancellations_lock:
+        cancellations = list(_session_cancellations.get(session_id, ()))
+    for cancellation in cancellations:
+        cancellation.cancel()
+    return len(cancellations)
+
+
 ##Question-answering against an RDF or OWL graph by generating SPARQL statements.
 class GraphSparqlQAChain(BaseTool):
     name: str = "SPARQL_QUERY_RUNNER"
@@ -229,10 +362,24 @@ class GraphSparqlQAChain(BaseTool):
     args_schema: type[BaseModel] = SparqlInput
     sparql_generation_select_chain: LLMChain = None
     sparql_improvement_chain: LLMChain = None
+    sparql_reformulation_chain: LLMChain = None
     requires_params: bool = True
     graph: RdfGraph = None
     session_id: str = None
     openai_key: Optional[str] = None
+    # Handling of the queries estimated too expensive, from the [queryCost] section of sparql.ini
+    max_query_cost: float = 0
+    query_cost_policy: str = "warn"
+    query_cost_max_rows: int = 10000
+    # Verified question and query pairs given as examples to the prompts, from [queryLibrary]
+    query_library: Optional[QueryLibrary] = None
+    max_examples: int = 3
+    min_example_similarity: float = 0.2
+    # Answer the questions already answered with their verified query, from [questionCache]
+    question_cache: bool = False
+    question_cache_min_similarity: float = 0.9
+    # Templates filled with the entities of the common questions, from [queryTemplates]
+    template_engine: Optional[TemplateEngine] = None
 
     def __init__(
         self,
@@ -253,12 +400,34 @@ class GraphSparqlQAChain(BaseTool):
                 llm=llm["llm_o3_mini"],
                 prompt=SPARQL_IMPROVEMENT_PROMPT,
             )
+            self.sparql_reformulation_chain = LLMChain(
+                llm=llm["llm_o3_mini"],
+                prompt=SPARQL_REFORMULATION_PROMPT,
+            )
         except KeyError as e:
             logger.error(f"Missing LLM key: {e}")
             raise
         self.graph = graph
         self.session_id = session_id
         self.openai_key = openai_key or os.getenv("OPENAI_API_KEY")
+        config = RdfGraph.load_config(sparql_config_path)
+        self.max_query_cost = config.getfloat("queryCost", "max_cost", fallback=0)
+        self.query_cost_policy = config.get("queryCost", "policy", fallback="warn")
+        self.query_cost_max_rows = config.getint("queryCost", "max_rows", fallback=10000)
+        if config.getboolean("queryLibrary", "enabled", fallback=False):
+            self.query_library = QueryLibrary()
+            self.max_examples = config.getint("queryLibrary", "max_examples", fallback=3)
+            self.min_example_similarity = config.getfloat(
+                "queryLibrary", "min_similarity", fallback=0.2
+            )
+            self.question_cache = config.getboolean("questionCache", "enabled", fallback=False)
+            self.question_cache_min_similarity = config.getfloat(
+                "questionCache", "min_similarity", fallback=0.9
+            )
+        if config.getboolean("queryTemplates", "enabled", fallback=False):
+            self.template_engine = TemplateEngine.from_file(
+                min_similarity=config.getfloat("queryTemplates", "min_similarity", fallback=0.5)
+            )
 
     def _run(
         self,
@@ -266,6 +435,27 @@ class GraphSparqlQAChain(BaseTool):
         entities: str = "",
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> Dict[str, str]:
+        # Each question gets its own token, so that aborting one does not cancel the next ones
+        cancellation = QueryCancellation()
+        with _session_cancellations_lock:
+            _session_cancellations.setdefault(self.session_id, set()).add(cancellation)
+        try:
+            return self._answer(question, entities, cancellation)
+        except BaseException:
+            # Stops the queries still running in the worker threads when the run is interrupted
+            cancellation.cancel()
+            raise
+        finally:
+            with _session_cancellations_lock:
+                running = _session_cancellations.get(self.session_id)
+                if running is not None:
+                    running.discard(cancellation)
+                    if not running:
+                        del _session_cancellations[self.session_id]
+
+    def _answer(
+        self, question: str, entities: str, cancellation: QueryCancellation
+    ) -> Dict[str, str]:
 
         logger.info(
             "providing question and entities to the chain for generating SPARQL query"
@@ -273,48 +463,137 @@ class GraphSparqlQAChain(BaseTool):
         logger.info("question: %s", question)
         logger.info("Entities: %s", entities)
 
-        generated_sparql = self.sparql_generation_select_chain.run(
-            {
-                "question": question,
-                "entities": entities,
-                "schema": self.graph.get_schema,
-            }
-        )
-
-        generated_sparql = self.remove_markdown_quotes(generated_sparql)
-        generated_sparql = self.remove_xsd_prefix(generated_sparql)
-
-        logger.info("Generated SPARQL query: %s", generated_sparql)
-
-        result = self.graph.query(generated_sparql)
-        #Check if the result is empty
-        if not result:
-            print("The query result is empty.")
-            #retrieving the schema nodes related to the initial query
-            schema_retrieved = self.search_nodes(generated_sparql)
-            #retrieving the sparql query template
-            template_query = self.find_similar_query(generated_sparql)
-            # Regenerate the SPARQL query
-            regenerated_sparql = self.sparql_improvement_chain.run(
+        cache_hit, cached = False, self.find_cached_query(question, entities)
+        if cached is not None:
+            start = time.perf_counter()
+            pages = self.graph.iter_query_pages(
+                self._optimize(cached.query), cancellation=cancellation
+            )
+            result = next(pages, [])
+            if result:
+                # The verified query of the same question is sent without generating a new one
+                cache_hit = True
+                generated_sparql = final_sparql = cached.query
+                latency = time.perf_counter() - start
+                cost_warning, diagnostics = None, []
+            else:
+                logger.info("The cached SPARQL query returned no results, generating a new one")
+
+        template = None if cache_hit else self.match_template(question, entities)
+        if template is not None:
+            # The filled template is sent without generating a query
+            generated_sparql, cost_warning = self.apply_cost_policy(
+                template.query, question, entities
+            )
+            diagnostics = []
+            start = time.perf_counter()
+            pages = self.graph.iter_query_pages(
+                self._optimize(generated_sparql), cancellation=cancellation
+            )
+            result = next(pages, [])
+            final_sparql, latency = generated_sparql, time.perf_counter() - start
+            if not result:
+                # The template may not fit the question or the data, a query is generated instead
+                logger.info(
+                    "The SPARQL query of template %s returned no results, generating a new one",
+                    template.template.id,
+                )
+                template = None
+
+        if not cache_hit and template is None:
+            examples = self.format_examples(self.find_verified_examples(question, entities))
+
+            generated_sparql = self.sparql_generation_select_chain.run(
                 {
-                    "generated_sparql": generated_sparql,
-                    "schema": schema_retrieved,
+                    "question": question,
                     "entities": entities,
-                    "template_query": template_query,
+                    "schema": self.graph.get_schema,
+                    "examples": examples,
                 }
             )
 
-            regenerated_sparql = self.remove_markdown_quotes(regenerated_sparql)
-            regenerated_sparql = self.remove_xsd_prefix(regenerated_sparql)
-
-            logger.info("Regenerated SPARQL query: %s", regenerated_sparql)
-
-            # Query the graph again with the regenerated SPARQL query
-            result = self.graph.query(regenerated_sparql)
-
-
-        # Create csv temp file inside the _call
-        temp_file_path = self.json_to_csv(result)
+            generated_sparql = self.remove_markdown_quotes(generated_sparql)
+            generated_sparql = self.remove_xsd_prefix(generated_sparql)
+
+            logger.info("Generated SPARQL query: %s", generated_sparql)
+
+            generated_sparql, diagnostics = self._validate(generated_sparql)
+            if self.has_schema_errors(diagnostics):
+                # A query that does not match the schema is corrected without querying the endpoint
+                logger.info("Generated SPARQL query does not match the schema: %s", diagnostics)
+                pages, result, cost_warning = iter(()), [], None
+                final_sparql, latency = generated_sparql, 0.0
+            else:
+                if diagnostics:
+                    # The schema is sampled, the properties may exist on instances it did not see
+                    logger.info(
+                        "Generated SPARQL query uses properties missing from the schema, "
+                        "sending it anyway: %s",
+                        diagnostics,
+                    )
+                generated_sparql, cost_warning = self.apply_cost_policy(
+                    generated_sparql, question, entities
+                )
+
+                pages, result, latency = self._send(generated_sparql, diagnostics, cancellation)
+                final_sparql = generated_sparql
+                repaired = None
+                if diagnostics and not result:
+                    repaired = self.graph.repair_query(generated_sparql)
+                if repaired is not None:
+                    # The query without results is repaired with the schema before asking the LLM
+                    logger.info("SPARQL query repaired with the schema: %s", repaired)
+                    generated_sparql, diagnostics = repaired, []
+                    pages, result, latency = self._send(generated_sparql, diagnostics, cancellation)
+                    final_sparql = generated_sparql
+            #Check if the result is empty
+            if not result:
+                print("The query result is empty.")
+                #retrieving the schema nodes related to the initial query
+                schema_retrieved = self.search_nodes(generated_sparql)
+                #retrieving the sparql query template
+                template_query = self.find_similar_query(generated_sparql)
+                # Regenerate the SPARQL query
+                regenerated_sparql = self.sparql_improvement_chain.run(
+                    {
+                        "generated_sparql": generated_sparql,
+                        "schema": schema_retrieved,
+                        "entities": entities,
+                        "template_query": template_query,
+                        "diagnostics": self.format_diagnostics(diagnostics),
+                        "examples": examples,
+                    }
+                )
+
+                regenerated_sparql = self.remove_markdown_quotes(regenerated_sparql)
+                regenerated_sparql = self.remove_xsd_prefix(regenerated_sparql)
+
+                logger.info("Regenerated SPARQL query: %s", regenerated_sparql)
+
+                regenerated_sparql, diagnostics = self._validate(regenerated_sparql)
+                if self.has_schema_errors(diagnostics):
+                    logger.warning(
+                        "Regenerated SPARQL query does not match the schema, it is not sent: %s",
+                        diagnostics,
+                    )
+                else:
+                    regenerated_sparql, cost_warning = self.apply_cost_policy(
+                        regenerated_sparql, question, entities
+                    )
+
+                    # Query the graph again with the regenerated SPARQL query
+                    pages, result, latency = self._send(
+                        regenerated_sparql, diagnostics, cancellation
+                    )
+                    final_sparql = regenerated_sparql
+
+
+        # Create csv temp file inside the _call, the remaining pages are written to it as they arrive
+        temp_file_path, row_count = self.pages_to_csv(result, pages)
+        if row_count and self.query_library is not None:
+            self.query_library.record(
+                self.graph.query_endpoint, question, entities, final_sparql, row_count, latency
+            )
 
         # Add check conditions (if temp_file_path=null->generate new sparql query)
         logger.info("Saving results to file: %s", temp_file_path)
@@ -354,8 +633,256 @@ class GraphSparqlQAChain(BaseTool):
                 "temp_file_path": temp_file_path,  # Add the file path to the results
             }
 
+        contextualized_result["cache_hit"] = cache_hit
+        if template is not None:
+            contextualized_result["template_id"] = template.template.id
+        if cost_warning:
+            contextualized_result["warning"] = cost_warning
+        if diagnostics and not result:
+            contextualized_result["validation_errors"] = [d.message for d in diagnostics]
+
+        if row_count > len(result):
+            # Only the first page is given to the LLM, the file holds the complete result
+            contextualized_result["row_count"] = row_count
+            contextualized_result["result_is_preview"] = True
+
         return {"result": contextualized_result}
 
+    def apply_cost_policy(
+        self, sparql: str, question: str, entities: str
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Estimates the cost of a generated query before it is sent and, above `max_query_cost`, applies
+        `query_cost_policy`: "limit" adds a LIMIT of `query_cost_max_rows` rows, "reformulate" asks the
+        LLM for a more selective query and adds the LIMIT if it is still too expensive, "warn" keeps the
+        query unchanged.
+
+        Args:
+          sparql (str): the generated query.
+          question (str): the question of the user.
+          entities (str): the resolved entities of the question.
+
+        Returns:
+          Tuple[str, Optional[str]]: the query to send, and a warning for the user if it was estimated
+          too expensive.
+        """
+        if self.max_query_cost <= 0:
+            return sparql, None
+        cost = self.graph.estimate_query_cost(sparql)
+        if cost is None or cost.cost <= self.max_query_cost:
+            return sparql, None
+        logger.warning("Query estimated too expensive (%r): %s", cost, sparql)
+
+        if self.query_cost_policy == "reformulate":
+            reformulated = self.sparql_reformulation_chain.run(
+                {
+                    "question": question,
+                    "entities": entities,
+                    "generated_sparql": sparql,
+                    "estimated_cost": f"{cost.cost:.0f}",
+                    "estimated_rows": f"{cost.rows:.0f}",
+                }
+            )
+            reformulated = self.remove_xsd_prefix(self.remove_markdown_quotes(reformulated))
+            reformulated_cost = self.graph.estimate_query_cost(reformulated)
+            logger.info("Reformulated SPARQL query (%r): %s", reformulated_cost, reformulated)
+            if reformulated_cost is not None and reformulated_cost.cost < cost.cost:
+                sparql, cost = reformulated, reformulated_cost
+                if cost.cost <= self.max_query_cost:
+                    return sparql, None
+
+        if self.query_cost_policy in ("limit", "reformulate"):
+            limited = self.limit_query(sparql, self.query_cost_max_rows)
+            if limited != sparql:
+                return limited, (
+                    f"The query was estimated to compute about {cost.cost:.0f} intermediate results "
+                    f"and was limited to its first {self.query_cost_max_rows} rows to avoid a timeout."
+                )
+        return sparql, (
+            f"The query is estimated to compute about {cost.cost:.0f} intermediate results and may "
+            f"time out or return incomplete results."
+        )
+
+    def find_cached_query(self, question: str, entities: str) -> Optional[VerifiedQuery]:
+        """
+        Looks up the verified query of the same question in the library: same normalized question and
+        entities, or a question at least `question_cache_min_similarity` similar with the same entities.
+
+        Args:
+          question (str): the question of the user.
+          entities (str): the resolved entities of the question.
+
+        Returns:
+          Optional[VerifiedQuery]: the verified pair, None if the question cache is disabled or misses.
+        """
+        if not self.question_cache or self.query_library is None:
+            return None
+        match = self.query_library.lookup(
+            self.graph.query_endpoint, question, entities, self.question_cache_min_similarity
+        )
+        if match is None:
+            return None
+        cached, similarity = match
+        logger.info(
+            "Question cache hit: %r (similarity %.2f, verified %s times)",
+            cached.question,
+            similarity,
+            cached.verifications,
+        )
+        return cached
+
+    def match_template(self, question: str, entities: str) -> Optional[TemplateMatch]:
+        """
+        Matches the question to a query template filled with its entities, see `TemplateEngine.match`.
+
+        Args:
+          question (str): the question of the user.
+          entities (str): the resolved entities of the question.
+
+        Returns:
+          Optional[TemplateMatch]: the filled template, None if templates are disabled or none matches.
+        """
+        if self.template_engine is None:
+            return None
+        match = self.template_engine.match(question, entities)
+        if match is not None:
+            logger.info("SPARQL query filled from template %s: %s", match.template.id, match.query)
+        return match
+
+    def find_verified_examples(self, question: str, entities: str) -> List[VerifiedQuery]:
+        """
+        Retrieves the verified queries of the questions most similar to the question from the library.
+
+        Args:
+          question (str): the question of the user.
+          entities (str): the resolved entities of the question.
+
+        Returns:
+          List[VerifiedQuery]: at most `max_examples` pairs, most similar first.
+        """
+        if self.query_library is None:
+            return []
+        similar = self.query_library.similar(
+            self.graph.query_endpoint,
+            question,
+            entities,
+            k=self.max_examples,
+            min_similarity=self.min_example_similarity,
+        )
+        if similar:
+            logger.info(
+                "Verified examples: %s",
+                ", ".join(f"{pair.question!r} ({score:.2f})" for pair, score in similar),
+            )
+        return [pair for pair, _ in similar]
+
+    @staticmethod
+    def format_examples(examples: List[VerifiedQuery]) -> str:
+        """
+        Formats verified question and query pairs for the generation and improvement prompts.
+
+        Args:
+          examples (List[VerifiedQuery]): the pairs returned by `find_verified_examples`.
+
+        Returns:
+          str: the question, entities and query of each pair.
+        """
+        if not examples:
+            return "No verified query is available for a similar question."
+        blocks = []
+        for example in examples:
+            block = f"Question: {example.question}\n"
+            if example.entities:
+                block += f"Entities: {example.entities}\n"
+            block += f"SPARQL query:\n{example.query}"
+            blocks.append(block)
+        return "\n\n".join(blocks)
+
+    @staticmethod
+    def format_diagnostics(diagnostics: List[SchemaDiagnostic]) -> str:
+        """
+        Formats the schema validation errors of a query for the improvement prompt.
+
+        Args:
+          diagnostics (List[SchemaDiagnostic]): the errors returned by `RdfGraph.validate_query`.
+
+        Returns:
+          str: one line per error, with the schema terms that may be meant.
+        """
+        if not diagnostics:
+            return "No schema error was found, but the query returned no results."
+        lines = []
+        for diagnostic in diagnostics:
+            line = f"- {diagnostic.message}"
+            if diagnostic.suggestions:
+                line += f" Candidates: {', '.join(diagnostic.suggestions)}."
+            lines.append(line)
+        return "\n".join(lines)
+
+    @staticmethod
+    def limit_query(sparql: str, max_rows: int) -> str:
+        """
+        Adds a LIMIT of `max_rows` rows to a SELECT query, or lowers its own LIMIT.
+
+        Returns:
+          str: the limited query, unchanged if it cannot be paginated or already returns fewer rows.
+        """
+        split = RdfGraph.split_slice(sparql)
+        if split is None:
+            return sparql
+        base_query, offset, limit = split
+        if limit is not None and limit <= max_rows:
+            return sparql
+        offset_clause = f"\nOFFSET {offset}" if offset else ""
+        return f"{base_query}\nLIMIT {max_rows}{offset_clause}"
+
+    @staticmethod
+    def has_schema_errors(diagnostics: List[SchemaDiagnostic]) -> bool:
+        """Whether the diagnostics of a query prevent sending it, see `SchemaDiagnostic.is_warning`."""
+        return any(not diagnostic.is_warning for diagnostic in diagnostics)
+
+    def _validate(self, sparql: str) -> Tuple[str, List[SchemaDiagnostic]]:
+        """
+        Checks a query against the schema, repairing the queries that cannot be sent without the LLM
+        when possible. The queries with warnings only are returned unchanged with their warnings.
+        """
+        diagnostics = self.graph.validate_query(sparql)
+        if self.has_schema_errors(diagnostics):
+            repaired = self.graph.repair_query(sparql)
+            if repaired is not None:
+                logger.info("SPARQL query repaired with the schema: %s", repaired)
+                return repaired, []
+        return sparql, diagnostics
+
+    def _send(
+        self,
+        sparql: str,
+        diagnostics: List[SchemaDiagnostic],
+        cancellation: QueryCancellation,
+    ) -> Tuple[Iterator[List[Dict[str, str]]], List[Dict[str, str]], float]:
+        """
+        Sends a query and returns its pages, its first page and the time taken to get it. When the
+        endpoint rejects a query that has schema warnings, the result is empty instead, so that the
+        query is corrected with its warnings like a query without results.
+        """
+        start = time.perf_counter()
+        pages = self.graph.iter_query_pages(self._optimize(sparql), cancellation=cancellation)
+        try:
+            result = next(pages, [])
+        except (SparqlSyntaxError, SparqlServerError, SparqlTimeoutError) as e:
+            if not diagnostics:
+                raise
+            logger.info("SPARQL query with schema warnings failed: %s", e)
+            pages, result = iter(()), []
+        return pages, result, time.perf_counter() - start
+
+    def _optimize(self, sparql: str) -> str:
+        """Returns the query sent to the endpoint, with its triple patterns reordered if enabled."""
+        optimized = self.graph.optimize_query(sparql)
+        if optimized != sparql:
+            logger.info("Triple patterns reordered: %s", optimized)
+        return optimized
+
     @staticmethod
     def remove_markdown_quotes(query_with_markdown: str) -> str:
         """
@@ -381,7 +908,8 @@ class GraphSparqlQAChain(BaseTool):
 
     def search_nodes(self, query):
         """
-        Searches for related nodes in the FAISS database using a query.
+        Searches for related nodes in the FAISS database using a query. The index is loaded once per
+        process, see `load_schema_node_index`, so only the query is embedded.
 
         Args:
             query (str): The search query to find related nodes.
@@ -389,54 +917,28 @@ class GraphSparqlQAChain(BaseTool):
         Returns:
             list: A list of related nodes found in the database.
         """
-        current_dir = os.path.dirname(__file__)
-
-        # Construct the path to the faiss_db directory
-        db_path = os.path.abspath(os.path.join(current_dir, '..', '..', '..', 'data', 'faiss_db'))
-
-        embedding_kwargs = {"api_key": self.openai_key} if self.openai_key else {}
-        embeddings = OpenAIEmbeddings(**embedding_kwargs)
-        db = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+        db = load_schema_node_index(SCHEMA_NODE_INDEX_PATH, self.openai_key)
         related_nodes = db.similarity_search(query, 12)
         return related_nodes
 
     def find_similar_query(self, input_query):
         """
-            Finds the most similar query from the database to the input query.
+            Finds the most similar query from the database to the input query, with the persistent
+            TF-IDF index of the templates (see `TemplateIndex`).
 
             Args:
                 input_query (str): The query to find similar queries for.
 
             Returns:
-                dict: The most similar query from the database and its similarity score.
+                dict: The most similar query from the database, None if it is empty.
             """
-        # Get the directory of the current script
-        current_dir = os.path.dirname(__file__)
-
-        # Construct the path to the queries.json file
-        json_file = os.path.abspath(os.path.join(current_dir, '..', '..', '..', 'data', 'queries.json'))
-
-        # Extract the query texts
-        database_queries = self.load_queries(json_file)
-        query_texts = [entry['query'] for entry in database_queries]
-
-        # Combine the input query with the database query texts
-        all_queries = [input_query] + query_texts
-
-        # Vectorize the queries using TF-IDF
-        vectorizer = TfidfVectorizer()
-        tfidf_matrix = vectorizer.fit_transform(all_queries)
-
-        # Compute cosine similarity between the input query and all other queries
-        cosine_similarities = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:]).flatten()
-
-        # Find the index of the most similar query
-        most_similar_index = np.argmax(cosine_similarities)
-
-        # Retrieve the most similar query from the database
-        most_similar_query = database_queries[most_similar_index]
-        similarity_score = cosine_similarities[most_similar_index]
-
+        results = get_template_index(QUERIES_PATH).search(input_query, 1)
+        if not results:
+            return None
+        most_similar_query, similarity_score = results[0]
+        logger.info(
+            "Most similar template: %s (similarity %.3f)", most_similar_query.get("id"), similarity_score
+        )
         return most_similar_query
 
     def load_queries(self, json_file):
@@ -472,45 +974,60 @@ class GraphSparqlQAChain(BaseTool):
             data = json_data
 
         if data and isinstance(data, list):
-            # Getting the temporary directory path
-
-            session_dir = create_user_session(self.session_id, user_session_dir=True)
-
-            # Create a NamedTemporaryFile within the session directory and keep it after closing
-            with tempfile.NamedTemporaryFile(suffix=".csv", dir=session_dir, delete=False) as temp_file:
+            temp_file_path, _ = self.pages_to_csv(data, iter(()))
+        else:
+            # Handle the case where data is empty or not a list
+            logger.info("JSON data is empty or not in the expected format.")
+            temp_file_path = None
 
-                temp_csv_path = Path(temp_file.name)  # Convert the temp file path to a Path object
+        return temp_file_path
 
-                # Open the temp file path again for writing CSV data
-                with temp_csv_path.open(mode="w", newline="") as file:
-                    # Extract headers from the first item, assuming all items are dictionaries
-                    headers = data[0].keys()
-                    # Create a CSV writer object
-                    csv_writer = csv.DictWriter(file, fieldnames=headers)
-                    # Write the header
-                    csv_writer.writeheader()
-                    # Write the rows
-                    csv_writer.writerows(data)
+    def pages_to_csv(
+        self, first_page: List[Dict[str, str]], next_pages: Iterator[List[Dict[str, str]]]
+    ) -> Tuple[Optional[Path], int]:
+        """
+        Writes the pages of a query result to a temporary CSV file of the session, each page being
+        written as soon as it is received, so that the complete result is never held in memory.
 
-            temp_file_path = temp_csv_path
+        Args:
+          first_page (List[Dict[str, str]]): the first rows of the result, whose keys are the CSV headers.
+          next_pages (Iterator[List[Dict[str, str]]]): the following pages, consumed by this method.
 
-            output_data = {
-                "output": {
-                    "paths": [str(temp_file_path)],
-                }
+        Returns:
+          Tuple[Optional[Path], int]: the path to the CSV file, None if the result is empty, and the number of rows written.
+        """
+        if not first_page:
+            logger.info("The query result is empty, no CSV file is written.")
+            return None, 0
+
+        session_dir = create_user_session(self.session_id, user_session_dir=True)
+
+        # Create a NamedTemporaryFile within the session directory and keep it after closing
+        with tempfile.NamedTemporaryFile(suffix=".csv", dir=session_dir, delete=False) as temp_file:
+            temp_csv_path = Path(temp_file.name)  # Convert the temp file path to a Path object
+
+        row_count = 0
+        # Open the temp file path again for writing CSV data
+        with temp_csv_path.open(mode="w", newline="") as file:
+            # Extract headers from the first item, assuming all items are dictionaries
+            csv_writer = csv.DictWriter(file, fieldnames=first_page[0].keys())
+            csv_writer.writeheader()
+            for page in itertools.chain([first_page], next_pages):
+                csv_writer.writerows(page)
+                row_count += len(page)
+
+        output_data = {
+            "output": {
+                "paths": [str(temp_csv_path)],
             }
+        }
 
-            logger.info(f"Output data: {output_data}")
-
-            db_manager = tools_database()
-            try:
-                db_manager.put(data=json.dumps(output_data), tool_name="tool_sparql")
-            except Exception as e:
-                logger.error(f"Error saving to database: {e}")
+        logger.info(f"Output data: {output_data}")
 
-        else:
-            # Handle the case where data is empty or not a list
-            logger.info("JSON data is empty or not in the expected format.")
-            temp_file_path = None
+        db_manager = tools_database()
+        try:
+            db_manager.put(data=json.dumps(output_data), tool_name="tool_sparql")
+        except Exception as e:
+            logger.error(f"Error saving to database: {e}")
 
-        return temp_file_path
+        return temp_csv_path, row_count
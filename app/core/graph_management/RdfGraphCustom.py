@@ -1,18 +1,51 @@
 from __future__ import annotations
 
 import configparser
-import csv
+import hashlib
 import logging.config
 import re
-from io import StringIO
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import rdflib
+from pyparsing import ParseException
 from rdflib import BNode, URIRef
-from rdflib.plugins.stores import sparqlstore
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.query import Result
+from rdflib.term import Identifier
 from tqdm import tqdm
 
+from app.core.graph_management.admission import (
+    AdmissionController,
+    get_admission_controller,
+)
+from app.core.graph_management.query_optimizer import (
+    QueryCost,
+    estimate_query_cost,
+    reorder_triple_patterns,
+)
+from app.core.graph_management.query_repair import QueryRepairer
+from app.core.graph_management.result_cache import ResultCache
+from app.core.graph_management.schema_cache import ExtractionProgress
+from app.core.graph_management.schema_statistics import SchemaStatistics
+from app.core.graph_management.schema_validator import (
+    SchemaDiagnostic,
+    SchemaIndex,
+    validate_query,
+)
+from app.core.graph_management.single_flight import SingleFlight
+from app.core.graph_management.sparql_store import (
+    NegotiatingSPARQLStore,
+    QueryCancellation,
+    SparqlQueryCancelled,
+    SparqlQueryError,
+    SparqlSyntaxError,
+    SparqlTimeoutError,
+)
 from app.core.utils import token_counter
 from app.core.session import setup_logger
 
@@ -22,6 +55,20 @@ parent_dir = Path(__file__).parent.parent.parent
 sparql_config_path = parent_dir / "config" / "sparql.ini"
 
 
+class _AbandonedQuery:
+    """Result of a coalesced query abandoned by the thread that sent it (timeout or cancellation)."""
+
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+# Identical queries sent concurrently by the graphs of the process
+_in_flight_queries = SingleFlight()
+
+# The rdflib SPARQL parser is not thread-safe
+sparql_parser_lock = threading.Lock()
+
+
 class RdfGraph:
     """
     RdfGraph class handles the RDF graph representing the schema of the endpoint,
@@ -36,6 +83,8 @@ class RdfGraph:
         standard: Optional[str] = "rdf",
         schema_file: Optional[str] = None,
         auth: Optional[Tuple[str, str]] = None,  # Add auth parameter
+        schema_data: Optional[Dict] = None,
+        progress_path: Optional[Path] = None,
     ) -> None:
         """
         Set up the RDFlib graph
@@ -43,6 +92,11 @@ class RdfGraph:
             query_endpoint (Optional[str]): SPARQL endpoint for queries, read access.
             standard (Optional[str]): RDF, RDFS, or OWL.
             schema_file (Optional[str]): File containing the RDF graph schema, in turtle format.
+            auth (Optional[Tuple[str, str]]): Optional (username, password) for the endpoint.
+            schema_data (Optional[Dict]): Schema previously returned by `to_schema_data`, restored
+                instead of extracting the schema from the endpoint.
+            progress_path (Optional[Path]): Checkpoint file where the properties of each class are saved as
+                they are extracted, so that an interrupted extraction resumes where it stopped.
         Raises:
             ValueError: If the standard is not one of rdf, rdfs, or owl
             ValueError: If no query endpoint is provided
@@ -51,11 +105,105 @@ class RdfGraph:
         self.standard = standard
         self.schema_file = schema_file
         self.namespaces = None
+        self.classes: List[Dict] = []
+        self.schema_graph: Optional[rdflib.graph.Graph] = None
+        # Per-class fingerprints (instance and property counts) of the extracted schema
+        self.class_fingerprints: Dict[str, str] = {}
+        # Held while the schema attributes are swapped, so that readers never see a half-updated schema
+        self._schema_lock = threading.RLock()
+        # Held during `refresh_schema`, so that concurrent refreshes do not query the endpoint twice
+        self._refresh_lock = threading.Lock()
         self.config = self.load_config(sparql_config_path)
         logger.info("sparql_config_path %s", sparql_config_path)
         self.CLS_RDF = self.config.get("sparqlQueries", "CLS_RDF")
         self.CLS_REL_RDF = self.config.get("sparqlQueries", "CLS_REL_RDF")
+        self.CLS_REL_AGG_RDF = self.config.get(
+            "sparqlQueries", "CLS_REL_AGG_RDF", fallback=None
+        )
+        self.CLS_REL_AGG_SAMPLE_RDF = self.config.get(
+            "sparqlQueries", "CLS_REL_AGG_SAMPLE_RDF", fallback=None
+        )
+        self.CLS_FINGERPRINT_RDF = self.config.get(
+            "sparqlQueries", "CLS_FINGERPRINT_RDF", fallback=None
+        )
+        self.CLS_STATS_RDF = self.config.get(
+            "sparqlQueries", "CLS_STATS_RDF", fallback=None
+        )
         self.EXCLUDED_URIS = self.config.get("excludedURIs", "uris").split(",")
+        self.extraction_strategy = self.config.get(
+            "schemaExtraction", "strategy", fallback="per_class"
+        )
+        self.aggregated_chunk_size = self.config.getint(
+            "schemaExtraction", "aggregated_chunk_size", fallback=25
+        )
+        self.max_workers = self.config.getint(
+            "schemaExtraction", "max_workers", fallback=8
+        )
+        self.max_retries = self.config.getint(
+            "schemaExtraction", "max_retries", fallback=2
+        )
+        self.retry_backoff_seconds = self.config.getfloat(
+            "schemaExtraction", "retry_backoff_seconds", fallback=1.0
+        )
+        # Rows requested per LIMIT/OFFSET page by `iter_query_pages`, 0 to disable pagination
+        self.page_size = self.config.getint(
+            "resultStreaming", "page_size", fallback=10000
+        )
+        # Deadline and retries of the queries sent by `query`, `iter_query` and `iter_query_pages`
+        self.query_timeout_seconds = self.config.getfloat(
+            "queryExecution", "timeout_seconds", fallback=120.0
+        )
+        self.query_max_retries = self.config.getint(
+            "queryExecution", "max_retries", fallback=2
+        )
+        self.query_retry_backoff_seconds = self.config.getfloat(
+            "queryExecution", "retry_backoff_seconds", fallback=0.5
+        )
+        # Limits the queries running at the same time on the endpoint, None when disabled
+        self.admission_controller: Optional[AdmissionController] = None
+        max_concurrent_queries = self.config.getint(
+            "admissionControl", "max_concurrent_queries", fallback=0
+        )
+        if query_endpoint and max_concurrent_queries > 0:
+            self.admission_controller = get_admission_controller(
+                query_endpoint,
+                max_concurrent_queries,
+                self.config.getint("admissionControl", "max_queued_queries", fallback=64),
+            )
+        # On-disk cache of the rows returned by `query`, None when disabled
+        self.result_cache: Optional[ResultCache] = None
+        if self.config.getboolean("resultCache", "enabled", fallback=False):
+            self.result_cache = ResultCache(
+                max_size_bytes=int(
+                    self.config.getfloat("resultCache", "max_size_mb", fallback=256) * 2**20
+                ),
+                ttl_seconds=self.config.getfloat(
+                    "resultCache", "ttl_seconds", fallback=86400
+                ),
+            )
+        # Cardinality statistics of the classes, collected with the schema when enabled
+        self.collect_statistics = bool(self.CLS_STATS_RDF) and self.config.getboolean(
+            "schemaStatistics", "enabled", fallback=False
+        )
+        self.statistics: Optional[SchemaStatistics] = None
+        # Check the generated queries against the schema before sending them, see `validate_query`
+        self.validate_queries = self.config.getboolean(
+            "queryValidation", "enabled", fallback=False
+        )
+        self._schema_index: Optional[Tuple[rdflib.Graph, SchemaIndex]] = None
+        # Repair the invalid generated queries with the schema graph, see `repair_query`
+        self.repair_queries = self.config.getboolean("queryValidation", "repair", fallback=False)
+        # Reorder the triple patterns of the generated queries with the statistics, see `optimize_query`
+        self.reorder_triple_patterns = self.config.getboolean(
+            "queryOptimization", "reorder_triple_patterns", fallback=False
+        )
+        # Time (in seconds) spent extracting each class during the last schema build
+        self.class_timings: Dict[str, float] = {}
+        # Classes whose properties could not be retrieved during the last schema build
+        self.failed_classes: List[str] = []
+        self.extraction_progress = (
+            ExtractionProgress(progress_path) if progress_path else None
+        )
 
         try:
             if self.standard not in (supported_standards := ("rdf", "rdfs", "owl")):
@@ -64,14 +212,40 @@ class RdfGraph:
                 )
             if not query_endpoint:
                 raise ValueError("No query endpoint provided.")
+            if self.extraction_strategy not in (
+                supported_strategies := ("per_class", "aggregated")
+            ):
+                raise ValueError(
+                    f"Invalid schema extraction strategy. Supported strategies are: {supported_strategies}."
+                )
         except ValueError as e:
             logger.error(f"Error: {e}")
             raise
     
-        self._store = sparqlstore.SPARQLStore(auth=auth)
+        result_formats = [
+            f.strip()
+            for f in self.config.get(
+                "endpoint", "result_formats", fallback="csv, json, xml"
+            ).split(",")
+            if f.strip()
+        ]
+        self._store = NegotiatingSPARQLStore(
+            result_formats=result_formats,
+            auth=auth,
+            pool_size=self.config.getint("connectionPool", "pool_size", fallback=10),
+            pool_block=self.config.getboolean(
+                "connectionPool", "pool_block", fallback=True
+            ),
+            connect_timeout_seconds=self.config.getfloat(
+                "queryExecution", "connect_timeout_seconds", fallback=10.0
+            ),
+        )
         self._store.open(query_endpoint)
         self.graph = rdflib.Graph(self._store, bind_namespaces="none")
-        self.load_schema()
+        if schema_data is not None:
+            self.restore_schema(schema_data)
+        else:
+            self.load_schema()
 
     @staticmethod
     def load_config(config_path):
@@ -83,6 +257,12 @@ class RdfGraph:
     def get_schema(self) -> str:
         return self.schema
 
+    @property
+    def schema_version(self) -> str:
+        """Hash of the schema text, part of the result cache keys so that a new schema invalidates them."""
+        schema = getattr(self, "schema", None) or ""
+        return hashlib.sha256(schema.encode("utf-8")).hexdigest()[:16]
+
     def get_prop_and_val_types(self, class_uri: str) -> List[Tuple[str, str]]:
         """
         Retrieves and filters properties and their value types for a specified class URI. It excludes properties with alphanumeric sequences, post-underscore and certain URIs.
@@ -93,22 +273,219 @@ class RdfGraph:
             List[Tuple[str, str]]: A list of tuples, each containing the property URI and the value type.
         """
         query = self.CLS_REL_RDF.format(class_uri=class_uri)
-        results = self.query(query)
+        results = self.query(query, use_cache=False)
 
         filtered_results = [
             (str(r.get("property")), str(r.get("valueType")))
             for r in results
-            # TODO [Franck]: why filter out "_"?
-            if not re.search(r"_([0-9a-fA-F]+)$", str(r.get("property")))
-            and str(r.get("property")) not in self.EXCLUDED_URIS
+            if self._is_schema_property(str(r.get("property")))
         ]
 
         return filtered_results
 
+    def _is_schema_property(self, property_uri: str) -> bool:
+        # TODO [Franck]: why filter out "_"?
+        return (
+            not re.search(r"_([0-9a-fA-F]+)$", property_uri)
+            and property_uri not in self.EXCLUDED_URIS
+        )
+
+    def _fetch_class_properties(self, class_uri: str) -> List[Tuple[str, str]]:
+        """
+        Runs `get_prop_and_val_types` for a class, retrying with an exponential backoff when the
+        endpoint query fails with a transient error (see `SparqlQueryError.transient`). Syntax
+        errors, timeouts and the other server errors are raised at once. The time spent on the
+        successful attempt is recorded in `class_timings`.
+
+        Args:
+            class_uri (str): The URI of the class for which to retrieve property and value types.
+        Returns:
+            List[Tuple[str, str]]: A list of tuples, each containing the property URI and the value type.
+        Raises:
+            ValueError: If the query fails with an error that is not transient, or still fails
+                after `max_retries` retries.
+        """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                properties_and_values = self.get_prop_and_val_types(class_uri)
+            except ValueError as e:
+                attempt += 1
+                # `_execute` already retried the transient errors within the deadline of the query
+                if not getattr(e, "transient", False) or attempt > self.max_retries:
+                    raise
+                delay = self.retry_backoff_seconds * 2 ** (attempt - 1)
+                logger.warning(
+                    "Query for class %s failed (attempt %s/%s), retrying in %.1fs: %s",
+                    class_uri,
+                    attempt,
+                    self.max_retries + 1,
+                    delay,
+                    e,
+                )
+                time.sleep(delay)
+                continue
+            self.class_timings[class_uri] = time.perf_counter() - start
+            return properties_and_values
+
+    def extract_class_properties(
+        self, class_uris: List[str]
+    ) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Retrieves the properties and value types of several classes, sending at most `max_workers`
+        queries to the endpoint at the same time (see the `schemaExtraction` section of sparql.ini).
+
+        Args:
+            class_uris (List[str]): The URIs of the classes to analyze.
+        Returns:
+            Dict[str, List[Tuple[str, str]]]: The properties and value types of each class, keyed by class URI.
+        Raises:
+            ValueError: If the properties of at least one class could not be retrieved.
+        """
+        results: Dict[str, List[Tuple[str, str]]] = {}
+        failures: Dict[str, Exception] = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = {
+                executor.submit(self._fetch_class_properties, class_uri): class_uri
+                for class_uri in class_uris
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Adding classes to graph",
+            ):
+                class_uri = futures[future]
+                try:
+                    results[class_uri] = future.result()
+                except ValueError as e:
+                    failures[class_uri] = e
+                    if self.extraction_progress:
+                        self.extraction_progress.record_failure(class_uri, e)
+                    continue
+                if self.extraction_progress:
+                    self.extraction_progress.record(class_uri, results[class_uri])
+
+        if self.class_timings:
+            slowest = sorted(
+                self.class_timings.items(), key=lambda item: item[1], reverse=True
+            )[:5]
+            logger.info(
+                "Extracted %s classes in %.2fs of query time, slowest: %s",
+                len(results),
+                sum(self.class_timings.values()),
+                ", ".join(f"{uri} ({timing:.2f}s)" for uri, timing in slowest),
+            )
+
+        if failures:
+            self.failed_classes = list(failures)
+            logger.error("Schema extraction failed for classes: %s", list(failures))
+            raise ValueError(
+                f"Could not retrieve the properties of {len(failures)} classes: "
+                + "; ".join(f"{uri}: {e}" for uri, e in failures.items())
+            )
+
+        return results
+
+    def extract_class_properties_aggregated(
+        self, class_uris: List[str]
+    ) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Retrieves the properties and value types of several classes with one CLS_REL_AGG_RDF query
+        per chunk of `aggregated_chunk_size` classes, instead of one query per class.
+        The classes of a chunk whose query fails are extracted again with `extract_class_properties`.
+
+        Each class is sampled like in CLS_REL_RDF (CLS_REL_AGG_SAMPLE_RDF subqueries combined with
+        UNION), but the results may still differ from the per-class strategy: the sampled instances
+        and the 300 properties kept for a class depend on the order in which the endpoint returns them.
+
+        Args:
+            class_uris (List[str]): The URIs of the classes to analyze.
+        Returns:
+            Dict[str, List[Tuple[str, str]]]: The properties and value types of each class, keyed by class URI.
+        """
+        if not self.CLS_REL_AGG_RDF or not self.CLS_REL_AGG_SAMPLE_RDF:
+            logger.warning(
+                "CLS_REL_AGG_RDF or CLS_REL_AGG_SAMPLE_RDF is not configured, using per-class extraction"
+            )
+            return self.extract_class_properties(class_uris)
+
+        chunk_size = max(1, self.aggregated_chunk_size)
+        chunks = [
+            class_uris[start : start + chunk_size]
+            for start in range(0, len(class_uris), chunk_size)
+        ]
+
+        def _run_chunk(chunk: List[str]) -> List[Dict]:
+            start = time.perf_counter()
+            class_samples = " UNION ".join(
+                self.CLS_REL_AGG_SAMPLE_RDF.format(class_uri=class_uri) for class_uri in chunk
+            )
+            rows = self.query(
+                self.CLS_REL_AGG_RDF.format(class_samples=class_samples), use_cache=False
+            )
+            logger.info(
+                "Aggregated query for %s classes returned %s rows in %.2fs",
+                len(chunk),
+                len(rows),
+                time.perf_counter() - start,
+            )
+            return rows
+
+        results: Dict[str, List[Tuple[str, str]]] = {}
+        fallback_uris: List[str] = []
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = {executor.submit(_run_chunk, chunk): chunk for chunk in chunks}
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Adding class chunks to graph",
+            ):
+                chunk = futures[future]
+                try:
+                    rows = future.result()
+                except ValueError as e:
+                    logger.warning(
+                        "Aggregated query failed for %s classes, falling back to per-class queries: %s",
+                        len(chunk),
+                        e,
+                    )
+                    fallback_uris.extend(chunk)
+                    continue
+
+                chunk_results: Dict[str, List[Tuple[str, str]]] = {
+                    class_uri: [] for class_uri in chunk
+                }
+                for r in rows:
+                    class_uri = str(r.get("cls"))
+                    property_uri = str(r.get("property"))
+                    # Mirror the LIMIT 300 of the per-class query
+                    if (
+                        class_uri in chunk_results
+                        and len(chunk_results[class_uri]) < 300
+                        and self._is_schema_property(property_uri)
+                    ):
+                        chunk_results[class_uri].append(
+                            (property_uri, str(r.get("valueType")))
+                        )
+                results.update(chunk_results)
+                if self.extraction_progress:
+                    for class_uri, properties in chunk_results.items():
+                        self.extraction_progress.record(class_uri, properties)
+
+        if fallback_uris:
+            results.update(self.extract_class_properties(fallback_uris))
+
+        return results
+
     def get_graph_from_classes(self, classes: List[Dict]) -> rdflib.graph.Graph:
         """
         Generates an RDF graph from a list of class URIs, that represents the types of triples that were found in the endpoint.
         Each triple has a class as a subject, property as predicate, and one possible value type of that property as object.
+        The classes are queried concurrently, one query per class or per chunk of classes depending on the
+        `strategy` of the `schemaExtraction` section, but the triples are added in the order of `classes`.
 
         :example:
             `ns1:InChIkey ns1:has_npc_pathway ns1:ChemicalTaxonomy .`
@@ -120,47 +497,443 @@ class RdfGraph:
             rdflib.graph.Graph: An RDF graph object.
         """
         graph = rdflib.Graph()
+        class_uris = list(dict.fromkeys(cl.get("cls") for cl in classes))
+        self.class_timings = {}
+        self._add_class_triples(graph, class_uris, self._extract_properties(class_uris))
+        return graph
+
+    def _extract_properties(
+        self, class_uris: List[str]
+    ) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Retrieves the properties and value types of the classes with the configured strategy. The
+        classes already saved in the progress checkpoint are not queried again, the checkpoint is
+        removed once every class is extracted.
+        """
+        results: Dict[str, List[Tuple[str, str]]] = {}
+        self.failed_classes = []
+        if self.extraction_progress:
+            completed = self.extraction_progress.load()
+            results = {uri: completed[uri] for uri in class_uris if uri in completed}
+            if results:
+                logger.info(
+                    "Resuming schema extraction, %s of %s classes already extracted",
+                    len(results),
+                    len(class_uris),
+                )
+
+        pending = [class_uri for class_uri in class_uris if class_uri not in results]
+        if pending:
+            if self.extraction_strategy == "aggregated":
+                results.update(self.extract_class_properties_aggregated(pending))
+            else:
+                results.update(self.extract_class_properties(pending))
+
+        if self.extraction_progress:
+            self.extraction_progress.clear()
+        return results
+
+    def retry_failed_classes(self) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Queries again only the classes recorded as failed in the progress checkpoint, and saves the
+        result to the checkpoint, so that the next extraction resumes with them.
+
+        Returns:
+            Dict[str, List[Tuple[str, str]]]: The properties and value types of the retried classes.
+        Raises:
+            ValueError: If no progress checkpoint is configured, or a class still fails.
+        """
+        if not self.extraction_progress:
+            raise ValueError("No extraction progress file configured.")
+        failed = self.extraction_progress.failed_classes()
+        logger.info("Retrying %s failed classes", len(failed))
+        return self.extract_class_properties(failed)
 
-        for cl in tqdm(classes, desc="Adding classes to graph"):
-            class_ref = URIRef(cl.get("cls"))
-            properties_and_values = self.get_prop_and_val_types(cl.get("cls"))
-            for property_uri, sample_value in properties_and_values:
+    @staticmethod
+    def _add_class_triples(
+        graph: rdflib.graph.Graph,
+        class_uris: List[str],
+        properties_by_class: Dict[str, List[Tuple[str, str]]],
+    ) -> None:
+        for class_uri in class_uris:
+            class_ref = URIRef(class_uri)
+            for property_uri, sample_value in properties_by_class[class_uri]:
                 value_ref = (
                     BNode() if sample_value == "Untyped" else URIRef(sample_value)
                 )
                 graph.add((class_ref, URIRef(property_uri), value_ref))
-        return graph
+
+    def _run_query(
+        self,
+        query: str,
+        deadline: Optional[float],
+        cancellation: Optional[QueryCancellation],
+    ) -> Result:
+        from rdflib.exceptions import ParserError
+
+        with self._store.query_options(deadline, cancellation):
+            try:
+                res = self.graph.query(query_object=query, initNs={}, initBindings={})
+
+            except SparqlQueryError:
+                raise
+
+            except (ParserError, ParseException) as e:
+                raise SparqlSyntaxError("Generated SPARQL statement is invalid\n" f"{e}")
+
+            except Exception as e:
+                raise SparqlQueryError(f"An error occurred while querying the graph: {e}")
+
+        if res.type != "SELECT":
+            raise SparqlQueryError(
+                f"Only SELECT queries are supported, got a {res.type} query."
+            )
+        return res
+
+    def _execute(
+        self,
+        query: str,
+        timeout: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Result:
+        """
+        Sends a SELECT query to the endpoint, retrying it with an exponential backoff after a
+        transient error (connection failure, overloaded endpoint), as long as its deadline allows it.
+
+        Args:
+          query (str): a string that represents a SPARQL query to be executed on the graph data.
+          timeout (Optional[float]): Seconds after which the query (retries included) is abandoned,
+            defaults to the `[queryExecution] timeout_seconds` setting. 0 disables the deadline.
+          cancellation (Optional[QueryCancellation]): Token to cancel the query from another thread.
+
+        Returns:
+            Result: the rdflib result of the query.
+
+        Raises:
+            SparqlSyntaxError: If the query is invalid.
+            SparqlTimeoutError: If the query does not complete before its deadline.
+            SparqlServerError: If the endpoint fails to answer.
+            SparqlQueryCancelled: If the query is cancelled.
+            SparqlQueryError: For any other failure, all these errors are ValueErrors.
+        """
+        timeout = self.query_timeout_seconds if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout and timeout > 0 else None
+
+        controller = self.admission_controller
+        attempt = 0
+        while True:
+            try:
+                # The slot is held by this thread, and freed as soon as it gives up on the query
+                admission = (
+                    controller.admit(deadline, cancellation)
+                    if controller is not None
+                    else nullcontext()
+                )
+                with admission:
+                    if cancellation is None:
+                        return self._run_query(query, deadline, None)
+                    return cancellation.run(
+                        lambda: self._run_query(query, deadline, cancellation),
+                        deadline,
+                        controller.executor if controller is not None else None,
+                    )
+            except SparqlQueryError as e:
+                delay = self.query_retry_backoff_seconds * 2**attempt
+                if (
+                    not e.transient
+                    or attempt >= self.query_max_retries
+                    or (deadline is not None and time.monotonic() + delay >= deadline)
+                ):
+                    raise
+                attempt += 1
+                logger.warning(
+                    "Query failed (%s), retrying in %.1fs (attempt %s/%s)",
+                    e,
+                    delay,
+                    attempt,
+                    self.query_max_retries,
+                )
+                if cancellation is None:
+                    time.sleep(delay)
+                elif cancellation.wait(delay):
+                    cancellation.raise_if_cancelled()
+
+    @staticmethod
+    def _term_to_str(term: Optional[Identifier]) -> str:
+        # Same text as the SPARQL CSV results format: unbound values are empty strings
+        if term is None:
+            return ""
+        if isinstance(term, BNode):
+            # The CSV results parser keeps the "_:" prefix in the blank node ids
+            return str(term) if term.startswith("_:") else f"_:{term}"
+        return str(term)
+
+    @classmethod
+    def result_to_rows(cls, res: Result) -> Iterator[Dict[str, str]]:
+        """
+        Converts the bindings of a SELECT result to dictionaries, one per row, keyed by variable name.
+        Values are converted to strings as in the SPARQL CSV results format.
+
+        Args:
+            res (Result): a SELECT result.
+
+        Returns:
+            Iterator[Dict[str, str]]: an iterator over the rows of the result.
+        """
+        variables = [(str(var), var) for var in res.vars or []]
+        term_to_str = cls._term_to_str
+        for binding in res.bindings:
+            yield {name: term_to_str(binding.get(var)) for name, var in variables}
+
+    def iter_query(
+        self,
+        query: str,
+        timeout: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Iterator[Dict[str, str]]:
+        """
+        queries a graph using a SPARQL statement and returns an iterator over the rows of the
+        result, converted lazily to dictionaries. The query is sent before this method returns.
+
+        Args:
+          query (str): a string that represents a SPARQL query to be executed on the graph data.
+          timeout (Optional[float]): Seconds after which the query is abandoned, see `_execute`.
+          cancellation (Optional[QueryCancellation]): Token to cancel the query from another thread.
+
+        Returns:
+            Iterator[Dict[str, str]]: an iterator over dictionaries containing the results of the query.
+        """
+        return self.result_to_rows(self._execute(query, timeout, cancellation))
 
     def query(
         self,
         query: str,
-    ) -> List[csv.DictReader]:
+        timeout: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+        use_cache: bool = True,
+    ) -> List[Dict[str, str]]:
         """
         queries a graph using a SPARQL statement and returns the results as a list of
-        dictionaries.
+        dictionaries. The rows are read from and saved to the result cache, if enabled.
 
         Args:
           query (str): a string that represents a SPARQL query to be executed on the graph data.
+          timeout (Optional[float]): Seconds after which the query is abandoned, see `_execute`.
+          cancellation (Optional[QueryCancellation]): Token to cancel the query from another thread.
+          use_cache (bool): Whether to use the result cache. The schema extraction queries do not,
+            since they must see the current state of the endpoint.
 
         Returns:
-            List[csv.DictReader]: a list of dictionaries containing the results of the query.
+            List[Dict[str, str]]: a list of dictionaries containing the results of the query.
         """
-        from rdflib.exceptions import ParserError
-        from rdflib.query import ResultRow
+        cache = self.result_cache if use_cache else None
+        if cache is not None:
+            schema_version = self.schema_version
+            rows = cache.get(self.query_endpoint, schema_version, query)
+            if rows is not None:
+                return rows
+
+        rows = self._query_coalesced(query, timeout, cancellation)
+        if cache is not None:
+            cache.put(self.query_endpoint, schema_version, query, rows)
+        return rows
+
+    def _query_coalesced(
+        self,
+        query: str,
+        timeout: Optional[float],
+        cancellation: Optional[QueryCancellation],
+    ) -> List[Dict[str, str]]:
+        """
+        Sends the query, or waits for the result of the identical query (same endpoint, schema
+        version and normalized text) that another thread is already sending.
+        """
+        key = ResultCache.key(self.query_endpoint, self.schema_version, query)
+        timeout_seconds = self.query_timeout_seconds if timeout is None else timeout
+        deadline = (
+            time.monotonic() + timeout_seconds
+            if timeout_seconds and timeout_seconds > 0
+            else None
+        )
+
+        def send() -> Union[List[Dict[str, str]], _AbandonedQuery]:
+            try:
+                return list(self.iter_query(query, timeout, cancellation))
+            except (SparqlQueryCancelled, SparqlTimeoutError) as e:
+                # The deadline and cancellation of this caller do not apply to the waiting threads
+                return _AbandonedQuery(e)
+
+        while True:
+            rows, shared = _in_flight_queries.do(key, send, deadline, cancellation)
+            if not isinstance(rows, _AbandonedQuery):
+                return list(rows) if shared else rows
+            if not shared:
+                raise rows.error
+            # The thread that sent the query gave up, send it again
+
+    # Trailing LIMIT and OFFSET clauses of a query, in any order
+    _SLICE_CLAUSES = re.compile(r"(?:\s+(?:LIMIT|OFFSET)\s+\d+)+\s*$", re.IGNORECASE)
+
+    @classmethod
+    def split_slice(cls, query: str) -> Optional[Tuple[str, int, Optional[int]]]:
+        """
+        Splits a SELECT query into the query without its LIMIT and OFFSET clauses, its offset and its limit.
 
+        Returns:
+            Optional[Tuple[str, int, Optional[int]]]: None if the query cannot be paginated: it is not a
+            SELECT query, rdflib cannot parse it, or its slice clauses are not at the end of the text.
+        """
         try:
-            res = self.graph.query(query_object=query, initNs={}, initBindings={})
+            with sparql_parser_lock:
+                parsed = parseQuery(query)[1]
+        except Exception:
+            # Let the endpoint report the error of the query
+            return None
+        if parsed.name != "SelectQuery":
+            return None
+        if "limitoffset" not in parsed:
+            return query, 0, None
 
-        except ParserError as e:
-            raise ValueError("Generated SPARQL statement is invalid\n" f"{e}")
+        match = cls._SLICE_CLAUSES.search(query)
+        if match is None:
+            return None
+        slice_clauses = parsed.limitoffset
+        offset = int(slice_clauses.offset) if slice_clauses.offset is not None else 0
+        limit = int(slice_clauses.limit) if slice_clauses.limit is not None else None
+        return query[: match.start()], offset, limit
+
+    def optimize_query(self, query: str) -> str:
+        """
+        Rewrites a generated query with the triple patterns of its basic graph patterns ordered most
+        selective first, estimated with the schema statistics, when `[queryOptimization]
+        reorder_triple_patterns` is enabled. The result of the query is unchanged.
 
-        except Exception as e:
-            raise ValueError(f"An error occurred while querying the graph: {e}")
+        Args:
+            query (str): The SPARQL query.
 
-        # TODO [Franck]: deal with other possible exceptions (timeout, etc)
+        Returns:
+            str: The rewritten query, or the query unchanged when the option is disabled, no statistics
+            were collected or the query has no triple patterns to reorder.
+        """
+        if not self.reorder_triple_patterns or self.statistics is None:
+            return query
+        return reorder_triple_patterns(query, self.statistics)
 
-        csv_str = res.serialize(format="csv").decode("utf-8")
-        return list(csv.DictReader(StringIO(csv_str)))
+    @property
+    def schema_index(self) -> Optional[SchemaIndex]:
+        """(class, property, value type) index of the current schema graph, rebuilt when it changes."""
+        schema_graph = getattr(self, "schema_graph", None)
+        if schema_graph is None:
+            return None
+        cached = self._schema_index
+        if cached is None or cached[0] is not schema_graph:
+            cached = self._schema_index = (schema_graph, SchemaIndex.from_graph(schema_graph))
+        return cached[1]
+
+    def validate_query(self, query: str) -> List[SchemaDiagnostic]:
+        """
+        Checks the triple patterns of a generated query against the extracted schema, without sending
+        it, when `[queryValidation] enabled` is set.
+
+        Args:
+            query (str): The SPARQL query.
+
+        Returns:
+            List[SchemaDiagnostic]: The errors found, empty if the query matches the schema, validation
+            is disabled, the schema was loaded from a file or rdflib cannot parse the query.
+        """
+        index = self.schema_index if self.validate_queries else None
+        if index is None:
+            return []
+        with sparql_parser_lock:
+            return validate_query(query, index)
+
+    def repair_query(self, query: str) -> Optional[str]:
+        """
+        Repairs the property and class mismatches of a generated query with the extracted schema,
+        without an LLM, when `[queryValidation] repair` is set: a property the class of its subject
+        does not have is replaced by a similarly named property of the class, or reached through the
+        shortest chain of properties of the schema graph, and an unknown property is replaced by the
+        closest schema property.
+
+        Args:
+            query (str): The SPARQL query.
+
+        Returns:
+            Optional[str]: The repaired query, None if repair is disabled, the schema was loaded from a
+            file or an error of the query cannot be repaired mechanically.
+        """
+        index = self.schema_index if self.validate_queries and self.repair_queries else None
+        if index is None:
+            return None
+        with sparql_parser_lock:
+            return QueryRepairer(index).repair(query)
+
+    def estimate_query_cost(self, query: str) -> Optional[QueryCost]:
+        """
+        Estimates the rows returned by a query and the intermediate solutions computed by its joins
+        with the schema statistics, without sending it.
+
+        Args:
+            query (str): The SPARQL query.
+
+        Returns:
+            Optional[QueryCost]: The estimates, None without statistics or if rdflib cannot parse the query.
+        """
+        if self.statistics is None:
+            return None
+        with sparql_parser_lock:
+            return estimate_query_cost(query, self.statistics)
+
+    def iter_query_pages(
+        self,
+        query: str,
+        page_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Iterator[List[Dict[str, str]]]:
+        """
+        queries a graph using a SPARQL SELECT statement, one page of `page_size` rows at a time, so
+        that only one page of the result is held in memory. Pages are fetched with LIMIT and OFFSET
+        clauses appended to the query (within its own LIMIT and OFFSET, if any). Without an ORDER BY
+        clause, the endpoint must return the rows in a stable order for the pages not to overlap,
+        which is the case of the common triple stores for a query on unchanged data.
+
+        Queries that cannot be paginated are sent as is and return a single page.
+
+        Args:
+          query (str): a string that represents a SPARQL query to be executed on the graph data.
+          page_size (Optional[int]): Rows per page, defaults to the `[resultStreaming] page_size`
+            setting. 0 disables pagination.
+          timeout (Optional[float]): Seconds after which the query of a page is abandoned, see `_execute`.
+          cancellation (Optional[QueryCancellation]): Token to cancel the queries from another thread.
+
+        Returns:
+            Iterator[List[Dict[str, str]]]: an iterator over the non-empty pages of the result, the
+            first query is sent when the first page is requested.
+        """
+        page_size = self.page_size if page_size is None else page_size
+        split = self.split_slice(query) if page_size > 0 else None
+        if split is None:
+            rows = self.query(query, timeout, cancellation)
+            if rows:
+                yield rows
+            return
+
+        base_query, offset, limit = split
+        fetched = 0
+        while limit is None or fetched < limit:
+            requested = page_size if limit is None else min(page_size, limit - fetched)
+            page = self.query(
+                f"{base_query}\nLIMIT {requested}\nOFFSET {offset + fetched}",
+                timeout,
+                cancellation,
+            )
+            if page:
+                yield page
+            fetched += len(page)
+            if len(page) < requested:
+                break
 
     @staticmethod
     def _get_local_name(iri: str) -> str:
@@ -209,33 +982,281 @@ class RdfGraph:
             raise ValueError("No namespaces found.")
         return self.namespaces
 
+    def to_schema_data(self) -> Dict:
+        """
+        Returns the plain data describing the schema (prompt text, namespaces, classes and
+        class/property/value type triples, and the statistics if collected), so that it can be stored
+        without pickling the `RdfGraph` and its SPARQL store. Untyped values are stored as "Untyped".
+
+        Returns:
+            Dict: A JSON-serializable dictionary accepted by `restore_schema`.
+        """
+        triples = []
+        if self.schema_graph is not None:
+            triples = sorted(
+                [str(s), str(p), "Untyped" if isinstance(o, BNode) else str(o)]
+                for s, p, o in self.schema_graph
+            )
+
+        return {
+            "schema": self.schema,
+            "namespaces": [[prefix, str(uri)] for prefix, uri in self.namespaces or []],
+            "classes": [
+                {key: str(value) for key, value in cl.items() if value is not None}
+                for cl in self.classes
+            ],
+            "triples": triples,
+            "fingerprints": dict(sorted(self.class_fingerprints.items())),
+            **(
+                {"statistics": self.statistics.to_data()}
+                if self.statistics is not None
+                else {}
+            ),
+        }
+
+    def restore_schema(self, schema_data: Dict) -> None:
+        """
+        Restores the schema from data returned by `to_schema_data`, without querying the endpoint.
+
+        Args:
+            schema_data (Dict): The schema data.
+        """
+        namespaces = [
+            (prefix, URIRef(uri)) for prefix, uri in schema_data.get("namespaces", [])
+        ]
+        schema_graph = rdflib.Graph()
+        for prefix, uri in namespaces:
+            schema_graph.bind(prefix, uri, override=True)
+        for subject, predicate, value_type in schema_data.get("triples", []):
+            value_ref = BNode() if value_type == "Untyped" else URIRef(value_type)
+            schema_graph.add((URIRef(subject), URIRef(predicate), value_ref))
+
+        with self._schema_lock:
+            self.schema = schema_data["schema"]
+            self.namespaces = namespaces or None
+            self.classes = list(schema_data.get("classes", []))
+            self.schema_graph = schema_graph
+            self.class_fingerprints = dict(schema_data.get("fingerprints", {}))
+            self.statistics = (
+                SchemaStatistics.from_data(schema_data["statistics"])
+                if "statistics" in schema_data
+                else None
+            )
+
+    def _build_schema_text(
+        self,
+        classes: List[Dict],
+        graph: rdflib.graph.Graph,
+    ) -> Tuple[str, List[Tuple[str, URIRef]]]:
+        """
+        Builds the schema description used in the prompts from the classes and the schema graph.
+
+        Args:
+            classes (List[Dict]): The classes returned by CLS_RDF.
+            graph (rdflib.graph.Graph): The graph returned by `get_graph_from_classes`.
+        Returns:
+            Tuple[str, List[Tuple[str, URIRef]]]: The schema description and the namespaces it uses.
+        """
+        schema = graph.serialize(format="turtle")
+        namespaces = list(graph.namespaces())
+
+        formatted_namespaces = [(prefix, str(uri)) for prefix, uri in namespaces]
+        logger.info("namespaces %s", formatted_namespaces)
+
+        return (
+            f"The namespace prefixes are: {formatted_namespaces}\n"
+            + f"In the following, each URI is followed by the local name and optionally its rdfs:Label, and optionally its rdfs:comment. \n"
+            + f"The RDF graph supports the following node types:\n"
+            + f'{", ".join([self._res_to_str(row, formatted_namespaces) for row in classes])}\n'
+            + f"The RDF graph have the following schema:\n"
+            + f"{schema} \n"
+        ), namespaces
+
+    def extract_statistics(
+        self,
+        class_uris: List[str],
+        statistics: Optional[SchemaStatistics] = None,
+    ) -> SchemaStatistics:
+        """
+        Collects the cardinality statistics of classes with one CLS_STATS_RDF query per class, sending
+        at most `max_workers` queries at the same time. A class whose query fails is left without
+        statistics.
+
+        Args:
+            class_uris (List[str]): The classes to query.
+            statistics (Optional[SchemaStatistics]): Statistics updated with the new counts, a new
+                object by default.
+
+        Returns:
+            SchemaStatistics: The updated statistics.
+        """
+        statistics = statistics if statistics is not None else SchemaStatistics()
+        if not self.CLS_STATS_RDF:
+            return statistics
+
+        def fetch(class_uri: str) -> List[Dict[str, str]]:
+            return self.query(
+                self.CLS_STATS_RDF.format(class_uri=class_uri), use_cache=False
+            )
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(fetch, class_uri): class_uri for class_uri in class_uris
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Collecting class statistics",
+            ):
+                class_uri = futures[future]
+                try:
+                    statistics.update_class(class_uri, future.result())
+                except ValueError as e:
+                    logger.warning("Could not collect statistics of class %s: %s", class_uri, e)
+        return statistics
+
+    def update_statistics(self) -> SchemaStatistics:
+        """
+        Collects the cardinality statistics of all the classes of the current schema, e.g. for a schema
+        restored from a cache entry without statistics, and swaps them in.
+
+        Returns:
+            SchemaStatistics: The new statistics, also available as `statistics`.
+        """
+        class_uris = list(dict.fromkeys(cl.get("cls") for cl in self.classes))
+        statistics = self.extract_statistics(class_uris)
+        with self._schema_lock:
+            self.statistics = statistics
+        return statistics
+
+    def get_class_fingerprints(self, class_uris: List[str]) -> Dict[str, str]:
+        """
+        Retrieves a cheap fingerprint of classes with one CLS_FINGERPRINT_RDF query per class, sending
+        at most `max_workers` queries at the same time: the number of instances of a bounded sample of
+        the class, like the one of CLS_REL_RDF, and of distinct properties used by these instances. A
+        class whose fingerprint did not change since the last extraction is assumed to have the same
+        properties.
+
+        Args:
+            class_uris (List[str]): The classes to fingerprint.
+
+        Returns:
+            Dict[str, str]: The fingerprint of each class, keyed by class URI. A class whose query
+            failed has no fingerprint, and is extracted again at the next refresh. Empty if
+            CLS_FINGERPRINT_RDF is not configured.
+        """
+        if not self.CLS_FINGERPRINT_RDF:
+            return {}
+
+        def fetch(class_uri: str) -> str:
+            rows = self.query(
+                self.CLS_FINGERPRINT_RDF.format(class_uri=class_uri), use_cache=False
+            )
+            row = rows[0] if rows else {}
+            return f"{row.get('instances', '')}:{row.get('properties', '')}"
+
+        fingerprints: Dict[str, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(fetch, class_uri): class_uri for class_uri in class_uris
+            }
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Fingerprinting classes",
+            ):
+                class_uri = futures[future]
+                try:
+                    fingerprints[class_uri] = future.result()
+                except ValueError as e:
+                    logger.warning("Could not fingerprint class %s: %s", class_uri, e)
+        # Same order as the classes, for the schema cache
+        return {uri: fingerprints[uri] for uri in class_uris if uri in fingerprints}
+
+    def refresh_schema(self) -> List[str]:
+        """
+        Incrementally updates the extracted schema: the properties of a class are extracted again only
+        if the class is new or its fingerprint changed, the triples of removed classes are dropped, and
+        the schema description is regenerated. Without previous fingerprints every class is extracted again.
+        The new schema is built aside and swapped in at once, so the current schema keeps being served
+        until the refresh is complete.
+
+        Returns:
+            List[str]: The URIs of the classes that were added, updated or removed.
+        """
+        with self._refresh_lock:
+            return self._refresh_schema()
+
+    def _refresh_schema(self) -> List[str]:
+        if self.schema_file or self.standard != "rdf" or self.schema_graph is None:
+            self.load_schema()
+            return [cl.get("cls") for cl in self.classes]
+
+        classes = self.query(self.CLS_RDF, use_cache=False)
+        class_uris = list(dict.fromkeys(cl.get("cls") for cl in classes))
+        # Taken before the extraction, changes made while extracting are seen by the next refresh
+        fingerprints = self.get_class_fingerprints(class_uris)
+
+        changed = [
+            class_uri
+            for class_uri in class_uris
+            if not fingerprints
+            or class_uri not in self.class_fingerprints
+            or self.class_fingerprints[class_uri] != fingerprints.get(class_uri)
+        ]
+        removed = [
+            cl.get("cls") for cl in self.classes if cl.get("cls") not in class_uris
+        ]
+        if not changed and not removed and classes == self.classes:
+            logger.info("Schema is up to date, %s classes unchanged", len(class_uris))
+            return []
+
+        logger.info(
+            "Refreshing schema: %s changed classes, %s removed classes",
+            len(changed),
+            len(removed),
+        )
+        stale = {URIRef(class_uri) for class_uri in changed + removed}
+        graph = rdflib.Graph()
+        for prefix, uri in self.schema_graph.namespaces():
+            graph.bind(prefix, uri, override=True)
+        for triple in self.schema_graph:
+            if triple[0] not in stale:
+                graph.add(triple)
+
+        self.class_timings = {}
+        self._add_class_triples(graph, changed, self._extract_properties(changed))
+        schema, namespaces = self._build_schema_text(classes, graph)
+
+        statistics = self.statistics
+        if self.collect_statistics:
+            statistics = SchemaStatistics.from_data(
+                statistics.to_data() if statistics is not None else {}
+            )
+            for class_uri in removed:
+                statistics.remove_class(class_uri)
+            # Without previous statistics, collect those of every class
+            self.extract_statistics(
+                changed if self.statistics is not None else class_uris, statistics
+            )
+
+        with self._schema_lock:
+            self.schema = schema
+            self.namespaces = namespaces
+            self.classes = classes
+            self.schema_graph = graph
+            self.class_fingerprints = fingerprints
+            self.statistics = statistics
+
+        logger.info("number of tokens %s", token_counter(self.schema))
+        return changed + removed
+
     def load_schema(self) -> None:
         """
         loads graph schema information based on the specified standard (rdf,
         rdfs, owl) into the `schema` attribute.
         """
 
-        def _rdf_s_schema(
-            classes: List[Dict],
-            graph: rdflib.graph.Graph,
-        ) -> str:
-            schema = graph.serialize(format="turtle")
-            self.namespaces = list(graph.namespaces())
-
-            formatted_namespaces = [
-                (prefix, str(uri)) for prefix, uri in self.namespaces
-            ]
-            logger.info("namespaces %s", formatted_namespaces)
-
-            return (
-                f"The namespace prefixes are: {formatted_namespaces}\n"
-                + f"In the following, each URI is followed by the local name and optionally its rdfs:Label, and optionally its rdfs:comment. \n"
-                + f"The RDF graph supports the following node types:\n"
-                + f'{", ".join([self._res_to_str(row, formatted_namespaces) for row in classes])}\n'
-                + f"The RDF graph have the following schema:\n"
-                + f"{schema} \n"
-            )
-
         if self.schema_file:
             # Load schema from an existing file (typically an ontology)
             with open(self.schema_file, "r") as f:
@@ -245,11 +1266,24 @@ class RdfGraph:
             if self.standard == "rdf":
                 logging.info("query %s", self.CLS_RDF)
                 # Get the list of classes to analyze
-                clss = self.query(self.CLS_RDF)
+                clss = self.query(self.CLS_RDF, use_cache=False)
+                # Fingerprints let `refresh_schema` skip the classes that did not change. They are
+                # taken before the extraction, like in `refresh_schema`
+                fingerprints = self.get_class_fingerprints(
+                    list(dict.fromkeys(cl.get("cls") for cl in clss))
+                )
 
                 # For each class, find the properties that their instances may have, as well as the object types
                 graph = self.get_graph_from_classes(clss)
-                self.schema = _rdf_s_schema(clss, graph)
+                schema, namespaces = self._build_schema_text(clss, graph)
+                with self._schema_lock:
+                    self.schema, self.namespaces = schema, namespaces
+                    self.classes = clss
+                    self.schema_graph = graph
+                    self.class_fingerprints = fingerprints
+
+                if self.collect_statistics:
+                    self.update_statistics()
 
                 logger.info("number of tokens %s", token_counter(self.schema))
 
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Optional
+
+from app.core.graph_management.sparql_store import (
+    QueryCancellation,
+    SparqlQueryRejected,
+    SparqlTimeoutError,
+)
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class _Ticket:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    """
+    Limits the number of queries running at the same time on an endpoint. Queries above the limit
+    wait in a bounded first-in first-out queue, and are rejected at once when the queue is full.
+
+    The slot of a query is held by the thread waiting for its result, so it is freed as soon as that
+    thread gives up on the query. The cancellable queries run in `executor`, which has one worker
+    thread per slot.
+    """
+
+    def __init__(self, endpoint_url: str, max_concurrent: int, max_queued: int) -> None:
+        """
+        Args:
+            endpoint_url (str): The endpoint, used in the messages.
+            max_concurrent (int): Maximum number of queries running at the same time.
+            max_queued (int): Maximum number of queries waiting for a running query to complete.
+        """
+        self.endpoint_url = endpoint_url
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queue: Deque[_Ticket] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrent), thread_name_prefix="sparql-query"
+        )
+
+    @contextmanager
+    def admit(
+        self,
+        deadline: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Iterator[None]:
+        """
+        Waits for a free slot, runs the body of the context, then frees the slot.
+
+        Args:
+            deadline (Optional[float]): `time.monotonic()` value after which waiting for a slot times out.
+            cancellation (Optional[QueryCancellation]): Token to stop waiting for a slot.
+
+        Raises:
+            SparqlQueryRejected: If the queue is full.
+            SparqlTimeoutError: If the deadline passes while waiting.
+            SparqlQueryCancelled: If the token is cancelled while waiting.
+        """
+        start = time.monotonic()
+        ticket = None
+        with self._lock:
+            running, queued = self._running, len(self._queue)
+            if running < self.max_concurrent and not queued:
+                self._running += 1
+            elif queued < self.max_queued:
+                ticket = _Ticket()
+                self._queue.append(ticket)
+            else:
+                self.rejected += 1
+                logger.warning(
+                    "Rejected a query to %s: %s queries running and %s waiting",
+                    self.endpoint_url,
+                    running,
+                    queued,
+                )
+                raise SparqlQueryRejected(
+                    f"The endpoint {self.endpoint_url} is busy ({running} queries running and "
+                    f"{queued} waiting), please try again later."
+                )
+
+        if ticket is not None:
+            self._wait(ticket, deadline, cancellation)
+        self._record_wait(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _wait(
+        self,
+        ticket: _Ticket,
+        deadline: Optional[float],
+        cancellation: Optional[QueryCancellation],
+    ) -> None:
+        try:
+            if cancellation is not None:
+                cancellation.wait_until(ticket.event, lambda: ticket.granted, deadline)
+            else:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                ticket.event.wait(timeout)
+                if not ticket.granted:
+                    raise SparqlTimeoutError(
+                        "The query did not complete before its deadline, it was waiting for "
+                        f"a free slot on {self.endpoint_url}."
+                    )
+        except Exception:
+            with self._lock:
+                granted = ticket.granted
+                if not granted:
+                    self._queue.remove(ticket)
+                    self.timed_out += 1
+            if granted:
+                # The slot was freed for this query while it gave up
+                self._release()
+            raise
+
+    def _record_wait(self, wait_seconds: float) -> None:
+        with self._lock:
+            self.admitted += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def _release(self) -> None:
+        with self._lock:
+            if self._queue:
+                # The slot goes to the oldest waiting query, the running count is unchanged
+                ticket = self._queue.popleft()
+                ticket.granted = True
+                ticket.event.set()
+            else:
+                self._running -= 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: The number of running and waiting queries, of admitted, rejected and
+            timed out queries, and the mean and maximum time spent waiting for a slot, in seconds.
+        """
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "mean_wait_seconds": (
+                    self.total_wait_seconds / self.admitted if self.admitted else 0.0
+                ),
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+# One controller per endpoint, shared by every graph of the process
+_controllers: Dict[str, AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(
+    endpoint_url: str, max_concurrent: int, max_queued: int
+) -> AdmissionController:
+    """
+    Returns the admission controller shared by all the graphs of `endpoint_url`. The limits are
+    those of the first call for an endpoint.
+    """
+    with _controllers_lock:
+        controller = _controllers.get(endpoint_url)
+        if controller is None:
+            controller = _controllers[endpoint_url] = AdmissionController(
+                endpoint_url, max_concurrent, max_queued
+            )
+        return controller
@@ -0,0 +1,269 @@
+"""
+Local stand-in for the ENPKG SPARQL endpoint, for tests, benchmarks and air-gapped machines.
+
+Serves an rdflib graph loaded from a fixture (by default `app/data/enpkg_fixture.ttl`, see
+`app.core.tests.generate_enpkg_fixture`) over the SPARQL 1.1 protocol, with an optional artificial
+latency added to every answer.
+
+Usage:
+    python -m app.core.graph_management.local_endpoint --port 7200 --latency 0.2
+    python -m app.core.main -c "..." --endpoint http://127.0.0.1:7200/repositories/ENPKG
+"""
+
+from __future__ import annotations
+
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+import rdflib
+from rdflib.plugins.sparql import prepareQuery
+
+from app.core.graph_management.RdfGraphCustom import sparql_parser_lock
+from app.core.graph_management.sparql_store import RESULT_MIME_TYPES
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+DEFAULT_FIXTURE = Path(__file__).resolve().parents[2] / "data" / "enpkg_fixture.ttl"
+DEFAULT_PATH = "/repositories/ENPKG"
+
+# rdflib serializer of each result format, in the order used when the client has no preference
+SELECT_FORMATS = {
+    RESULT_MIME_TYPES["json"]: "json",
+    RESULT_MIME_TYPES["csv"]: "csv",
+    RESULT_MIME_TYPES["xml"]: "xml",
+}
+GRAPH_FORMATS = {
+    "text/turtle": "turtle",
+    "application/n-triples": "nt",
+    "application/rdf+xml": "xml",
+}
+
+
+def negotiate(accept: str, formats: dict) -> Tuple[str, str]:
+    """
+    Picks the format of the answer from an Accept header, by decreasing quality value.
+
+    Args:
+        accept (str): The Accept header, e.g. "text/csv, application/sparql-results+json;q=0.9".
+        formats (dict): The supported formats, MIME type to rdflib serializer name.
+
+    Returns:
+        Tuple[str, str]: The MIME type and the rdflib serializer name, the first supported format
+        when the header lists none of them.
+    """
+    ranked: List[Tuple[float, int, str]] = []
+    for position, part in enumerate(accept.split(",")):
+        mime_type, *parameters = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if mime_type in formats and quality > 0:
+            ranked.append((-quality, position, mime_type))
+    mime_type = min(ranked)[2] if ranked else next(iter(formats))
+    return mime_type, formats[mime_type]
+
+
+class LocalSparqlEndpoint:
+    """
+    SPARQL endpoint answering SELECT, ASK, CONSTRUCT and DESCRIBE queries sent by GET or POST on
+    `path` from an in-memory rdflib graph. Every answer waits `latency_seconds` first, without
+    blocking the other queries, to behave like a remote endpoint.
+
+    The results are negotiated with the Accept header like GraphDB does: CSV, JSON or XML for SELECT
+    and ASK, Turtle, N-Triples or RDF/XML for CONSTRUCT and DESCRIBE. Invalid queries are answered
+    with a 400 status.
+    """
+
+    def __init__(
+        self,
+        graph: rdflib.Graph,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        path: str = DEFAULT_PATH,
+        latency_seconds: float = 0.0,
+    ) -> None:
+        """
+        Args:
+            graph (rdflib.Graph): The data served. It must not be modified while the endpoint runs.
+            host (str): Interface the server listens on.
+            port (int): Port the server listens on, 0 to pick a free port.
+            path (str): Path of the endpoint.
+            latency_seconds (float): Delay added before each answer.
+        """
+        self.graph = graph
+        self.host = host
+        self.port = port
+        self.path = path
+        self.latency_seconds = latency_seconds
+        # Number of queries answered, failed ones included
+        self.query_count = 0
+        self._count_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_fixture(
+        cls, fixture: Union[str, Path] = DEFAULT_FIXTURE, **kwargs
+    ) -> LocalSparqlEndpoint:
+        """
+        Creates an endpoint serving a fixture file.
+
+        Args:
+            fixture (Union[str, Path]): RDF file, in a format rdflib guesses from its extension.
+            **kwargs: The other arguments of `LocalSparqlEndpoint`.
+
+        Returns:
+            LocalSparqlEndpoint: The endpoint, not started.
+        """
+        graph = rdflib.Graph()
+        graph.parse(str(fixture))
+        logger.info("Loaded %s triples from %s", len(graph), fixture)
+        return cls(graph, **kwargs)
+
+    @property
+    def url(self) -> str:
+        """URL of the endpoint, with the port actually bound once started."""
+        return f"http://{self.host}:{self.port}{self.path}"
+
+    def start(self) -> LocalSparqlEndpoint:
+        """Starts serving in a background thread."""
+        if self._server is not None:
+            return self
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="local-sparql-endpoint", daemon=True
+        )
+        self._thread.start()
+        logger.info("Local SPARQL endpoint listening at %s", self.url)
+        return self
+
+    def stop(self) -> None:
+        """Stops the server and closes its socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = self._thread = None
+
+    def __enter__(self) -> LocalSparqlEndpoint:
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def answer(self, query: str, accept: str) -> Tuple[int, str, bytes]:
+        """
+        Evaluates a query and serializes its result.
+
+        Args:
+            query (str): The SPARQL query.
+            accept (str): The Accept header of the request.
+
+        Returns:
+            Tuple[int, str, bytes]: The HTTP status, the content type and the body.
+        """
+        with self._count_lock:
+            self.query_count += 1
+        try:
+            # The rdflib parser is shared with the clients running in the same process
+            with sparql_parser_lock:
+                prepared = prepareQuery(query, initNs=dict(self.graph.namespaces()))
+        except Exception as e:
+            return 400, "text/plain", f"MALFORMED QUERY: {e}".encode()
+        try:
+            result = self.graph.query(prepared)
+            if result.type in ("CONSTRUCT", "DESCRIBE"):
+                mime_type, serializer = negotiate(accept, GRAPH_FORMATS)
+                return 200, mime_type, result.graph.serialize(format=serializer, encoding="utf-8")
+            formats = SELECT_FORMATS
+            if result.type == "ASK":
+                # The CSV serializer of rdflib only writes solutions
+                formats = {m: f for m, f in SELECT_FORMATS.items() if f != "csv"}
+            mime_type, serializer = negotiate(accept, formats)
+            return 200, mime_type, result.serialize(format=serializer)
+        except Exception as e:
+            logger.warning("Local endpoint failed to evaluate a query: %s", e)
+            return 500, "text/plain", f"Query evaluation failed: {e}".encode()
+
+    def _handler_class(self) -> type:
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps connections open between requests, like the pooled sessions of the clients expect
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status: int, content_type: str, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, query: Optional[str]) -> None:
+                if urlsplit(self.path).path != endpoint.path:
+                    self._reply(404, "text/plain", b"Unknown repository")
+                    return
+                if not query:
+                    self._reply(400, "text/plain", b"Missing query parameter")
+                    return
+                if endpoint.latency_seconds > 0:
+                    time.sleep(endpoint.latency_seconds)
+                self._reply(*endpoint.answer(query, self.headers.get("Accept", "")))
+
+            def do_GET(self) -> None:
+                self._handle(parse_qs(urlsplit(self.path).query).get("query", [None])[0])
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if self.headers.get("Content-Type", "").startswith("application/sparql-query"):
+                    self._handle(body)
+                else:
+                    self._handle(parse_qs(body).get("query", [None])[0])
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debug("Local endpoint: " + format, *args)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--fixture", type=Path, default=DEFAULT_FIXTURE)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7200)
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Delay added to each answer, in seconds."
+    )
+    args = parser.parse_args()
+
+    endpoint = LocalSparqlEndpoint.from_fixture(
+        args.fixture,
+        host=args.host,
+        port=args.port,
+        path=args.path,
+        latency_seconds=args.latency,
+    ).start()
+    print(f"SPARQL endpoint serving {len(endpoint.graph)} triples at {endpoint.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        endpoint.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+from typing import List, Optional, Set, Tuple
+
+from rdflib import BNode, URIRef, Variable
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.term import Identifier
+
+from app.core.graph_management.schema_statistics import RDF_TYPE, SchemaStatistics
+from app.core.graph_management.sparql_text import replace_spans, triple_runs
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+TriplePattern = Tuple[Identifier, Identifier, Identifier]
+
+# Operators that need the complete solutions of their operand before returning the first one
+_BLOCKING_OPERATORS = ("OrderBy", "Group", "AggregateJoin")
+
+
+def _is_variable(term: Identifier) -> bool:
+    return isinstance(term, (Variable, BNode))
+
+
+class SelectivityEstimator:
+    """
+    Estimates the number of solutions of a triple pattern from the schema statistics, assuming the
+    values of a property are evenly distributed over its subjects and objects.
+    """
+
+    def __init__(self, statistics: SchemaStatistics) -> None:
+        self.statistics = statistics
+        # Upper bound used for the patterns that the statistics know nothing about
+        self.total_triples = max(
+            1,
+            sum(
+                counts.get("triples", 0)
+                for properties in statistics.property_counts.values()
+                for counts in properties.values()
+            ),
+        )
+        self.total_instances = max(1, sum(statistics.class_instances.values()))
+
+    def estimate(self, pattern: TriplePattern, bound: Set[Identifier]) -> float:
+        """
+        Args:
+            pattern (TriplePattern): The subject, predicate and object of the pattern.
+            bound (Set[Identifier]): The variables bound by the patterns evaluated before this one.
+
+        Returns:
+            float: The estimated number of solutions of the pattern.
+        """
+        subject, predicate, obj = pattern
+        subject_bound = not _is_variable(subject) or subject in bound
+        object_bound = not _is_variable(obj) or obj in bound
+
+        if str(predicate) == RDF_TYPE and isinstance(obj, URIRef):
+            instances = self.statistics.get_class_instances(str(obj))
+            estimate = float(self.total_instances if instances is None else instances)
+            return min(estimate, 1.0) if subject_bound else estimate
+
+        counts = (
+            self.statistics.get_property_counts(str(predicate))
+            if isinstance(predicate, URIRef)
+            else None
+        )
+        if counts is None:
+            # Variable predicate, property path or property without statistics
+            estimate = float(self.total_triples)
+            if subject_bound:
+                estimate /= self.total_instances
+            if object_bound:
+                estimate /= self.total_instances
+            return estimate
+
+        estimate = float(counts["triples"])
+        if subject_bound:
+            estimate /= max(1, counts["subjects"])
+        if object_bound:
+            estimate /= max(1, counts["objects"])
+        return estimate
+
+
+def order_patterns(
+    patterns: List[TriplePattern],
+    estimator: SelectivityEstimator,
+    bound: Optional[Set[Identifier]] = None,
+) -> List[TriplePattern]:
+    """
+    Orders the patterns of a basic graph pattern most selective first. Each step picks the pattern
+    with the fewest estimated solutions among those sharing a variable with the patterns already
+    picked, so that no cartesian product is introduced, the first pattern written winning ties.
+
+    Args:
+        patterns (List[TriplePattern]): The patterns of the basic graph pattern.
+        estimator (SelectivityEstimator): Estimates the solutions of a pattern.
+        bound (Optional[Set[Identifier]]): The variables bound before the first pattern.
+
+    Returns:
+        List[TriplePattern]: The same patterns, reordered.
+    """
+    remaining = list(patterns)
+    ordered: List[TriplePattern] = []
+    bound = set(bound or ())
+    while remaining:
+        connected = [
+            pattern
+            for pattern in remaining
+            if any(_is_variable(term) and term in bound for term in pattern)
+        ]
+        candidates = connected or remaining
+        best = min(candidates, key=lambda pattern: estimator.estimate(pattern, bound))
+        remaining.remove(best)
+        ordered.append(best)
+        bound.update(term for term in best if _is_variable(term))
+    return ordered
+
+
+def reorder_triple_patterns(query: str, statistics: SchemaStatistics) -> str:
+    """
+    Rewrites a SPARQL query with the triple patterns of each of its basic graph patterns ordered most
+    selective first, for endpoints that evaluate them in the written order. The patterns of a basic
+    graph pattern are a conjunction, so their order does not change the result.
+
+    The patterns are moved in the text of the query (see `sparql_text.triple_runs`): only the runs of
+    consecutive simple triple patterns are reordered, the rest of the query is kept as written.
+
+    Args:
+        query (str): The SPARQL query.
+        statistics (SchemaStatistics): The cardinality statistics of the schema.
+
+    Returns:
+        str: The rewritten query, or the query unchanged if it has no run of several triple patterns
+        or their order is already the estimated best one.
+    """
+    runs = triple_runs(query)
+    if not runs:
+        return query
+    estimator = SelectivityEstimator(statistics)
+    replacements = []
+    for run in runs:
+        if len(run) < 2:
+            continue
+        remaining = list(run)
+        ordered = []
+        for pattern in order_patterns([triple.pattern for triple in run], estimator):
+            triple = next(t for t in remaining if t.pattern == pattern)
+            remaining.remove(triple)
+            ordered.append(triple)
+        # Each pattern takes the place of another one, keeping the dot ending that place
+        replacements.extend(
+            (place.start, place.end, query[triple.start : triple.end])
+            for place, triple in zip(run, ordered)
+            if place is not triple
+        )
+    if not replacements:
+        logger.debug("The triple patterns of the query are already ordered")
+        return query
+    return replace_spans(query, replacements)
+
+
+class QueryCost:
+    """
+    Estimated size of a query: the number of rows it returns and its cost, the number of intermediate
+    solutions computed by its joins.
+    """
+
+    def __init__(self, rows: float, cost: float) -> None:
+        self.rows = rows
+        self.cost = cost
+
+    def __repr__(self) -> str:
+        return f"QueryCost(rows={self.rows:.0f}, cost={self.cost:.0f})"
+
+
+def _conjunction(node) -> Optional[List[TriplePattern]]:
+    """Returns the triple patterns of a BGP or of a join of BGPs, None for other operators."""
+    name = getattr(node, "name", None)
+    if name == "BGP":
+        return list(node.triples)
+    if name == "Join":
+        left, right = _conjunction(node.p1), _conjunction(node.p2)
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+
+def _is_blocking(node) -> bool:
+    if getattr(node, "name", None) in _BLOCKING_OPERATORS:
+        return True
+    return any(_is_blocking(node[key]) for key in ("p", "p1", "p2") if key in node)
+
+
+def _visible_variables(node) -> Set[Identifier]:
+    """Variables bound by the solutions of an operator, only the projected ones for a subquery."""
+    name = getattr(node, "name", None)
+    if name == "BGP":
+        return {term for pattern in node.triples for term in pattern if _is_variable(term)}
+    if name == "Project":
+        return set(node.PV)
+    if name in ("Join", "LeftJoin", "Union"):
+        return _visible_variables(node.p1) | _visible_variables(node.p2)
+    if name == "Minus":
+        return _visible_variables(node.p1)
+    if name == "Extend":
+        return _visible_variables(node.p) | {node.var}
+    if "p" in node:
+        return _visible_variables(node.p)
+    return set(getattr(node, "_vars", None) or ())
+
+
+def _conjunction_cost(
+    patterns: List[TriplePattern],
+    estimator: SelectivityEstimator,
+    bound: Optional[Set[Identifier]] = None,
+) -> QueryCost:
+    """
+    Joins the patterns in the order chosen by `order_patterns`, as a planner using statistics would.
+    With `bound` variables, the estimates are those of each solution binding them.
+    """
+    rows, cost = 1.0, 0.0
+    bound = set(bound or ())
+    for pattern in order_patterns(patterns, estimator, bound):
+        rows *= estimator.estimate(pattern, bound)
+        cost += rows
+        bound.update(term for term in pattern if _is_variable(term))
+    return QueryCost(rows, cost)
+
+
+def _join_rows(node, left: QueryCost, right: QueryCost, estimator: SelectivityEstimator) -> float:
+    """
+    Estimates the rows of a join that is not a conjunction of triple patterns, e.g. with a subquery
+    or an OPTIONAL. The triple patterns of one side are estimated for each solution of the other
+    side binding the shared variables, as within a basic graph pattern. Without a side made of
+    triple patterns, each solution of the larger side is assumed to join one solution of the other.
+    """
+    shared = _visible_variables(node.p1) & _visible_variables(node.p2)
+    if not shared:
+        return left.rows * right.rows
+    for patterns, other in ((_conjunction(node.p2), left), (_conjunction(node.p1), right)):
+        if patterns is not None:
+            return other.rows * _conjunction_cost(patterns, estimator, shared).rows
+    return min(left.rows * right.rows, max(left.rows, right.rows))
+
+
+def _operator_cost(node, estimator: SelectivityEstimator) -> QueryCost:
+    patterns = _conjunction(node)
+    if patterns is not None:
+        return _conjunction_cost(patterns, estimator)
+
+    name = getattr(node, "name", None)
+    if name in ("Join", "Union", "LeftJoin", "Minus"):
+        left = _operator_cost(node.p1, estimator)
+        right = _operator_cost(node.p2, estimator)
+        if name == "Union":
+            return QueryCost(left.rows + right.rows, left.cost + right.cost)
+        if name == "Minus":
+            return QueryCost(left.rows, left.cost + right.cost)
+        if name == "LeftJoin":
+            optional = _conjunction(node.p1), _conjunction(node.p2)
+            if None not in optional:
+                joined = _conjunction_cost(optional[0] + optional[1], estimator)
+                return QueryCost(max(left.rows, joined.rows), max(left.cost, joined.cost))
+            return QueryCost(left.rows, left.cost + right.cost)
+        rows = _join_rows(node, left, right, estimator)
+        return QueryCost(rows, left.cost + right.cost + rows)
+
+    if name == "Slice":
+        operand = _operator_cost(node.p, estimator)
+        if node.length is None or operand.rows <= node.length:
+            return operand
+        if _is_blocking(node.p):
+            return QueryCost(float(node.length), operand.cost)
+        # The endpoint stops once it has computed the requested rows
+        fetched = min(operand.rows, float(node.length + (node.start or 0)))
+        return QueryCost(float(node.length), operand.cost * fetched / operand.rows)
+
+    if "p" in node:
+        return _operator_cost(node.p, estimator)
+    return QueryCost(1.0, 0.0)
+
+
+def estimate_query_cost(query: str, statistics: SchemaStatistics) -> Optional[QueryCost]:
+    """
+    Estimates the rows returned and the cost of a query from the schema statistics, before it is
+    sent. FILTER clauses and aggregates are ignored, so the estimates are upper bounds for the
+    queries using them. The rdflib parser is not thread-safe, callers running concurrently must hold
+    `sparql_parser_lock`.
+
+    Args:
+        query (str): The SPARQL query.
+        statistics (SchemaStatistics): The cardinality statistics of the schema.
+
+    Returns:
+        Optional[QueryCost]: The estimates, None if rdflib cannot parse the query.
+    """
+    try:
+        parsed: Query = translateQuery(parseQuery(query))
+    except Exception as e:
+        logger.debug("The cost of the query is not estimated: %s", e)
+        return None
+    return _operator_cost(parsed.algebra, SelectivityEstimator(statistics))
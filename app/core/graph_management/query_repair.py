@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import difflib
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from rdflib import URIRef, Variable
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.term import Identifier
+
+from app.core.graph_management.schema_validator import (
+    SchemaDiagnostic,
+    SchemaIndex,
+    TriplePattern,
+    _local_name,
+    collect_basic_graph_patterns,
+    infer_classes,
+    validate_patterns,
+)
+from app.core.graph_management.sparql_text import (
+    TextTriple,
+    prefixes,
+    replace_spans,
+    tokenize,
+    triple_runs,
+    variables,
+    write_term,
+)
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+# Longest chain of properties inserted between a node and a property of another class
+MAX_INSERTED_HOPS = 3
+# Minimum similarity of the local names of a property and of its replacement
+MIN_PROPERTY_SIMILARITY = 0.5
+MIN_UNKNOWN_PROPERTY_SIMILARITY = 0.8
+# Number of diagnostics repaired at most in one query
+MAX_REPAIRS = 10
+# Keywords of the queries whose wrong properties are only renamed: inserting hops changes the values
+# given to BIND and the groups counted by the aggregates
+_NO_INSERTED_HOPS = {
+    "BIND", "GROUP", "HAVING", "COUNT", "SUM", "MIN", "MAX", "AVG", "SAMPLE", "GROUP_CONCAT"
+}
+
+
+def _similarity(first: str, second: str) -> float:
+    return difflib.SequenceMatcher(None, _local_name(first), _local_name(second)).ratio()
+
+
+def shortest_property_path(
+    index: SchemaIndex, start_classes: Set[str], end_classes: Set[str], max_hops: int
+) -> Optional[List[Tuple[str, str]]]:
+    """
+    Finds the shortest chain of properties linking instances of one of the start classes to
+    instances of one of the end classes, with a breadth-first search over the schema graph whose
+    edges are the properties whose value type is a class.
+
+    Args:
+        index (SchemaIndex): The schema index.
+        start_classes (Set[str]): The classes the chain starts from.
+        end_classes (Set[str]): The classes the chain must reach.
+        max_hops (int): Maximum number of properties of the chain.
+
+    Returns:
+        Optional[List[Tuple[str, str]]]: The (property, class reached) of each hop, an empty list if a
+        start class is an end class, None if no chain of at most `max_hops` properties exists.
+    """
+    previous: Dict[str, Optional[Tuple[str, str]]] = {
+        class_uri: None for class_uri in sorted(start_classes)
+    }
+    queue = deque((class_uri, 0) for class_uri in sorted(start_classes))
+    while queue:
+        class_uri, hops = queue.popleft()
+        if class_uri in end_classes:
+            path: List[Tuple[str, str]] = []
+            while previous[class_uri] is not None:
+                from_class, property_uri = previous[class_uri]
+                path.append((property_uri, class_uri))
+                class_uri = from_class
+            return list(reversed(path))
+        if hops == max_hops:
+            continue
+        for property_uri, value_types in sorted(index.properties_of(class_uri).items()):
+            for value_type in sorted(value_types):
+                if index.is_class_type(value_type) and value_type not in previous:
+                    previous[value_type] = (class_uri, property_uri)
+                    queue.append((value_type, hops + 1))
+    return None
+
+
+class QueryRepairer:
+    """
+    Repairs without an LLM the mechanical schema errors of a query found by `validate_patterns`:
+    a property used on a class that does not have it is replaced by a similarly named property of the
+    class, or reached through the shortest chain of properties from the class, and an unknown property
+    is replaced by the closest property of the schema.
+    """
+
+    def __init__(self, index: SchemaIndex, max_hops: int = MAX_INSERTED_HOPS) -> None:
+        self.index = index
+        self.max_hops = max_hops
+        # Description of the repairs applied to the last query
+        self.repairs: List[str] = []
+
+    def _new_variable(self, name: str, used: Set[Identifier]) -> Variable:
+        variable = Variable(name)
+        suffix = 1
+        while variable in used:
+            suffix += 1
+            variable = Variable(f"{name}{suffix}")
+        used.add(variable)
+        return variable
+
+    def _replace_property(
+        self,
+        pattern: TriplePattern,
+        subject_classes: Set[str],
+        object_classes: Set[str],
+    ) -> Optional[List[TriplePattern]]:
+        """Replaces the property by the closest property of the subject classes reaching the object classes."""
+        subject, predicate, obj = pattern
+        candidates = [
+            (_similarity(str(predicate), property_uri), property_uri)
+            for class_uri in subject_classes
+            for property_uri in self.index.properties_of(class_uri)
+            if self.index.targets(subject_classes, property_uri) & object_classes
+        ]
+        candidates = [c for c in candidates if c[0] >= MIN_PROPERTY_SIMILARITY]
+        if not candidates:
+            return None
+        _, property_uri = max(candidates)
+        return [(subject, URIRef(property_uri), obj)]
+
+    def _insert_hops(
+        self,
+        pattern: TriplePattern,
+        subject_classes: Set[str],
+        object_classes: Set[str],
+        used: Set[Identifier],
+    ) -> Optional[List[TriplePattern]]:
+        """Links the subject to a class having the property with the shortest chain of properties."""
+        subject, predicate, obj = pattern
+        owners = self.index.classes_with(str(predicate))
+        if object_classes:
+            # The property must still lead to the classes expected for the object
+            owners = {
+                owner
+                for owner in owners
+                if self.index.targets({owner}, str(predicate)) & object_classes
+            }
+        path = shortest_property_path(self.index, subject_classes, owners, self.max_hops)
+        if not path:
+            return None
+        patterns: List[TriplePattern] = []
+        node = subject
+        for property_uri, class_uri in path:
+            name = _local_name(class_uri)
+            hop = self._new_variable(name[:1].lower() + name[1:], used)
+            patterns.append((node, URIRef(property_uri), hop))
+            node = hop
+        patterns.append((node, predicate, obj))
+        return patterns
+
+    def _repair(
+        self,
+        diagnostic: SchemaDiagnostic,
+        classes: Dict[Identifier, Set[str]],
+        domains: Dict[Identifier, Set[str]],
+        used: Set[Identifier],
+        insert_hops: bool = True,
+    ) -> Optional[List[TriplePattern]]:
+        subject, predicate, obj = diagnostic.pattern
+        subject_classes = classes.get(subject, set())
+        object_classes = classes.get(obj, set()) | domains.get(obj, set())
+
+        if diagnostic.code == SchemaDiagnostic.UNKNOWN_PROPERTY:
+            candidates = [
+                property_uri
+                for property_uri in diagnostic.suggestions
+                if _similarity(str(predicate), property_uri) >= MIN_UNKNOWN_PROPERTY_SIMILARITY
+                and (
+                    not subject_classes
+                    or subject_classes & self.index.classes_with(property_uri)
+                )
+            ]
+            return [(subject, URIRef(candidates[0]), obj)] if candidates else None
+
+        if diagnostic.code == SchemaDiagnostic.PROPERTY_NOT_ON_CLASS:
+            replacement = self._replace_property(diagnostic.pattern, subject_classes, object_classes)
+            if replacement is None and insert_hops:
+                replacement = self._insert_hops(
+                    diagnostic.pattern, subject_classes, object_classes, used
+                )
+            return replacement
+        return None
+
+    @staticmethod
+    def _write(
+        replacement: List[TriplePattern], triple: TextTriple, query: str, namespaces: Dict[str, str]
+    ) -> str:
+        """Writes the replacement patterns of a triple, keeping the text of the terms it already had."""
+        written = {term: token.text for term, token in zip(triple.pattern, triple.tokens)}
+        line_start = query.rfind("\n", 0, triple.start) + 1
+        indent = query[line_start : triple.start]
+        separator = f" .\n{indent}" if not indent.strip() else " . "
+        return separator.join(
+            " ".join(written.get(term) or write_term(term, namespaces) for term in pattern)
+            for pattern in replacement
+        )
+
+    def repair(self, query: str) -> Optional[str]:
+        """
+        Repairs the schema errors of a query. The wrong triple patterns are replaced in the text of the
+        query, the rest of the query is kept as written. Queries with subqueries are not repaired, and
+        the wrong properties of queries with BIND or aggregates are only renamed, without inserting
+        hops. The rdflib parser is not thread-safe, callers running concurrently must hold
+        `sparql_parser_lock`.
+
+        Args:
+            query (str): The SPARQL query.
+
+        Returns:
+            Optional[str]: The repaired query, the query unchanged if it has no error, None if one of
+            its errors cannot be repaired or its wrong pattern cannot be located in the text.
+        """
+        self.repairs = []
+        for _ in range(MAX_REPAIRS):
+            try:
+                parsed = translateQuery(parseQuery(query))
+            except Exception as e:
+                logger.debug("The query is not repaired: %s", e)
+                return None
+            patterns = [
+                pattern
+                for bgp in collect_basic_graph_patterns(parsed.algebra)
+                for pattern in bgp.triples
+            ]
+            diagnostics = validate_patterns(patterns, self.index)
+            if not diagnostics:
+                break
+            diagnostic = diagnostics[0]
+
+            tokens = tokenize(query)
+            if sum(token.keyword() == "SELECT" for token in tokens) > 1:
+                logger.info("Cannot repair a query with subqueries without the LLM")
+                return None
+            runs = triple_runs(query) or []
+            located = [t for run in runs for t in run if t.pattern == diagnostic.pattern]
+            if len(located) != 1:
+                logger.info("Cannot locate the pattern to repair: %s", diagnostic.message)
+                return None
+
+            classes, domains = infer_classes(patterns, self.index)
+            insert_hops = not {token.keyword() for token in tokens} & _NO_INSERTED_HOPS
+            replacement = self._repair(diagnostic, classes, domains, variables(query), insert_hops)
+            if replacement is None:
+                logger.info("Cannot repair the query without the LLM: %s", diagnostic.message)
+                return None
+            triple = located[0]
+            text = self._write(replacement, triple, query, prefixes(tokens))
+            query = replace_spans(query, [(triple.start, triple.end, text)])
+            self.repairs.append(
+                f"{' '.join(self.index.shorten(t) for t in diagnostic.pattern)} -> "
+                + " . ".join(" ".join(self.index.shorten(t) for t in p) for p in replacement)
+            )
+        else:
+            return None
+
+        if self.repairs:
+            logger.info("Query repaired without the LLM: %s", "; ".join(self.repairs))
+        return query
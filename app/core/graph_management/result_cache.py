@@ -0,0 +1,276 @@
+"""
+On-disk cache of the rows returned by SPARQL SELECT queries.
+
+Entries are keyed by endpoint, schema version and normalized query text, so that the same
+question generated again (rerun, evaluation pass, follow-up) is answered without querying the
+endpoint. The cache is a sqlite database bounded in size (least recently used entries are evicted
+first) and in age (entries older than the TTL are ignored and removed).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+parent_dir = Path(__file__).parent.parent.parent
+default_cache_dir = parent_dir / "graphs" / "result_cache"
+
+
+def get_result_cache_dir() -> Path:
+    """Cache directory, overridable with the METABOT_RESULT_CACHE_DIR environment variable."""
+    return Path(os.getenv("METABOT_RESULT_CACHE_DIR", default_cache_dir))
+
+
+# Tokens of a SPARQL query that normalization must not alter or split
+_QUERY_TOKENS = re.compile(
+    r"""
+    (?P<string>
+        \"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+        | '''(?:[^'\\]|\\.|'(?!''))*'''
+        | "(?:[^"\\\n]|\\.)*"
+        | '(?:[^'\\\n]|\\.)*'
+    )
+    | (?P<iri><[^<>"{}|^`\\\s]*>)
+    | (?P<comment>\#[^\n]*)
+    | (?P<space>\s+)
+    | (?P<punctuation>[{}(),;])
+    | (?P<word>[^\s"'<#{}(),;]+|.)
+    """,
+    re.VERBOSE,
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes the text of a SPARQL query so that queries differing only by their comments,
+    whitespace or the order of their PREFIX declarations are identical. Strings and IRIs are kept as is.
+
+    Args:
+        query (str): The SPARQL query.
+
+    Returns:
+        str: The normalized query.
+    """
+    tokens: List[str] = []
+    for match in _QUERY_TOKENS.finditer(query):
+        kind = match.lastgroup
+        if kind in ("comment", "space"):
+            continue
+        tokens.append(match.group())
+
+    # Leading PREFIX and BASE declarations, sorted by prefix name
+    declarations = []
+    position = 0
+    while position < len(tokens):
+        keyword = tokens[position].upper()
+        if keyword == "PREFIX" and position + 2 < len(tokens):
+            declarations.append(("PREFIX", tokens[position + 1], tokens[position + 2]))
+            position += 3
+        elif keyword == "BASE" and position + 1 < len(tokens):
+            declarations.append(("BASE", "", tokens[position + 1]))
+            position += 2
+        else:
+            break
+    prologue = [" ".join(part for part in declaration if part) for declaration in sorted(declarations)]
+
+    body = ""
+    for token in tokens[position:]:
+        if token in "{}(),;" or body.endswith(("{", "(")) or not body:
+            body += token
+        else:
+            body += " " + token
+    return "\n".join(prologue + [body]) if body else "\n".join(prologue)
+
+
+class ResultCache:
+    """
+    Stores the rows of SELECT queries (see `RdfGraph.query`) in a sqlite database shared by the
+    processes using the same cache directory.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        max_size_bytes: int = 256 * 2**20,
+        ttl_seconds: float = 86400,
+    ) -> None:
+        """
+        Args:
+            path (Optional[Path]): The sqlite database, `results.sqlite3` of the cache directory by default.
+            max_size_bytes (int): Maximum total size of the stored rows, in bytes of JSON.
+            ttl_seconds (float): Age after which an entry is no longer used, 0 to keep entries until evicted.
+        """
+        self.path = Path(path) if path else get_result_cache_dir() / "results.sqlite3"
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS results (
+                        key TEXT PRIMARY KEY,
+                        endpoint TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        accessed_at REAL NOT NULL,
+                        size INTEGER NOT NULL,
+                        rows TEXT NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)"
+                )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(endpoint_url: str, schema_version: str, query: str) -> str:
+        """Cache key of a query: hash of the endpoint, the schema version and the normalized query."""
+        digest = hashlib.sha256(
+            f"{endpoint_url}\0{schema_version}\0{normalize_query(query)}".encode("utf-8")
+        )
+        return digest.hexdigest()
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(
+        self, endpoint_url: str, schema_version: str, query: str
+    ) -> Optional[List[Dict[str, str]]]:
+        """
+        Returns:
+            Optional[List[Dict[str, str]]]: The cached rows of the query, or None if they are not
+            cached, expired or unreadable.
+        """
+        key = self.key(endpoint_url, schema_version, query)
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                entry = conn.execute(
+                    "SELECT created_at, rows FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if entry is not None and self._is_expired(entry[0], now):
+                    with conn:
+                        conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    return None
+                with conn:
+                    conn.execute(
+                        "UPDATE results SET accessed_at = ? WHERE key = ?", (now, key)
+                    )
+                rows = json.loads(entry[1])
+            except (sqlite3.Error, ValueError) as e:
+                logger.warning("Ignoring the result cache %s: %s", self.path, e)
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.info("Result cache hit for query %s", key[:12])
+        return rows
+
+    def put(
+        self,
+        endpoint_url: str,
+        schema_version: str,
+        query: str,
+        rows: List[Dict[str, str]],
+    ) -> None:
+        """Stores the rows of a query, then evicts the least recently used entries above the size limit."""
+        key = self.key(endpoint_url, schema_version, query)
+        data = json.dumps(rows, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_size_bytes:
+            logger.info("Result of query %s is too large to be cached", key[:12])
+            return
+
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, endpoint_url, now, now, size, data),
+                    )
+                    self._evict(conn, now)
+            except sqlite3.Error as e:
+                logger.warning("Could not write to the result cache %s: %s", self.path, e)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.ttl_seconds > 0:
+            conn.execute(
+                "DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        evicted = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM results ORDER BY accessed_at"
+        ).fetchall():
+            if total_size <= self.max_size_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def clear(self) -> None:
+        """Removes all the cached results."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM results")
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: The hits, misses and evictions of this instance, its hit rate, and the
+            number of entries and total size (in bytes) of the cache.
+        """
+        with self._lock:
+            try:
+                entries, size = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning("Could not read the result cache %s: %s", self.path, e)
+                entries, size = 0, 0
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "size_bytes": size,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
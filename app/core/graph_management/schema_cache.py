@@ -0,0 +1,250 @@
+"""
+On-disk cache of the schemas extracted from SPARQL endpoints.
+
+Each endpoint gets its own JSON file in the cache directory. The file name is derived from the
+endpoint URL, the schema extraction options of sparql.ini and the cache format version, so a
+different endpoint or a change of the extraction queries or strategy never reuses a stale schema.
+"""
+
+from __future__ import annotations
+
+import configparser
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+parent_dir = Path(__file__).parent.parent.parent
+sparql_config_path = parent_dir / "config" / "sparql.ini"
+default_cache_dir = parent_dir / "graphs" / "schema_cache"
+
+# Bump when the layout of the cached data changes, older files are then ignored
+SCHEMA_CACHE_FORMAT_VERSION = 1
+
+
+def get_schema_cache_dir() -> Path:
+    """Cache directory, overridable with the METABOT_SCHEMA_CACHE_DIR environment variable."""
+    return Path(os.getenv("METABOT_SCHEMA_CACHE_DIR", default_cache_dir))
+
+
+# Options of sparql.ini determining what is extracted and stored in the cache: the class, property,
+# fingerprint and statistics queries, the excluded URIs and the extraction strategy
+SCHEMA_OPTIONS: Tuple[Tuple[str, str], ...] = (
+    ("sparqlQueries", "CLS_RDF"),
+    ("sparqlQueries", "CLS_REL_RDF"),
+    ("sparqlQueries", "CLS_REL_AGG_RDF"),
+    ("sparqlQueries", "CLS_REL_AGG_SAMPLE_RDF"),
+    ("sparqlQueries", "CLS_FINGERPRINT_RDF"),
+    ("sparqlQueries", "CLS_STATS_RDF"),
+    ("excludedURIs", "uris"),
+    ("schemaExtraction", "strategy"),
+    ("schemaExtraction", "aggregated_chunk_size"),
+)
+
+
+def schema_query_hash(config_path: Path = sparql_config_path) -> str:
+    """
+    Hashes the options of sparql.ini that determine the extracted schema (`SCHEMA_OPTIONS`).
+
+    Args:
+        config_path (Path): Path to sparql.ini.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    digest = hashlib.sha256()
+    for section, option in SCHEMA_OPTIONS:
+        digest.update(config.get(section, option, fallback="").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SchemaCache:
+    """
+    Stores the plain schema data of an `RdfGraph` (see `RdfGraph.to_schema_data`) for one endpoint.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        cache_dir: Optional[Path] = None,
+        config_path: Path = sparql_config_path,
+    ) -> None:
+        self.endpoint_url = endpoint_url
+        self.cache_dir = Path(cache_dir) if cache_dir else get_schema_cache_dir()
+        self.query_hash = schema_query_hash(config_path)
+
+    @property
+    def key(self) -> str:
+        digest = hashlib.sha256(
+            f"{self.endpoint_url}\0{self.query_hash}\0{SCHEMA_CACHE_FORMAT_VERSION}".encode(
+                "utf-8"
+            )
+        )
+        return digest.hexdigest()[:24]
+
+    @property
+    def path(self) -> Path:
+        return self.cache_dir / f"{self.key}.json"
+
+    @property
+    def progress_path(self) -> Path:
+        """Checkpoint file of an extraction in progress for this entry (see `ExtractionProgress`)."""
+        return self.cache_dir / f"{self.key}.progress.jsonl"
+
+    def _is_valid_entry(self, entry: Dict) -> bool:
+        return (
+            entry.get("format_version") == SCHEMA_CACHE_FORMAT_VERSION
+            and entry.get("endpoint") == self.endpoint_url
+            and entry.get("query_hash") == self.query_hash
+            and isinstance(entry.get("data"), dict)
+            and "schema" in entry["data"]
+        )
+
+    def load(self) -> Optional[Dict]:
+        """
+        Returns:
+            Optional[Dict]: The cached schema data, or None if there is no valid cache entry.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable schema cache %s: %s", self.path, e)
+            return None
+
+        if not isinstance(entry, dict) or not self._is_valid_entry(entry):
+            logger.warning("Ignoring outdated schema cache %s", self.path)
+            return None
+
+        logger.info("Loaded schema of %s from %s", self.endpoint_url, self.path)
+        return entry["data"]
+
+    def is_valid(self) -> bool:
+        """Checks whether a valid cache entry exists for the endpoint."""
+        return self.load() is not None
+
+    def save(self, schema_data: Dict) -> Path:
+        """
+        Writes the schema data atomically: the entry is written to a temporary file of the cache
+        directory, then moved over the previous entry, so readers never see a partial file.
+
+        Args:
+            schema_data (Dict): The data returned by `RdfGraph.to_schema_data`.
+
+        Returns:
+            Path: The path of the cache entry.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "format_version": SCHEMA_CACHE_FORMAT_VERSION,
+            "endpoint": self.endpoint_url,
+            "query_hash": self.query_hash,
+            "data": schema_data,
+        }
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=self.cache_dir,
+            prefix=f".{self.key}.",
+            suffix=".tmp",
+            delete=False,
+        ) as temp_file:
+            json.dump(entry, temp_file, ensure_ascii=False)
+            temp_path = Path(temp_file.name)
+        try:
+            temp_path.chmod(0o644)
+            os.replace(temp_path, self.path)
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        logger.info("Saved schema of %s to %s", self.endpoint_url, self.path)
+        return self.path
+
+    def clear(self) -> None:
+        """Removes the cache entry of the endpoint, if any."""
+        self.path.unlink(missing_ok=True)
+
+
+class ExtractionProgress:
+    """
+    Checkpoint file of a schema extraction: one JSON line per class is appended as soon as its
+    properties are retrieved (or its query definitively failed), so that an interrupted extraction
+    resumes at the classes that are still missing instead of starting from zero.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def _append(self, record: Dict) -> None:
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+
+    def record(self, class_uri: str, properties: List[Tuple[str, str]]) -> None:
+        """Saves the properties and value types retrieved for a class."""
+        self._append({"cls": class_uri, "properties": [list(p) for p in properties]})
+
+    def record_failure(self, class_uri: str, error: Exception) -> None:
+        """Saves that the query of a class failed, the class is extracted again on resume."""
+        self._append({"cls": class_uri, "error": str(error)})
+
+    def _records(self) -> List[Dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Line truncated by an interruption while it was written
+                logger.warning("Ignoring invalid line of %s", self.path)
+        return records
+
+    def load(self) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Returns:
+            Dict[str, List[Tuple[str, str]]]: The properties of the classes already extracted, keyed by class URI.
+        """
+        completed: Dict[str, List[Tuple[str, str]]] = {}
+        for record in self._records():
+            if "properties" in record:
+                completed[record["cls"]] = [tuple(p) for p in record["properties"]]
+            else:
+                completed.pop(record.get("cls"), None)
+        return completed
+
+    def failed_classes(self) -> List[str]:
+        """
+        Returns:
+            List[str]: The classes whose last recorded query failed.
+        """
+        failed: Dict[str, bool] = {}
+        for record in self._records():
+            failed[record.get("cls")] = "error" in record
+        return [class_uri for class_uri, is_failed in failed.items() if is_failed]
+
+    def clear(self) -> None:
+        """Removes the checkpoint file, once the extraction is complete."""
+        with self._lock:
+            self.path.unlink(missing_ok=True)
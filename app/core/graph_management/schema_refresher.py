@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import threading
+from typing import List, Optional
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_cache import SchemaCache
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class SchemaRefresher:
+    """
+    Background thread that keeps the schema of a shared `RdfGraph` up to date in long-running processes
+    (Streamlit app, workers). At every interval it reloads the schema cache entry if another process
+    updated it, otherwise it runs `RdfGraph.refresh_schema` and saves the result to the cache.
+    The graph keeps serving its current schema until the new one is swapped in.
+    """
+
+    def __init__(
+        self,
+        graph: RdfGraph,
+        schema_cache: SchemaCache,
+        interval_seconds: float,
+    ) -> None:
+        """
+        Args:
+            graph (RdfGraph): The graph whose schema is refreshed.
+            schema_cache (SchemaCache): The cache entry of the graph's endpoint.
+            interval_seconds (float): Delay between two refreshes.
+        """
+        self.graph = graph
+        self.schema_cache = schema_cache
+        self.interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cache_mtime = self._get_cache_mtime()
+
+    def _get_cache_mtime(self) -> Optional[float]:
+        try:
+            return self.schema_cache.path.stat().st_mtime
+        except OSError:
+            return None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Starts the refresh thread, if it is not already running."""
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="schema-refresher", daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            "Refreshing the schema of %s every %ss",
+            self.graph.query_endpoint,
+            self.interval_seconds,
+        )
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stops the refresh thread, waiting at most `timeout` seconds for a refresh in progress."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                self.refresh_now()
+            except Exception as e:
+                # Keep serving the current schema, the next interval will try again
+                logger.error(f"Schema refresh failed: {e}")
+
+    def refresh_now(self) -> List[str]:
+        """
+        Refreshes the schema once.
+
+        Returns:
+            List[str]: The URIs of the classes that changed, or all the classes when the schema was
+            reloaded from a cache entry written by another process.
+        """
+        cache_mtime = self._get_cache_mtime()
+        if cache_mtime is not None and cache_mtime != self._cache_mtime:
+            schema_data = self.schema_cache.load()
+            if schema_data is not None:
+                self._cache_mtime = cache_mtime
+                if schema_data != self.graph.to_schema_data():
+                    logger.info("Reloading the schema from %s", self.schema_cache.path)
+                    self.graph.restore_schema(schema_data)
+                    return [cl.get("cls") for cl in self.graph.classes]
+
+        updated = self.graph.refresh_schema()
+        if updated:
+            self.schema_cache.save(self.graph.to_schema_data())
+            self._cache_mtime = self._get_cache_mtime()
+        return updated
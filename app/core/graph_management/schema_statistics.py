@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+
+class SchemaStatistics:
+    """
+    Cardinality statistics of the schema classes, collected with the CLS_STATS_RDF query of sparql.ini:
+    the number of instances of each class and, for each property used by these instances, the number
+    of triples, of distinct subjects and of distinct objects.
+
+    Counts per property over all the classes are summed, so they are overestimated for instances
+    having several classes.
+    """
+
+    def __init__(
+        self,
+        class_instances: Optional[Dict[str, int]] = None,
+        property_counts: Optional[Dict[str, Dict[str, Dict[str, int]]]] = None,
+    ) -> None:
+        """
+        Args:
+            class_instances (Optional[Dict[str, int]]): Number of instances, keyed by class URI.
+            property_counts (Optional[Dict[str, Dict[str, Dict[str, int]]]]): The "triples", "subjects"
+                and "objects" counts, keyed by class URI then property URI.
+        """
+        self.class_instances: Dict[str, int] = dict(class_instances or {})
+        self.property_counts: Dict[str, Dict[str, Dict[str, int]]] = {
+            class_uri: dict(counts) for class_uri, counts in (property_counts or {}).items()
+        }
+
+    @staticmethod
+    def _to_int(value: Optional[str]) -> int:
+        try:
+            return int(float(value)) if value not in (None, "") else 0
+        except ValueError:
+            return 0
+
+    def update_class(self, class_uri: str, rows: Iterable[Dict[str, str]]) -> None:
+        """
+        Replaces the statistics of a class with the rows returned by CLS_STATS_RDF for it. The number
+        of instances is the number of distinct subjects of rdf:type.
+
+        Args:
+            class_uri (str): The class URI.
+            rows (Iterable[Dict[str, str]]): Rows with the property, triples, subjects and objects columns.
+        """
+        counts = {
+            str(row.get("property")): {
+                key: self._to_int(row.get(key)) for key in ("triples", "subjects", "objects")
+            }
+            for row in rows
+            if row.get("property")
+        }
+        self.property_counts[class_uri] = counts
+        self.class_instances[class_uri] = counts.get(RDF_TYPE, {}).get("subjects", 0)
+
+    def remove_class(self, class_uri: str) -> None:
+        self.class_instances.pop(class_uri, None)
+        self.property_counts.pop(class_uri, None)
+
+    def get_class_instances(self, class_uri: str) -> Optional[int]:
+        """
+        Returns:
+            Optional[int]: The number of instances of the class, None if it has no statistics.
+        """
+        return self.class_instances.get(class_uri)
+
+    def get_property_counts(
+        self, property_uri: str, class_uri: Optional[str] = None
+    ) -> Optional[Dict[str, int]]:
+        """
+        Args:
+            property_uri (str): The property URI.
+            class_uri (Optional[str]): Restricts the counts to the instances of this class.
+
+        Returns:
+            Optional[Dict[str, int]]: The "triples", "subjects" and "objects" counts of the property,
+            None if no class with statistics uses it.
+        """
+        if class_uri is not None:
+            return self.property_counts.get(class_uri, {}).get(property_uri)
+
+        total: Optional[Dict[str, int]] = None
+        for counts in self.property_counts.values():
+            property_counts = counts.get(property_uri)
+            if property_counts is None:
+                continue
+            total = total or {"triples": 0, "subjects": 0, "objects": 0}
+            for key in total:
+                total[key] += property_counts.get(key, 0)
+        return total
+
+    def largest_properties(self, limit: int = 10) -> List[Tuple[str, str, int]]:
+        """
+        Returns:
+            List[Tuple[str, str, int]]: The (class URI, property URI, number of triples) of the `limit`
+            most used properties, by decreasing number of triples.
+        """
+        triples = [
+            (class_uri, property_uri, counts.get("triples", 0))
+            for class_uri, properties in self.property_counts.items()
+            for property_uri, counts in properties.items()
+            if property_uri != RDF_TYPE
+        ]
+        return sorted(triples, key=lambda item: item[2], reverse=True)[:limit]
+
+    def to_data(self) -> Dict:
+        """Returns the statistics as a JSON-serializable dictionary accepted by `from_data`."""
+        return {
+            "class_instances": dict(sorted(self.class_instances.items())),
+            "property_counts": {
+                class_uri: dict(sorted(counts.items()))
+                for class_uri, counts in sorted(self.property_counts.items())
+            },
+        }
+
+    @classmethod
+    def from_data(cls, data: Dict) -> SchemaStatistics:
+        return cls(data.get("class_instances"), data.get("property_counts"))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, SchemaStatistics) and self.to_data() == other.to_data()
@@ -0,0 +1,370 @@
+from __future__ import annotations
+
+import difflib
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import rdflib
+from rdflib import BNode, Literal, URIRef, Variable
+from rdflib.namespace import NamespaceManager
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.term import Identifier
+
+from app.core.graph_management.schema_statistics import RDF_TYPE
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+UNTYPED = "Untyped"
+XSD_NAMESPACE = "http://www.w3.org/2001/XMLSchema#"
+# Vocabularies used by the queries without being part of the extracted schema
+IGNORED_NAMESPACES = (
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "http://www.w3.org/2000/01/rdf-schema#",
+    "http://www.w3.org/2002/07/owl#",
+)
+
+TriplePattern = Tuple[Identifier, Identifier, Identifier]
+
+
+def _namespace(iri: str) -> str:
+    return re.sub(r"[^/#]*$", "", iri)
+
+
+def _local_name(iri: str) -> str:
+    return re.sub(r"^.*[/#]", "", iri)
+
+
+class SchemaIndex:
+    """
+    In-memory index of the (class, property, value type) triples of the extracted schema, where the
+    value type is a class, an XSD datatype or "Untyped".
+    """
+
+    def __init__(
+        self,
+        triples: Iterable[Tuple[str, str, str]],
+        namespace_manager: Optional[NamespaceManager] = None,
+    ) -> None:
+        """
+        Args:
+            triples (Iterable[Tuple[str, str, str]]): The (class, property, value type) triples.
+            namespace_manager (Optional[NamespaceManager]): Prefixes used to shorten the IRIs of the
+                diagnostics.
+        """
+        self.value_types: Dict[str, Dict[str, Set[str]]] = {}
+        self.classes_by_property: Dict[str, Set[str]] = {}
+        for class_uri, property_uri, value_type in triples:
+            self.value_types.setdefault(class_uri, {}).setdefault(property_uri, set()).add(
+                value_type
+            )
+            self.classes_by_property.setdefault(property_uri, set()).add(class_uri)
+        self.namespaces = {
+            _namespace(iri)
+            for iri in list(self.value_types) + list(self.classes_by_property)
+        }
+        self.namespace_manager = namespace_manager or NamespaceManager(
+            rdflib.Graph(), bind_namespaces="none"
+        )
+
+    @classmethod
+    def from_graph(cls, schema_graph: rdflib.Graph) -> SchemaIndex:
+        """Builds the index of the graph returned by `RdfGraph.get_graph_from_classes`."""
+        return cls(
+            (
+                (str(s), str(p), UNTYPED if isinstance(o, BNode) else str(o))
+                for s, p, o in schema_graph
+            ),
+            schema_graph.namespace_manager,
+        )
+
+    @staticmethod
+    def is_class_type(value_type: str) -> bool:
+        """Whether a value type is a class, as opposed to a datatype or "Untyped"."""
+        return value_type != UNTYPED and not value_type.startswith(XSD_NAMESPACE)
+
+    def is_known_property(self, property_uri: str) -> bool:
+        return property_uri in self.classes_by_property
+
+    def properties_of(self, class_uri: str) -> Dict[str, Set[str]]:
+        """
+        Returns:
+            Dict[str, Set[str]]: The value types of the properties of the class, keyed by property URI.
+        """
+        return self.value_types.get(class_uri, {})
+
+    def classes_with(self, property_uri: str) -> Set[str]:
+        return self.classes_by_property.get(property_uri, set())
+
+    def targets(self, class_uris: Iterable[str], property_uri: str) -> Set[str]:
+        """
+        Returns:
+            Set[str]: The classes of the values of the property for instances of the classes.
+        """
+        return {
+            value_type
+            for class_uri in class_uris
+            for value_type in self.properties_of(class_uri).get(property_uri, ())
+            if self.is_class_type(value_type)
+        }
+
+    def shorten(self, term: Identifier) -> str:
+        """Returns the term as in a query, with a prefix when one is bound for its namespace."""
+        try:
+            return term.n3(self.namespace_manager)
+        except Exception:
+            return term.n3()
+
+
+class SchemaDiagnostic:
+    """A triple pattern of a query that does not match the schema."""
+
+    # Codes of the diagnostics
+    UNKNOWN_PROPERTY = "unknown_property"
+    PROPERTY_NOT_ON_CLASS = "property_not_on_class"
+    INCOMPATIBLE_PROPERTIES = "incompatible_properties"
+    IRI_AS_SUBJECT = "iri_as_subject"
+    LITERAL_FOR_CLASS = "literal_for_class"
+    IRI_FOR_LITERAL = "iri_for_literal"
+    # Codes that may only mean that the property was missing from the instances sampled by the
+    # schema extraction, the queries with no other diagnostics are still sent
+    WARNING_CODES = frozenset({UNKNOWN_PROPERTY, PROPERTY_NOT_ON_CLASS})
+
+    def __init__(
+        self,
+        code: str,
+        message: str,
+        pattern: TriplePattern,
+        suggestions: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Args:
+            code (str): One of the codes above.
+            message (str): Description of the error, for the logs and the LLM.
+            pattern (TriplePattern): The subject, predicate and object of the pattern.
+            suggestions (Optional[List[str]]): Properties or classes of the schema that may be meant.
+        """
+        self.code = code
+        self.message = message
+        self.pattern = pattern
+        self.suggestions = suggestions or []
+
+    @property
+    def is_warning(self) -> bool:
+        return self.code in self.WARNING_CODES
+
+    def to_dict(self) -> Dict:
+        return {
+            "code": self.code,
+            "message": self.message,
+            "pattern": [term.n3() for term in self.pattern],
+            "suggestions": self.suggestions,
+        }
+
+    def __repr__(self) -> str:
+        return f"SchemaDiagnostic({self.code!r}, {self.message!r})"
+
+
+def _is_variable(term: Identifier) -> bool:
+    return isinstance(term, (Variable, BNode))
+
+
+def collect_basic_graph_patterns(node, bgps: Optional[List] = None) -> List:
+    """
+    Returns:
+        List: The BGP nodes of the algebra of a query, except those sent to other endpoints with SERVICE.
+    """
+    bgps = [] if bgps is None else bgps
+    name = getattr(node, "name", None)
+    if name == "ServiceGraphPattern":
+        return bgps
+    if name == "BGP":
+        bgps.append(node)
+    if isinstance(node, dict):
+        for value in node.values():
+            collect_basic_graph_patterns(value, bgps)
+    elif isinstance(node, list):
+        for value in node:
+            collect_basic_graph_patterns(value, bgps)
+    return bgps
+
+
+def infer_classes(
+    patterns: List[TriplePattern], index: SchemaIndex
+) -> Tuple[Dict[Identifier, Set[str]], Dict[Identifier, Set[str]]]:
+    """
+    Infers the possible classes of the subjects and objects of the patterns: from their rdf:type
+    patterns, then from the value types of the properties linking them to typed nodes, and for the
+    nodes still untyped from the classes having all the properties used on them.
+
+    Returns:
+        Tuple[Dict[Identifier, Set[str]], Dict[Identifier, Set[str]]]: The classes given by rdf:type
+        or by the value types, and the classes inferred from the properties used on the node.
+    """
+    classes: Dict[Identifier, Set[str]] = {}
+    for subject, predicate, obj in patterns:
+        if str(predicate) == RDF_TYPE and isinstance(obj, URIRef):
+            classes.setdefault(subject, set()).add(str(obj))
+
+    properties_by_subject: Dict[Identifier, List[str]] = {}
+    for subject, predicate, _ in patterns:
+        if isinstance(predicate, URIRef) and index.is_known_property(str(predicate)):
+            properties_by_subject.setdefault(subject, []).append(str(predicate))
+    domains: Dict[Identifier, Set[str]] = {}
+    for subject, properties in properties_by_subject.items():
+        candidates = set.intersection(*(index.classes_with(p) for p in properties))
+        domains[subject] = candidates
+
+    explicit = set(classes)
+    for _ in range(len(patterns) + 1):
+        changed = False
+        for subject, predicate, obj in patterns:
+            if not _is_variable(obj) or obj in explicit or str(predicate) == RDF_TYPE:
+                continue
+            subject_classes = classes.get(subject) or domains.get(subject, set())
+            targets = index.targets(subject_classes, str(predicate))
+            if targets - classes.get(obj, set()):
+                classes.setdefault(obj, set()).update(targets)
+                changed = True
+        if not changed:
+            break
+    return classes, domains
+
+
+def validate_patterns(patterns: List[TriplePattern], index: SchemaIndex) -> List[SchemaDiagnostic]:
+    """
+    Checks triple patterns against the schema index.
+
+    Args:
+        patterns (List[TriplePattern]): The patterns of a query.
+        index (SchemaIndex): The schema index.
+
+    Returns:
+        List[SchemaDiagnostic]: One diagnostic per error found, empty if the patterns match the schema.
+    """
+    classes, domains = infer_classes(patterns, index)
+    diagnostics: List[SchemaDiagnostic] = []
+    reported_subjects: Set[Identifier] = set()
+    known_properties = list(index.classes_by_property)
+
+    for pattern in patterns:
+        subject, predicate, obj = pattern
+        text = " ".join(index.shorten(term) for term in pattern)
+        if not isinstance(predicate, URIRef) or str(predicate) == RDF_TYPE:
+            continue
+        property_uri = str(predicate)
+
+        if isinstance(subject, URIRef) and (
+            _namespace(str(subject)) not in index.namespaces or str(subject) in index.value_types
+        ):
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.IRI_AS_SUBJECT,
+                    f"{index.shorten(subject)} is used as the subject of {text}, but it is an "
+                    "entity or class IRI that can only be used as an object.",
+                    pattern,
+                )
+            )
+
+        if not index.is_known_property(property_uri):
+            if property_uri.startswith(IGNORED_NAMESPACES):
+                continue
+            similar = difflib.get_close_matches(
+                _local_name(property_uri),
+                [_local_name(p) for p in known_properties],
+                n=3,
+            )
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.UNKNOWN_PROPERTY,
+                    f"{index.shorten(predicate)} in {text} is not a property of the schema.",
+                    pattern,
+                    [p for name in similar for p in known_properties if _local_name(p) == name],
+                )
+            )
+            continue
+
+        subject_classes = classes.get(subject, set())
+        owners = index.classes_with(property_uri)
+        if subject_classes and not subject_classes & owners:
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.PROPERTY_NOT_ON_CLASS,
+                    f"{index.shorten(predicate)} in {text} is not a property of "
+                    f"{', '.join(sorted(index.shorten(URIRef(c)) for c in subject_classes))}, "
+                    f"only of {', '.join(sorted(index.shorten(URIRef(c)) for c in owners))}.",
+                    pattern,
+                    sorted(owners),
+                )
+            )
+            continue
+        if not subject_classes and not domains.get(subject) and subject not in reported_subjects:
+            reported_subjects.add(subject)
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.INCOMPATIBLE_PROPERTIES,
+                    f"No class of the schema has all the properties used on {index.shorten(subject)}.",
+                    pattern,
+                )
+            )
+            continue
+
+        value_types = {
+            value_type
+            for class_uri in (subject_classes & owners or owners)
+            for value_type in index.properties_of(class_uri).get(property_uri, ())
+        }
+        if UNTYPED in value_types or not value_types:
+            continue
+        if isinstance(obj, Literal) and all(index.is_class_type(v) for v in value_types):
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.LITERAL_FOR_CLASS,
+                    f"The object of {text} is a literal, but the values of "
+                    f"{index.shorten(predicate)} are IRIs of "
+                    f"{', '.join(sorted(index.shorten(URIRef(v)) for v in value_types))}.",
+                    pattern,
+                    sorted(value_types),
+                )
+            )
+        elif isinstance(obj, URIRef) and not any(index.is_class_type(v) for v in value_types):
+            diagnostics.append(
+                SchemaDiagnostic(
+                    SchemaDiagnostic.IRI_FOR_LITERAL,
+                    f"The object of {text} is an IRI, but the values of "
+                    f"{index.shorten(predicate)} are literals.",
+                    pattern,
+                    sorted(value_types),
+                )
+            )
+    return diagnostics
+
+
+def validate_query(query: str, index: SchemaIndex) -> List[SchemaDiagnostic]:
+    """
+    Parses a query and checks its triple patterns against the schema index, without sending it:
+    properties missing from the schema, properties used on nodes of a class that does not have them,
+    properties of different classes used on the same node, IRIs used as subjects, and literals or
+    IRIs used as values of the wrong kind. The patterns of SERVICE clauses are not checked. The rdflib
+    parser is not thread-safe, callers running concurrently must hold `sparql_parser_lock`.
+
+    Args:
+        query (str): The SPARQL query.
+        index (SchemaIndex): The schema index.
+
+    Returns:
+        List[SchemaDiagnostic]: The errors found, empty if the query matches the schema or rdflib
+        cannot parse it (the endpoint reports the syntax errors).
+    """
+    try:
+        parsed = translateQuery(parseQuery(query))
+    except Exception as e:
+        logger.debug("The query is not validated against the schema: %s", e)
+        return []
+    patterns = [
+        pattern
+        for bgp in collect_basic_graph_patterns(parsed.algebra)
+        for pattern in bgp.triples
+    ]
+    return validate_patterns(patterns, index)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from app.core.graph_management.sparql_store import QueryCancellation, SparqlTimeoutError
+
+T = TypeVar("T")
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters: List[threading.Event] = []
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function and the
+    callers arriving while it runs wait for its result instead of running it again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        # Number of calls that received the result of another call
+        self.shared_calls = 0
+
+    def do(
+        self,
+        key: Hashable,
+        function: Callable[[], T],
+        deadline: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Tuple[T, bool]:
+        """
+        Runs `function`, or waits for the call of another thread with the same key.
+
+        Args:
+            key (Hashable): Identifies the equivalent calls.
+            function (Callable[[], T]): The call to run.
+            deadline (Optional[float]): `time.monotonic()` value after which waiting for another thread times out.
+            cancellation (Optional[QueryCancellation]): Token to stop waiting for another thread.
+
+        Returns:
+            Tuple[T, bool]: The result of the call, and whether it was run by another thread.
+
+        Raises:
+            SparqlTimeoutError: If the deadline passes while waiting for another thread.
+            SparqlQueryCancelled: If the token is cancelled while waiting for another thread.
+            Exception: The error raised by `function`, in every waiting thread.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                wake = threading.Event()
+                call.waiters.append(wake)
+                self.shared_calls += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = function()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    call.done = True
+                    waiters = list(call.waiters)
+                for waiter in waiters:
+                    waiter.set()
+            return call.result, False
+
+        if cancellation is not None:
+            cancellation.wait_until(wake, lambda: call.done, deadline)
+        else:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not wake.wait(timeout):
+                raise SparqlTimeoutError("The query did not complete before its deadline.")
+        if call.error is not None:
+            raise call.error
+        return call.result, True
@@ -0,0 +1,559 @@
+from __future__ import annotations
+
+import socket
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.exceptions import ReadTimeoutError
+from rdflib.plugins.stores import sparqlstore
+from rdflib.plugins.stores.sparqlconnector import SPARQLConnectorException
+from rdflib.query import Result
+from rdflib.term import BNode
+
+from app.core.session import setup_logger
+
+logger = setup_logger(__name__)
+
+
+# SPARQL result formats, in the order in which rdflib parses them fastest
+RESULT_MIME_TYPES = {
+    "csv": "text/csv",
+    "json": "application/sparql-results+json",
+    "xml": "application/sparql-results+xml",
+    "tsv": "text/tab-separated-values",
+}
+
+# Longer queries are sent in the body of a POST request instead of the URL
+MAX_GET_QUERY_LENGTH = 2000
+
+# HTTP statuses of errors that may not happen again if the query is retried
+TRANSIENT_HTTP_STATUSES = (429, 502, 503, 504)
+
+T = TypeVar("T")
+
+
+class SparqlQueryError(ValueError):
+    """Failure of a SPARQL query. `transient` tells whether the same query may succeed if retried."""
+
+    transient = False
+
+
+class SparqlSyntaxError(SparqlQueryError):
+    """The query is invalid, rejected by the endpoint or by the rdflib parser."""
+
+
+class SparqlTimeoutError(SparqlQueryError):
+    """The query did not complete before its deadline."""
+
+
+class SparqlServerError(SparqlQueryError):
+    """The endpoint failed to answer: server error, overloaded endpoint or connection failure."""
+
+    def __init__(self, message: str, transient: bool = False) -> None:
+        super().__init__(message)
+        self.transient = transient
+
+
+class SparqlQueryCancelled(SparqlQueryError):
+    """The query was cancelled with `QueryCancellation.cancel`."""
+
+
+class SparqlQueryRejected(SparqlQueryError):
+    """Too many queries are running or waiting for the endpoint, see `AdmissionController`."""
+
+
+# Runs the queries that can be cancelled when no executor is given, so that the caller can stop
+# waiting for them. `AdmissionController.executor` is used for the endpoints with admission control
+_cancellable_executor = ThreadPoolExecutor(thread_name_prefix="sparql-query")
+
+# `_RunningQuery` of the query run by the current worker thread of `QueryCancellation.run`
+_running_query = threading.local()
+
+
+class _RunningQuery:
+    """
+    Sockets of the HTTP requests of a query run in a worker thread. They are shut down when the
+    caller gives up on the query, so that the worker stops waiting for the endpoint at once.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sockets = set()
+        self.aborted = False
+
+    def track(self, sock: socket.socket) -> None:
+        with self._lock:
+            if not self.aborted:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+    def release(self) -> None:
+        """Stops tracking the sockets, before their connections go back to the pool."""
+        with self._lock:
+            self._sockets.clear()
+
+    def abort(self) -> None:
+        with self._lock:
+            self.aborted = True
+            sockets = list(self._sockets)
+            self._sockets.clear()
+        for sock in sockets:
+            _shutdown(sock)
+
+
+def _shutdown(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError as e:
+        logger.debug("Error while shutting down the socket of an abandoned query: %s", e)
+
+
+def _release_running_query() -> None:
+    running = getattr(_running_query, "value", None)
+    if running is not None:
+        running.release()
+
+
+class _TrackedHTTPConnection(HTTPConnection):
+    """Connection registering its socket with the `_RunningQuery` of the thread waiting for the response."""
+
+    def getresponse(self, *args: Any, **kwargs: Any) -> Any:
+        running = getattr(_running_query, "value", None)
+        if running is not None and self.sock is not None:
+            running.track(self.sock)
+        return super().getresponse(*args, **kwargs)
+
+
+class _TrackedHTTPSConnection(_TrackedHTTPConnection, HTTPSConnection):
+    pass
+
+
+class _TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+
+class _TrackedHTTPAdapter(HTTPAdapter):
+    """Adapter whose connections can be shut down by `_RunningQuery.abort`."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TrackedHTTPConnectionPool,
+            "https": _TrackedHTTPSConnectionPool,
+        }
+
+
+class QueryCancellation:
+    """
+    Token to cancel the queries it is passed to from another thread, e.g. when the user aborts a
+    question. Cancelling makes the waiting queries raise `SparqlQueryCancelled` at once and closes
+    their HTTP responses and connections, which stops sending them and reading their results.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._responses = set()
+        self._waiters = set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """Cancels the queries in progress and the next queries using this token."""
+        self._event.set()
+        with self._lock:
+            responses = list(self._responses)
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.set()
+        for response in responses:
+            try:
+                response.close()
+            except Exception as e:
+                logger.debug("Error while closing a cancelled response: %s", e)
+
+    def wait(self, timeout: float) -> bool:
+        """Waits at most `timeout` seconds for the cancellation, returns whether it was cancelled."""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self) -> None:
+        if self.is_cancelled:
+            raise SparqlQueryCancelled("The query was cancelled.")
+
+    @contextmanager
+    def _track(self, response: requests.Response) -> Iterator[None]:
+        with self._lock:
+            self._responses.add(response)
+        try:
+            self.raise_if_cancelled()
+            yield
+        finally:
+            with self._lock:
+                self._responses.discard(response)
+
+    def run(
+        self,
+        function: Callable[[], T],
+        deadline: Optional[float] = None,
+        executor: Optional[Executor] = None,
+    ) -> T:
+        """
+        Runs `function` in a worker thread and waits for its result until the deadline or the
+        cancellation, whichever comes first. When the caller gives up, the connections of the
+        requests sent by `function` are shut down, so that the worker thread stops too.
+
+        Args:
+            function (Callable[[], T]): The query to run.
+            deadline (Optional[float]): `time.monotonic()` value after which the query times out.
+            executor (Optional[Executor]): Executor of the worker threads, a process-wide one by default.
+
+        Returns:
+            T: The value returned by `function`.
+
+        Raises:
+            SparqlQueryCancelled: If the token is cancelled before `function` returns.
+            SparqlTimeoutError: If the deadline passes before `function` returns.
+        """
+        self.raise_if_cancelled()
+        running = _RunningQuery()
+
+        def call() -> T:
+            _running_query.value = running
+            try:
+                return function()
+            finally:
+                _running_query.value = None
+
+        done = threading.Event()
+        future = (executor or _cancellable_executor).submit(call)
+        future.add_done_callback(lambda _: done.set())
+        try:
+            self.wait_until(done, future.done, deadline)
+        except BaseException:
+            # Also on KeyboardInterrupt, so that the worker thread does not keep the query running
+            future.cancel()
+            running.abort()
+            raise
+        return future.result()
+
+    def wait_until(
+        self,
+        wake: threading.Event,
+        is_done: Callable[[], bool],
+        deadline: Optional[float] = None,
+    ) -> None:
+        """
+        Waits until `wake` is set by the completion of an operation, the deadline or the cancellation,
+        whichever comes first. `wake` must not be shared with other waiters, since cancelling sets it.
+
+        Args:
+            wake (threading.Event): Event set when the operation completes.
+            is_done (Callable[[], bool]): Tells whether the operation completed.
+            deadline (Optional[float]): `time.monotonic()` value after which the wait times out.
+
+        Raises:
+            SparqlQueryCancelled: If the token is cancelled before the operation completes.
+            SparqlTimeoutError: If the deadline passes before the operation completes.
+        """
+        with self._lock:
+            self._waiters.add(wake)
+        try:
+            self.raise_if_cancelled()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            wake.wait(timeout)
+            if is_done():
+                return
+            self.raise_if_cancelled()
+            raise SparqlTimeoutError("The query did not complete before its deadline.")
+        finally:
+            with self._lock:
+                self._waiters.discard(wake)
+
+
+class _GuardedStream:
+    """Response body that raises when the query deadline passes or the query is cancelled while it is read."""
+
+    def __init__(
+        self,
+        raw: Any,
+        deadline: Optional[float],
+        cancellation: Optional[QueryCancellation],
+    ) -> None:
+        self._raw = raw
+        self._deadline = deadline
+        self._cancellation = cancellation
+
+    def read(self, size: int = -1) -> bytes:
+        if self._cancellation is not None:
+            self._cancellation.raise_if_cancelled()
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise SparqlTimeoutError("The query did not complete before its deadline.")
+        try:
+            return self._raw.read() if size is None or size < 0 else self._raw.read(size)
+        except ReadTimeoutError as e:
+            raise SparqlTimeoutError(f"The endpoint stopped sending the result: {e}")
+        except (Urllib3HTTPError, OSError) as e:
+            if self._cancellation is not None:
+                self._cancellation.raise_if_cancelled()
+            raise SparqlServerError(f"The result could not be read: {e}", transient=True)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._raw, name)
+
+
+# One HTTP session per endpoint host, shared by every store of the process
+_endpoint_sessions: Dict[str, requests.Session] = {}
+_endpoint_sessions_lock = threading.Lock()
+
+
+def get_endpoint_session(
+    endpoint_url: str, pool_size: int = 10, pool_block: bool = True
+) -> requests.Session:
+    """
+    Returns the HTTP session shared by all the queries sent to the host of `endpoint_url`. Its
+    connection pool keeps up to `pool_size` connections alive, so that queries reuse an open
+    connection (and its TLS session) instead of connecting again.
+
+    The pool settings are those of the first call for a host.
+
+    Args:
+        endpoint_url (str): URL of the SPARQL endpoint.
+        pool_size (int): Maximum number of connections kept open to the host.
+        pool_block (bool): Whether queries wait for a free connection when `pool_size` connections are
+            in use, instead of opening extra connections that are closed after the query.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    parts = urlsplit(endpoint_url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _endpoint_sessions_lock:
+        session = _endpoint_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = _TrackedHTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, pool_block=pool_block
+            )
+            session.mount(f"{parts.scheme}://", adapter)
+            session.headers["Connection"] = "keep-alive"
+            _endpoint_sessions[key] = session
+            logger.info(
+                "Created HTTP connection pool of %s connections for %s", pool_size, key
+            )
+        return session
+
+
+def close_endpoint_sessions() -> None:
+    """Closes the shared sessions and their open connections."""
+    with _endpoint_sessions_lock:
+        for session in _endpoint_sessions.values():
+            session.close()
+        _endpoint_sessions.clear()
+
+
+def build_accept_header(result_formats: Sequence[str]) -> str:
+    """
+    Builds an Accept header listing the result formats by decreasing preference.
+
+    Args:
+        result_formats (Sequence[str]): Format names, keys of RESULT_MIME_TYPES.
+
+    Returns:
+        str: The header value, e.g. "text/csv, application/sparql-results+json;q=0.9".
+    """
+    parts = []
+    for rank, result_format in enumerate(result_formats):
+        mime_type = RESULT_MIME_TYPES[result_format]
+        quality = max(0.1, 1 - rank / 10)
+        parts.append(mime_type if rank == 0 else f"{mime_type};q={quality:.1f}")
+    return ", ".join(parts)
+
+
+class NegotiatingSPARQLStore(sparqlstore.SPARQLStore):
+    """
+    Read-only SPARQL store that lets the endpoint pick the fastest result format to parse among
+    `result_formats`, requests compressed responses, and parses the response while it is downloaded
+    instead of reading it into memory first.
+
+    The CSV format is the fastest to parse but does not keep literal datatypes, which is fine for
+    `RdfGraph.query` since it converts every value to a string.
+
+    Requests go through the session shared by all the stores of the endpoint host (see
+    `get_endpoint_session`), the credentials being sent with each request.
+    """
+
+    def __init__(
+        self,
+        query_endpoint: Optional[str] = None,
+        result_formats: Sequence[str] = ("csv", "json", "xml"),
+        auth: Optional[tuple] = None,
+        pool_size: int = 10,
+        pool_block: bool = True,
+        connect_timeout_seconds: float = 10.0,
+        **kwargs: Any,
+    ) -> None:
+        unknown_formats = [f for f in result_formats if f not in RESULT_MIME_TYPES]
+        if unknown_formats or not result_formats:
+            raise ValueError(
+                f"Invalid result formats {list(result_formats)}. Supported formats are: {list(RESULT_MIME_TYPES)}."
+            )
+        super().__init__(query_endpoint=query_endpoint, auth=auth, **kwargs)
+        self.result_formats = list(result_formats)
+        self.accept_header = build_accept_header(self.result_formats)
+        self.negotiated_format: Optional[str] = None
+        self.pool_size = pool_size
+        self.pool_block = pool_block
+        self.connect_timeout_seconds = connect_timeout_seconds
+        # Deadline and cancellation of the query being sent by each thread, see `query_options`
+        self._options = threading.local()
+
+    @contextmanager
+    def query_options(
+        self,
+        deadline: Optional[float] = None,
+        cancellation: Optional[QueryCancellation] = None,
+    ) -> Iterator[None]:
+        """
+        Sets the deadline and the cancellation token of the queries sent by the current thread
+        within the context. rdflib's `Graph.query` does not forward options to the store.
+
+        Args:
+            deadline (Optional[float]): `time.monotonic()` value after which the queries time out.
+            cancellation (Optional[QueryCancellation]): Token to cancel the queries.
+        """
+        previous = getattr(self._options, "value", (None, None))
+        self._options.value = (deadline, cancellation)
+        try:
+            yield
+        finally:
+            self._options.value = previous
+
+    @property
+    def session(self) -> requests.Session:
+        return get_endpoint_session(self.query_endpoint, self.pool_size, self.pool_block)
+
+    def _send(
+        self,
+        params: Dict[str, str],
+        headers: Dict[str, str],
+        deadline: Optional[float],
+    ) -> requests.Response:
+        # The read timeout bounds the wait for the response headers, the body is guarded by `_GuardedStream`
+        read_timeout = None
+        if deadline is not None:
+            read_timeout = deadline - time.monotonic()
+            if read_timeout <= 0:
+                raise SparqlTimeoutError("The query deadline passed before it was sent.")
+        timeout = (min(self.connect_timeout_seconds, read_timeout or float("inf")), read_timeout)
+
+        try:
+            if len(params["query"]) > MAX_GET_QUERY_LENGTH:
+                return self.session.post(
+                    self.query_endpoint,
+                    data=params,
+                    headers=headers,
+                    stream=True,
+                    timeout=timeout,
+                )
+            return self.session.get(
+                self.query_endpoint,
+                params=params,
+                headers=headers,
+                stream=True,
+                timeout=timeout,
+            )
+        except requests.exceptions.ConnectTimeout as e:
+            raise SparqlServerError(
+                f"Could not connect to {self.query_endpoint}: {e}", transient=True
+            )
+        except requests.exceptions.Timeout as e:
+            raise SparqlTimeoutError(f"The endpoint did not answer before the deadline: {e}")
+        except requests.exceptions.RequestException as e:
+            raise SparqlServerError(
+                f"Could not query {self.query_endpoint}: {e}", transient=True
+            )
+
+    @staticmethod
+    def _raise_for_status(response: requests.Response) -> None:
+        if response.ok:
+            return
+        message = f"{response.status_code} {response.reason}: {response.text[:1000]}"
+        if response.status_code == 400:
+            raise SparqlSyntaxError(f"Generated SPARQL statement is invalid\n{message}")
+        if response.status_code == 408:
+            raise SparqlTimeoutError(message)
+        if response.status_code in TRANSIENT_HTTP_STATUSES or response.status_code >= 500:
+            raise SparqlServerError(
+                message, transient=response.status_code in TRANSIENT_HTTP_STATUSES
+            )
+        raise SparqlQueryError(message)
+
+    def _query(
+        self,
+        query: str,
+        default_graph: Optional[str] = None,
+        named_graph: Optional[str] = None,
+    ) -> Result:
+        if not self.query_endpoint:
+            raise SPARQLConnectorException("Query endpoint not set!")
+        deadline, cancellation = getattr(self._options, "value", (None, None))
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        self._queries += 1
+
+        params = {"query": query}
+        # avoid a useless (BNode) default graph URI, which calls to Graph().query() will add
+        if default_graph is not None and not isinstance(default_graph, BNode):
+            params["default-graph-uri"] = default_graph
+
+        headers = dict(self.kwargs.get("headers", {}))
+        headers.update({"Accept": self.accept_header, "Accept-Encoding": "gzip, deflate"})
+
+        try:
+            response = self._send(params, headers, deadline)
+        except SparqlQueryError:
+            _release_running_query()
+            raise
+        try:
+            if cancellation is not None:
+                cancellation.raise_if_cancelled()
+            self._raise_for_status(response)
+
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            result_format = next(
+                (f for f, mime in RESULT_MIME_TYPES.items() if mime == content_type),
+                content_type,
+            )
+            if result_format != self.negotiated_format:
+                logger.info(
+                    "Endpoint %s returns results as %s", self.query_endpoint, result_format
+                )
+                self.negotiated_format = result_format
+
+            # Decompress and parse the body as it arrives
+            response.raw.decode_content = True
+            body = _GuardedStream(response.raw, deadline, cancellation)
+            if cancellation is None:
+                return Result.parse(body, content_type=content_type)
+            with cancellation._track(response):
+                return Result.parse(body, content_type=content_type)
+        finally:
+            # Returns the connection to the pool once the body has been read
+            _release_running_query()
+            response.close()
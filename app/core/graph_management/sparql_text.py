@@ -0,0 +1,271 @@
+"""
+Triple patterns of SPARQL queries located in the text of the query.
+
+Writing a query back from the rdflib SPARQL algebra (`translateAlgebra`) does not give an equivalent
+query for every construct (a FILTER on a BIND variable, HAVING, GROUP_CONCAT) and expands the
+prefixed names. The query rewrites edit the triple patterns in the text instead, keeping the rest of
+the query as it was written.
+
+Only the simple triple patterns are located: three terms (variable, IRI, prefixed name, literal or
+`a`) ended by a dot or by the end of their group. Patterns using `;`, `,`, property paths or blank
+node brackets are left where they are, and end the run of patterns that can be reordered.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from rdflib import RDF, Literal, URIRef, Variable
+from rdflib.term import BNode, Identifier
+from rdflib.util import from_n3
+
+TriplePattern = Tuple[Identifier, Identifier, Identifier]
+
+_TOKEN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    | (?P<literal>
+        (?:\"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+        | '''(?:[^'\\]|\\.|'(?!''))*'''
+        | "(?:[^"\\\n]|\\.)*"
+        | '(?:[^'\\\n]|\\.)*')
+        (?:@[A-Za-z]+(?:-[A-Za-z0-9]+)*
+        | \^\^(?:<[^<>"{}|^`\\\s]*>|(?:[A-Za-z](?:[\w.-]*[\w-])?)?:[\w%-]*(?:\.[\w%-]+)*))?)
+    | (?P<iri><[^<>"{}|^`\\\s]*>)
+    | (?P<variable>[?$]\w+)
+    | (?P<number>(?:\d*\.\d+|\d+)(?:[eE][+-]?\d+)?)
+    | (?P<pname>(?:[A-Za-z](?:[\w.-]*[\w-])?)?:[\w%:-]*(?:\.[\w%:-]+)*|_:\w+(?:\.\w+)*)
+    | (?P<word>[A-Za-z_]\w*)
+    | (?P<punctuation>[{}()\[\].;,])
+    | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_TERM_KINDS = ("literal", "iri", "variable", "number", "pname")
+_OPEN = {"(": ")", "[": "]"}
+
+
+class Token:
+    def __init__(self, kind: str, text: str, start: int) -> None:
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = start + len(text)
+
+    @property
+    def is_term(self) -> bool:
+        return self.kind in _TERM_KINDS or (
+            self.kind == "word" and self.text in ("a", "true", "false")
+        )
+
+    def keyword(self) -> str:
+        return self.text.upper() if self.kind == "word" else ""
+
+    def __repr__(self) -> str:
+        return f"Token({self.kind}, {self.text!r})"
+
+
+def tokenize(query: str) -> List[Token]:
+    """
+    Returns:
+        List[Token]: The tokens of the query, without the whitespace and the comments.
+    """
+    return [
+        Token(match.lastgroup, match.group(), match.start())
+        for match in _TOKEN.finditer(query)
+        if match.lastgroup != "space"
+    ]
+
+
+def prefixes(tokens: List[Token]) -> Dict[str, str]:
+    """
+    Returns:
+        Dict[str, str]: The namespace of each prefix declared by the query.
+    """
+    declared = {}
+    for first, second, third in zip(tokens, tokens[1:], tokens[2:]):
+        if first.keyword() == "PREFIX" and second.kind == "pname" and third.kind == "iri":
+            declared[second.text[:-1]] = third.text[1:-1]
+    return declared
+
+
+def to_term(token: Token, namespaces: Dict[str, str]) -> Identifier:
+    """Converts a term token to the rdflib term of the algebra of the query."""
+    if token.kind == "variable":
+        return Variable(token.text[1:])
+    if token.kind == "iri":
+        return URIRef(token.text[1:-1])
+    if token.kind == "pname":
+        if token.text.startswith("_:"):
+            return BNode(token.text[2:])
+        prefix, local = token.text.split(":", 1)
+        return URIRef(namespaces.get(prefix, f"{prefix}:") + local)
+    if token.text == "a":
+        return RDF.type
+    try:
+        return from_n3(token.text)
+    except Exception:
+        return Literal(token.text)
+
+
+class TextTriple:
+    """A simple triple pattern of a query, with the position of its text."""
+
+    def __init__(
+        self, tokens: List[Token], terminator: Optional[Token], namespaces: Dict[str, str]
+    ) -> None:
+        self.tokens = tokens
+        self.pattern: TriplePattern = tuple(to_term(token, namespaces) for token in tokens)
+        # Text of the three terms, without the dot ending the pattern
+        self.start = tokens[0].start
+        self.end = tokens[-1].end
+        self.terminator = terminator
+
+    def __repr__(self) -> str:
+        return f"TextTriple({' '.join(token.text for token in self.tokens)})"
+
+
+class _Group:
+    """Direct elements of a group graph pattern: tokens, and nested groups or bracketed tokens."""
+
+    def __init__(self, is_data: bool = False) -> None:
+        self.elements: List = []
+        self.is_data = is_data
+
+
+def _groups(tokens: List[Token]) -> Optional[List[_Group]]:
+    """
+    Splits the tokens into their groups, None if the braces or brackets are unbalanced or a group is
+    written inside brackets (e.g. `FILTER (EXISTS { ... })`).
+    """
+    groups: List[_Group] = []
+    stack: List[_Group] = []
+    brackets: List[str] = []
+    top = _Group()
+    for token in tokens:
+        current = stack[-1] if stack else top
+        if brackets:
+            if token.text in _OPEN:
+                brackets.append(_OPEN[token.text])
+            elif token.text in (")", "]"):
+                if token.text != brackets.pop():
+                    return None
+            elif token.text in ("{", "}"):
+                # Groups inside brackets, e.g. EXISTS { ... } in a FILTER, are not rewritten
+                return None
+            continue
+        if token.text in _OPEN:
+            brackets.append(_OPEN[token.text])
+            current.elements.append(None)
+        elif token.text in (")", "]"):
+            return None
+        elif token.text == "{":
+            is_data = current.is_data or any(
+                isinstance(e, Token) and e.keyword() == "VALUES" for e in current.elements[-2:]
+            )
+            group = _Group(is_data)
+            current.elements.append(group)
+            groups.append(group)
+            stack.append(group)
+        elif token.text == "}":
+            if not stack:
+                return None
+            stack.pop()
+        else:
+            current.elements.append(token)
+    if stack or brackets:
+        return None
+    return groups
+
+
+def triple_runs(query: str) -> Optional[List[List[TextTriple]]]:
+    """
+    Finds the runs of consecutive simple triple patterns of a query: the patterns of a run belong to
+    the same basic graph pattern, with nothing written between them.
+
+    Args:
+        query (str): The SPARQL query.
+
+    Returns:
+        Optional[List[List[TextTriple]]]: The runs, in the order of the text, None if the braces or
+        brackets of the query are unbalanced or a group is written inside brackets.
+    """
+    tokens = tokenize(query)
+    groups = _groups(tokens)
+    if groups is None:
+        return None
+    namespaces = prefixes(tokens)
+    runs: List[List[TextTriple]] = []
+    for group in groups:
+        elements = group.elements
+        first = elements[0] if elements else None
+        if group.is_data or (isinstance(first, Token) and first.keyword() == "SELECT"):
+            # VALUES data, or a subquery whose patterns are in its WHERE group
+            continue
+        run: List[TextTriple] = []
+        position = 0
+        while position < len(elements):
+            terms = elements[position : position + 3]
+            after = elements[position + 3] if position + 3 < len(elements) else None
+            is_triple = (
+                len(terms) == 3
+                and all(isinstance(e, Token) and e.is_term for e in terms)
+                and (after is None or (isinstance(after, Token) and after.text == "."))
+            )
+            if is_triple:
+                run.append(TextTriple(terms, after, namespaces))
+                position += 4
+                continue
+            if run:
+                runs.append(run)
+                run = []
+            # The next pattern starts after a dot or a nested group
+            position += 1
+            while position < len(elements) and not (
+                isinstance(elements[position - 1], _Group)
+                or (isinstance(elements[position - 1], Token) and elements[position - 1].text == ".")
+            ):
+                position += 1
+        if run:
+            runs.append(run)
+    return runs
+
+
+def variables(query: str) -> Set[Variable]:
+    """
+    Returns:
+        Set[Variable]: Every variable written in the query.
+    """
+    return {Variable(token.text[1:]) for token in tokenize(query) if token.kind == "variable"}
+
+
+def keywords(query: str) -> Set[str]:
+    """
+    Returns:
+        Set[str]: The keywords and function names of the query, in upper case.
+    """
+    return {token.keyword() for token in tokenize(query) if token.kind == "word"}
+
+
+def write_term(term: Identifier, namespaces: Dict[str, str]) -> str:
+    """Writes a term with the prefixes declared by the query, as a full IRI otherwise."""
+    if isinstance(term, Variable):
+        return f"?{term}"
+    if isinstance(term, URIRef):
+        if term == RDF.type:
+            return "a"
+        for prefix, namespace in sorted(namespaces.items(), key=lambda item: -len(item[1])):
+            local = term[len(namespace) :]
+            if term.startswith(namespace) and re.fullmatch(r"[\w-]+", local):
+                return f"{prefix}:{local}"
+        return f"<{term}>"
+    return term.n3()
+
+
+def replace_spans(query: str, replacements: List[Tuple[int, int, str]]) -> str:
+    """Replaces non-overlapping (start, end, text) spans of the query."""
+    for start, end, text in sorted(replacements, reverse=True):
+        query = query[:start] + text + query[end:]
+    return query
@@ -10,7 +10,12 @@ from langsmith import Client
 from langchain_community.chat_models import ChatLiteLLM
 from langchain_openai import ChatOpenAI
 
-from app.core.workflow.langraph_workflow import create_workflow, process_workflow
+from app.core.workflow.langraph_workflow import (
+    create_workflow,
+    link_kg_database,
+    process_workflow,
+)
+from app.core.agents.sparql.tool_sparql import cancel_session_queries
 from app.core.session import create_user_session, initialize_session_context
 from app.core.utils import IntRange, setup_logger
 from app.core.questions import standard_questions
@@ -21,7 +26,6 @@ load_dotenv()
 logger = setup_logger(__name__)
 
 parent_dir = Path(__file__).resolve().parent.parent
-graph_path = parent_dir / "graphs" / "graph.pkl"
 params_path = parent_dir / "config" / "params.ini"
 
 
@@ -326,6 +330,10 @@ def main():
         '--endpoint', type=str,
         help="Knowledge graph endpoint URL (optional).",
     )
+    parser.add_argument(
+        '--refresh-schema', action='store_true',
+        help="Update the cached schema with the classes that changed in the knowledge graph.",
+    )
 
     args = parser.parse_args()
 
@@ -368,6 +376,10 @@ def main():
             return
 
     try:
+        if args.refresh_schema:
+            # Update the cached schema before the workflow loads it
+            link_kg_database(endpoint_url, refresh_schema=True)
+
         workflow = create_workflow(
             models=models,
             session_id=session_id,
@@ -377,6 +389,10 @@ def main():
         )
         process_workflow(workflow, question)
 
+    except KeyboardInterrupt:
+        # The queries may be running in the worker threads of the workflow
+        cancel_session_queries(session_id)
+        raise
     except Exception as e:
         logger.error(f"Error processing workflow: {e}")
         raise
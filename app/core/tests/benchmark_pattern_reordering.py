@@ -0,0 +1,124 @@
+"""
+Benchmark of the triple pattern reordering of RdfGraph.optimize_query on a retention time self-join.
+
+Evaluates the query as written by the LLM (broadest patterns first, taxon last) and the reordered
+query on a synthetic graph shaped like the LCMS data of a few taxa, with the rdflib engine made to
+evaluate the patterns in the written order, like an endpoint with a naive planner. No endpoint is
+needed.
+
+Usage:
+    python -m app.core.tests.benchmark_pattern_reordering --taxa 3 --features 20
+"""
+
+import argparse
+import time
+from unittest import mock
+
+import rdflib
+from rdflib import Literal, URIRef
+from rdflib.namespace import RDF, XSD
+from rdflib.plugins.sparql import algebra
+
+from app.core.graph_management.query_optimizer import reorder_triple_patterns
+from app.core.graph_management.schema_statistics import SchemaStatistics
+
+
+KG = "https://enpkg.commons-lab.org/kg/"
+TAXON = "http://www.wikidata.org/entity/Q0"
+
+QUERY = f"""PREFIX ns1: <{KG}>
+SELECT ?posFeature ?negFeature
+WHERE {{
+ ?posFeatureList ns1:has_lcms_feature ?posFeature .
+ ?posFeature ns1:has_retention_time ?posRT .
+ ?negFeatureList ns1:has_lcms_feature ?negFeature .
+ ?negFeature ns1:has_retention_time ?negRT .
+ ?posAnalysis ns1:has_lcms_feature_list ?posFeatureList .
+ ?posAnalysis a ns1:LCMSAnalysisPos .
+ ?negAnalysis ns1:has_lcms_feature_list ?negFeatureList .
+ ?negAnalysis a ns1:LCMSAnalysisNeg .
+ ?labExtract ns1:has_LCMS ?posAnalysis .
+ ?labExtract ns1:has_LCMS ?negAnalysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+ FILTER (ABS(?posRT - ?negRT) <= 0.01)
+}}"""
+
+
+def build_graph(n_taxa: int, n_features: int) -> rdflib.Graph:
+    graph = rdflib.Graph()
+    ns = rdflib.Namespace(KG)
+    for taxon in range(n_taxa):
+        raw_material = ns[f"raw_material_{taxon}"]
+        extract = ns[f"extract_{taxon}"]
+        taxon_iri = URIRef(f"http://www.wikidata.org/entity/Q{taxon}")
+        graph.add((raw_material, ns.has_wd_id, taxon_iri))
+        graph.add((raw_material, ns.has_lab_process, extract))
+        for mode, analysis_class in (("pos", ns.LCMSAnalysisPos), ("neg", ns.LCMSAnalysisNeg)):
+            analysis = ns[f"analysis_{mode}_{taxon}"]
+            feature_list = ns[f"feature_list_{mode}_{taxon}"]
+            graph.add((extract, ns.has_LCMS, analysis))
+            graph.add((analysis, RDF.type, analysis_class))
+            graph.add((analysis, ns.has_lcms_feature_list, feature_list))
+            for i in range(n_features):
+                feature = ns[f"feature_{mode}_{taxon}_{i}"]
+                graph.add((feature_list, ns.has_lcms_feature, feature))
+                graph.add(
+                    (feature, ns.has_retention_time, Literal(i / 10, datatype=XSD.float))
+                )
+    return graph
+
+
+def collect_statistics(graph: rdflib.Graph) -> SchemaStatistics:
+    """Counts the triples, subjects and objects of each property, as CLS_STATS_RDF would."""
+    statistics = SchemaStatistics()
+    properties = {}
+    for subject, predicate, obj in graph:
+        triples, subjects, objects = properties.setdefault(str(predicate), ([], set(), set()))
+        triples.append(subject)
+        subjects.add(subject)
+        objects.add(obj)
+    statistics.update_class(
+        "all",
+        [
+            {
+                "property": predicate,
+                "triples": len(triples),
+                "subjects": len(subjects),
+                "objects": len(objects),
+            }
+            for predicate, (triples, subjects, objects) in properties.items()
+        ],
+    )
+    for analysis_class in ("LCMSAnalysisPos", "LCMSAnalysisNeg"):
+        statistics.class_instances[f"{KG}{analysis_class}"] = len(
+            set(graph.subjects(RDF.type, URIRef(f"{KG}{analysis_class}")))
+        )
+    return statistics
+
+
+def measure(name: str, graph: rdflib.Graph, query: str) -> int:
+    start = time.perf_counter()
+    rows = len(graph.query(query))
+    print(f"{name:<12} {rows:>8} rows  {time.perf_counter() - start:8.3f} s")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--taxa", type=int, default=3)
+    parser.add_argument("--features", type=int, default=20)
+    args = parser.parse_args()
+
+    graph = build_graph(args.taxa, args.features)
+    reordered = reorder_triple_patterns(QUERY, collect_statistics(graph))
+
+    # Evaluate the patterns in the written order instead of letting rdflib sort them
+    with mock.patch.object(algebra, "reorderTriples", list):
+        written_rows = measure("as written", graph, QUERY)
+        reordered_rows = measure("reordered", graph, reordered)
+    assert written_rows == reordered_rows
+
+
+if __name__ == "__main__":
+    main()
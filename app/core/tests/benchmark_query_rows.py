@@ -0,0 +1,77 @@
+"""
+Benchmark of the conversion of SPARQL SELECT results to rows in RdfGraph.query.
+
+Compares the former conversion (serialize the result to CSV, decode it and parse it again with
+csv.DictReader) with RdfGraph.result_to_rows, on a synthetic result shaped like an LCMS feature
+list query. No endpoint is needed.
+
+Usage:
+    python -m app.core.tests.benchmark_query_rows --rows 100000
+"""
+
+import argparse
+import csv
+import time
+import tracemalloc
+from io import StringIO
+
+from rdflib import Literal, URIRef, Variable
+from rdflib.namespace import XSD
+from rdflib.query import Result
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+
+
+KG = "https://enpkg.commons-lab.org/kg/"
+
+
+def build_result(n_rows: int) -> Result:
+    variables = [Variable(name) for name in ("feature", "rt", "mass", "inchikey2d")]
+    result = Result("SELECT")
+    result.vars = variables
+    result.bindings = [
+        {
+            variables[0]: URIRef(f"{KG}lcms_feature_{i}"),
+            variables[1]: Literal(i % 1200 / 100, datatype=XSD.float),
+            variables[2]: Literal(100 + i % 900 + 0.1234, datatype=XSD.float),
+            # Unbound for one row in three, as with an OPTIONAL pattern
+            **({variables[3]: URIRef(f"{KG}QWERTYUIOPASDF{i}")} if i % 3 else {}),
+        }
+        for i in range(n_rows)
+    ]
+    return result
+
+
+def csv_round_trip(result: Result):
+    csv_str = result.serialize(format="csv").decode("utf-8")
+    return list(csv.DictReader(StringIO(csv_str)))
+
+
+def direct_rows(result: Result):
+    return list(RdfGraph.result_to_rows(result))
+
+
+def measure(name: str, convert, result: Result) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = convert(result)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<16} {len(rows):>8} rows  {elapsed:8.3f} s  peak {peak / 2**20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    result = build_result(args.rows)
+    assert csv_round_trip(build_result(100)) == direct_rows(build_result(100))
+
+    measure("csv round trip", csv_round_trip, result)
+    measure("direct rows", direct_rows, result)
+
+
+if __name__ == "__main__":
+    main()
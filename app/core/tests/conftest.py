@@ -0,0 +1,22 @@
+import pytest
+
+from app.core.graph_management.local_endpoint import LocalSparqlEndpoint
+
+
+@pytest.fixture(autouse=True)
+def isolated_result_cache(tmp_path, monkeypatch):
+    """Keeps the SPARQL result cache of the tests out of the repository."""
+    monkeypatch.setenv("METABOT_RESULT_CACHE_DIR", str(tmp_path / "result_cache"))
+
+
+@pytest.fixture(autouse=True)
+def isolated_query_library(tmp_path, monkeypatch):
+    """Keeps the verified queries recorded by the tests out of the repository."""
+    monkeypatch.setenv("METABOT_QUERY_LIBRARY_DIR", str(tmp_path / "query_library"))
+
+
+@pytest.fixture(scope="session")
+def local_endpoint():
+    """Local SPARQL endpoint serving the bundled ENPKG fixture, see `LocalSparqlEndpoint`."""
+    with LocalSparqlEndpoint.from_fixture() as endpoint:
+        yield endpoint
@@ -0,0 +1,300 @@
+"""
+Generates the fixture served by the local SPARQL endpoint (`app.core.graph_management.local_endpoint`).
+
+Without `--source`, builds a small deterministic graph with the shape of ENPKG: raw materials of a few
+taxa, their extracts and positive and negative LCMS analyses, features with SIRIUS, ISDB and CANOPUS
+annotations, the annotated structures with their Wikidata, NPClassifier and ChEMBL links, and the
+rdfs:Class declarations the schema extraction starts from. This is how the bundled
+`app/data/enpkg_fixture.ttl` is built, so that it needs no network access.
+
+With `--source`, extracts a real subset of an endpoint instead: the class declarations and everything
+reachable from the first `--taxa` raw materials, keeping at most `--features` values of each property
+of a node (e.g. features of a feature list).
+
+Usage:
+    python -m app.core.tests.generate_enpkg_fixture --taxa 3 --features 8
+    python -m app.core.tests.generate_enpkg_fixture --source https://enpkg.commons-lab.org/graphdb/repositories/ENPKG --taxa 2 --features 20 --output enpkg_subset.ttl
+"""
+
+import argparse
+import random
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, List, Set
+
+import rdflib
+import requests
+from rdflib import Literal, URIRef
+from rdflib.namespace import RDF, RDFS, XSD
+
+from app.core.graph_management.local_endpoint import DEFAULT_FIXTURE
+
+
+NS1 = rdflib.Namespace("https://enpkg.commons-lab.org/kg/")
+NS2 = rdflib.Namespace("https://enpkg.commons-lab.org/module/")
+WD = rdflib.Namespace("http://www.wikidata.org/entity/")
+CHEMBL_TARGET = rdflib.Namespace("https://www.ebi.ac.uk/chembl/target_report_card/")
+
+# Label and comment of the classes, as declared in ENPKG
+CLASSES = {
+    NS1.RawMaterial: ("A RawMaterial", "A raw laboratory biological material, i.e. before extraction"),
+    NS1.WDTaxon: ("Cross-reference to a taxon in Wikidata", "Cross-reference to a taxon in Wikidata"),
+    NS1.LabExtract: ("A LabExtract", "A natural extract obtained from the processing of a RawMaterial"),
+    NS1.LCMSAnalysisPos: ("Pos LCMS analysis", "An LCMS analysis in positive ionization mode (pos)"),
+    NS1.LCMSAnalysisNeg: ("Neg LCMS analysis", "An LCMS analysis in negative ionization mode (neg)"),
+    NS1.LCMSFeatureList: (
+        "Feature list",
+        "A list of LCMS features obtained from the processing of a given LCMS analysis",
+    ),
+    NS1.LCMSFeature: ("LCMS individual MS2 spectrum", "An LCMS feature from a processed LCMS analysis"),
+    NS1.Annotation: ("Spectrum annotation", "A spectral annotation"),
+    NS1.SiriusStructureAnnotation: (
+        "SIRIUS structural annotation",
+        "A spectrum structural annotation by SIRIUS",
+    ),
+    NS1.IsdbAnnotation: (
+        "ISDB structural annotation",
+        "A spectrum structural annotation by comparison with an in-silico spectral DB, coupled to "
+        "chemical and taxonomical reweighting",
+    ),
+    NS1.SiriusCanopusAnnotation: (
+        "CANOPUS chemical class annotation",
+        "A spectrum chemical class annotation by SIRIUS-CANOPUS",
+    ),
+    NS1.Spec2VecDoc: (
+        "A Spec2VecDoc",
+        "An ensemble of Spec2VecPeak and Spec2VecLoss objects that characterizes an MS2Spectrum",
+    ),
+    NS1.Spec2VecPeak: ("A Spec2VecPeak", "A Spec2VecPeak that partly characterizes an MS2 spectrum"),
+    NS1.InChIkey2D: (
+        "2D InChIKey",
+        "The first 14 characters of an InChIKey, often returned by MS-based annotation tools",
+    ),
+    NS1.InChIkey: ("InChIKey", "A chemical structure represented by its InChIKey"),
+    NS1.WDChemical: (
+        "Cross-reference to a chemical entity in Wikidata",
+        "Cross-reference to a chemical entity in Wikidata",
+    ),
+    NS1.NPCClass: ("NPCClass", "A NPClassifier (NPC) chemical class"),
+    NS2.ChEMBLChemical: ("A ChEMBL chemical", "A ChEMBL chemical"),
+    NS2.ChEMBLAssayResults: ("A ChEMBL assay result", "A ChEMBL assay result"),
+    NS2.ChEMBLTarget: ("A ChEMBL target", "A ChEMBL target"),
+}
+
+TAXA = ["Datura metel", "Melia azedarach", "Tabernaemontana coffeoides", "Cinchona officinalis"]
+NPC_CLASSES = ["Tropane_alkaloids", "Limonoids", "Flavonols", "Quinoline_alkaloids"]
+CHEMBL_TARGETS = ["CHEMBL367", "CHEMBL612348", "CHEMBL364"]
+ADDUCTS = {"pos": "[M+H]+", "neg": "[M-H]-"}
+
+
+def _typed(graph: rdflib.Graph, node: URIRef, *classes: URIRef) -> URIRef:
+    for class_uri in classes:
+        graph.add((node, RDF.type, class_uri))
+    return node
+
+
+def synthetic_fixture(n_taxa: int, n_features: int, seed: int = 0) -> rdflib.Graph:
+    """
+    Builds a graph with the classes and properties of ENPKG used by the example queries.
+
+    Args:
+        n_taxa (int): Number of taxa, each with one raw material and one extract.
+        n_features (int): Number of features of each LCMS analysis.
+        seed (int): Seed of the random values (retention times, masses, annotations).
+
+    Returns:
+        rdflib.Graph: The fixture.
+    """
+    rng = random.Random(seed)
+    graph = rdflib.Graph()
+    graph.bind("ns1", NS1)
+    graph.bind("ns2", NS2)
+    graph.bind("wd", WD)
+    for class_uri, (label, comment) in CLASSES.items():
+        _typed(graph, class_uri, RDFS.Class)
+        graph.add((class_uri, RDFS.label, Literal(label)))
+        graph.add((class_uri, RDFS.comment, Literal(comment)))
+
+    npc_classes = []
+    for name in NPC_CLASSES:
+        npc_class = _typed(graph, NS1[f"npc_{name}"], NS1.NPCClass)
+        graph.add((npc_class, RDFS.label, Literal(name.replace("_", " "))))
+        npc_classes.append(npc_class)
+    targets = [_typed(graph, CHEMBL_TARGET[t], NS2.ChEMBLTarget) for t in CHEMBL_TARGETS]
+
+    # Structures shared by the features, so that annotations of different analyses join
+    structures = []
+    for i in range(max(4, n_features // 2)):
+        key = f"SYNTHKEY{i:06d}"
+        inchikey2d = _typed(graph, NS1[key], NS1.InChIkey2D)
+        inchikey = _typed(graph, NS1[f"{key}-UHFFFAOYSA-N"], NS1.InChIkey)
+        graph.add((inchikey2d, NS1.is_InChIkey2D_of, inchikey))
+        graph.add((inchikey, NS1.has_wd_id, _typed(graph, WD[f"Q{900000 + i}"], NS1.WDChemical)))
+        graph.add((inchikey, NS1.has_smiles, Literal("C" * (i + 1) + "O")))
+        graph.add((inchikey, NS1.has_npc_class, rng.choice(npc_classes)))
+        if i % 2 == 0:
+            chemical = _typed(graph, NS2[f"chembl_CHEMBL{100000 + i}"], NS2.ChEMBLChemical)
+            graph.add((inchikey, NS2.has_chembl_id, chemical))
+            activity = _typed(graph, NS2[f"chembl_activity_{i}"], NS2.ChEMBLAssayResults)
+            graph.add((chemical, NS2.has_chembl_activity, activity))
+            graph.add((activity, NS2.target_id, rng.choice(targets)))
+            graph.add((activity, NS2.activity_type, Literal("IC50")))
+            graph.add(
+                (activity, NS2.activity_value, Literal(round(rng.uniform(1, 5000), 1), datatype=XSD.float))
+            )
+        structures.append(inchikey2d)
+
+    peaks = []
+    for i in range(8):
+        peak = _typed(graph, NS1[f"peak@{100 + 25 * i}.0"], NS1.Spec2VecPeak)
+        graph.add((peak, RDFS.label, Literal(f"peak@{100 + 25 * i}.0")))
+        peaks.append(peak)
+
+    for t in range(n_taxa):
+        taxon_name = TAXA[t] if t < len(TAXA) else f"Taxon {t}"
+        sample = f"VGF{t:03d}_A01"
+        raw_material = _typed(graph, NS1[f"{sample}_raw"], NS1.RawMaterial)
+        graph.add((raw_material, NS1.has_wd_id, _typed(graph, WD[f"Q{157115 + t}"], NS1.WDTaxon)))
+        graph.add((raw_material, NS1.submitted_taxon, Literal(taxon_name)))
+        extract = _typed(graph, NS1[sample], NS1.LabExtract)
+        graph.add((extract, RDFS.label, Literal(sample)))
+        graph.add((raw_material, NS1.has_lab_process, extract))
+
+        for mode, analysis_class in (("pos", NS1.LCMSAnalysisPos), ("neg", NS1.LCMSAnalysisNeg)):
+            analysis = _typed(graph, NS1[f"{sample}_lcms_{mode}"], analysis_class)
+            feature_list = _typed(graph, NS1[f"{sample}_lcms_{mode}_feature_list"], NS1.LCMSFeatureList)
+            graph.add((extract, NS1.has_LCMS, analysis))
+            graph.add((analysis, NS1.has_lcms_feature_list, feature_list))
+            for f in range(n_features):
+                feature_id = f"{sample}_lcms_{mode}_feature_{f + 1}"
+                feature = _typed(graph, NS1[feature_id], NS1.LCMSFeature)
+                graph.add((feature_list, NS1.has_lcms_feature, feature))
+                graph.add((feature, NS1.has_ionization, Literal(mode)))
+                # Retention times close between modes, so that the pos/neg self-joins return rows
+                rt = round(0.5 * f + rng.uniform(0, 0.4), 3)
+                graph.add((feature, NS1.has_retention_time, Literal(rt, datatype=XSD.float)))
+                mass = round(rng.uniform(150, 900), 4)
+                graph.add((feature, NS1.has_parent_mass, Literal(mass, datatype=XSD.float)))
+
+                doc = _typed(graph, NS1[f"{feature_id}_spec2vec_doc"], NS1.Spec2VecDoc)
+                graph.add((feature, NS1.has_spec2vec_doc, doc))
+                for peak in rng.sample(peaks, 3):
+                    graph.add((doc, NS1.has_spec2vec_peak, peak))
+
+                structure = structures[(f + t) % len(structures)]
+                sirius = _typed(
+                    graph, NS1[f"sirius_{feature_id}"], NS1.SiriusStructureAnnotation, NS1.Annotation
+                )
+                graph.add((feature, NS1.has_sirius_annotation, sirius))
+                graph.add((sirius, NS1.has_InChIkey2D, structure))
+                graph.add((sirius, NS1.has_sirius_adduct, Literal(ADDUCTS[mode])))
+                if f % 2 == 0:
+                    isdb = _typed(graph, NS1[f"isdb_{feature_id}"], NS1.IsdbAnnotation, NS1.Annotation)
+                    graph.add((feature, NS1.has_isdb_annotation, isdb))
+                    graph.add((isdb, NS1.has_InChIkey2D, structure))
+                canopus = _typed(
+                    graph, NS1[f"canopus_{feature_id}"], NS1.SiriusCanopusAnnotation, NS1.Annotation
+                )
+                graph.add((feature, NS1.has_canopus_annotation, canopus))
+                graph.add((canopus, NS1.has_canopus_npc_class, rng.choice(npc_classes)))
+                probability = round(rng.uniform(0.1, 1.0), 3)
+                graph.add(
+                    (canopus, NS1.has_canopus_npc_class_prob, Literal(probability, datatype=XSD.float))
+                )
+    return graph
+
+
+def _construct(endpoint: str, query: str) -> rdflib.Graph:
+    response = requests.post(
+        endpoint,
+        data={"query": query},
+        headers={"Accept": "application/n-triples"},
+        timeout=300,
+    )
+    response.raise_for_status()
+    graph = rdflib.Graph()
+    graph.parse(data=response.text, format="nt")
+    return graph
+
+
+def _chunks(items: List[URIRef], size: int) -> Iterable[List[URIRef]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def extract_fixture(
+    endpoint: str, n_raw_materials: int, max_values: int, max_depth: int = 10
+) -> rdflib.Graph:
+    """
+    Extracts the class declarations of an endpoint and the nodes reachable from some of its raw
+    materials, breadth first, with CONSTRUCT queries.
+
+    Args:
+        endpoint (str): URL of the SPARQL endpoint.
+        n_raw_materials (int): Number of raw materials the extraction starts from.
+        max_values (int): Maximum number of values of each property of a node that are followed.
+        max_depth (int): Maximum number of properties followed from a raw material.
+
+    Returns:
+        rdflib.Graph: The extracted subset.
+    """
+    graph = _construct(
+        endpoint,
+        """CONSTRUCT { ?cls a rdfs:Class ; rdfs:label ?label ; rdfs:comment ?comment }
+        WHERE {
+            ?cls a rdfs:Class .
+            OPTIONAL { ?cls rdfs:label ?label }
+            OPTIONAL { ?cls rdfs:comment ?comment }
+        }""",
+    )
+    raw_materials = _construct(
+        endpoint,
+        f"""CONSTRUCT {{ ?rawMaterial a <{NS1.RawMaterial}> }}
+        WHERE {{ ?rawMaterial a <{NS1.RawMaterial}> ; <{NS1.has_lab_process}> ?extract }}
+        LIMIT {n_raw_materials}""",
+    )
+    frontier = sorted(set(raw_materials.subjects()))
+    visited: Set[URIRef] = set(frontier)
+    for _ in range(max_depth):
+        next_frontier: Set[URIRef] = set()
+        for nodes in _chunks(frontier, 50):
+            values = " ".join(f"<{node}>" for node in nodes)
+            described = _construct(
+                endpoint, f"CONSTRUCT {{ ?s ?p ?o }} WHERE {{ VALUES ?s {{ {values} }} ?s ?p ?o }}"
+            )
+            kept = defaultdict(int)
+            for subject, predicate, obj in sorted(described):
+                if kept[subject, predicate] >= max_values:
+                    continue
+                kept[subject, predicate] += 1
+                graph.add((subject, predicate, obj))
+                if predicate != RDF.type and isinstance(obj, URIRef) and obj not in visited:
+                    visited.add(obj)
+                    next_frontier.add(obj)
+        if not next_frontier:
+            break
+        frontier = sorted(next_frontier)
+    for prefix, namespace in (("ns1", NS1), ("ns2", NS2), ("wd", WD)):
+        graph.bind(prefix, namespace)
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--source", type=str, help="Endpoint to extract the fixture from.")
+    parser.add_argument("--taxa", type=int, default=3)
+    parser.add_argument("--features", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=DEFAULT_FIXTURE)
+    args = parser.parse_args()
+
+    if args.source:
+        graph = extract_fixture(args.source, args.taxa, args.features)
+    else:
+        graph = synthetic_fixture(args.taxa, args.features, args.seed)
+    graph.serialize(args.output, format="turtle")
+    print(f"Wrote {len(graph)} triples to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.core.graph_management.admission import (
+    AdmissionController,
+    get_admission_controller,
+)
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.sparql_store import (
+    QueryCancellation,
+    SparqlQueryCancelled,
+    SparqlQueryRejected,
+    SparqlTimeoutError,
+)
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+
+
+def _hold(controller, release, started=None, **kwargs):
+    with controller.admit(**kwargs):
+        if started is not None:
+            started.set()
+        release.wait(5)
+
+
+def test_admission_limits_concurrent_queries():
+    controller = AdmissionController(ENDPOINT, max_concurrent=2, max_queued=10)
+    running = {"current": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def run_query(_):
+        with controller.admit():
+            with lock:
+                running["current"] += 1
+                running["peak"] = max(running["peak"], running["current"])
+            time.sleep(0.02)
+            with lock:
+                running["current"] -= 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(run_query, range(8)))
+
+    stats = controller.stats()
+    assert running["peak"] == 2
+    assert stats["admitted"] == 8
+    assert stats["running"] == 0
+    assert stats["max_wait_seconds"] > 0
+
+
+def test_admission_rejects_queries_when_the_queue_is_full():
+    controller = AdmissionController(ENDPOINT, max_concurrent=1, max_queued=1)
+    release = threading.Event()
+    started = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(_hold, controller, release, started)
+        started.wait(5)
+        queued = executor.submit(_hold, controller, release)
+        while controller.stats()["queued"] < 1:
+            time.sleep(0.01)
+
+        with pytest.raises(SparqlQueryRejected, match="busy"):
+            with controller.admit():
+                pass
+
+        release.set()
+        queued.result()
+    assert controller.stats()["rejected"] == 1
+    assert controller.stats()["admitted"] == 2
+
+
+def test_admission_serves_waiting_queries_in_order():
+    controller = AdmissionController(ENDPOINT, max_concurrent=1, max_queued=10)
+    release = threading.Event()
+    started = threading.Event()
+    order = []
+
+    def run_query(i):
+        with controller.admit():
+            order.append(i)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        executor.submit(_hold, controller, release, started)
+        started.wait(5)
+        for i in range(3):
+            executor.submit(run_query, i)
+            while controller.stats()["queued"] < i + 1:
+                time.sleep(0.01)
+        release.set()
+
+    assert order == [0, 1, 2]
+
+
+def test_waiting_queries_time_out_and_leave_the_queue():
+    controller = AdmissionController(ENDPOINT, max_concurrent=1, max_queued=10)
+    release = threading.Event()
+    started = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(_hold, controller, release, started)
+        started.wait(5)
+
+        with pytest.raises(SparqlTimeoutError):
+            with controller.admit(deadline=time.monotonic() + 0.05):
+                pass
+        cancellation = QueryCancellation()
+        threading.Timer(0.05, cancellation.cancel).start()
+        with pytest.raises(SparqlQueryCancelled):
+            with controller.admit(cancellation=cancellation):
+                pass
+
+        assert controller.stats()["queued"] == 0
+        release.set()
+    assert controller.stats()["timed_out"] == 2
+    assert controller.stats()["running"] == 0
+
+
+def test_rdf_graph_queries_share_the_endpoint_admission_controller(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    controller = get_admission_controller(
+        "http://localhost:7300/repositories/busy", max_concurrent=1, max_queued=0
+    )
+    graphs = [
+        RdfGraph(query_endpoint="http://localhost:7300/repositories/busy", standard="rdf")
+        for _ in range(2)
+    ]
+    assert all(graph.admission_controller is controller for graph in graphs)
+
+    release = threading.Event()
+    started = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(_hold, controller, release, started)
+        started.wait(5)
+        graphs[0].result_cache = None
+        with pytest.raises(ValueError, match="busy"):
+            graphs[0].query("SELECT ?s WHERE { ?s ?p ?o }")
+        release.set()
@@ -0,0 +1,124 @@
+import time
+
+import pytest
+import rdflib
+import requests
+from rdflib.namespace import RDF, RDFS
+
+from app.core.graph_management import RdfGraphCustom
+from app.core.graph_management.local_endpoint import (
+    DEFAULT_FIXTURE,
+    GRAPH_FORMATS,
+    SELECT_FORMATS,
+    LocalSparqlEndpoint,
+    negotiate,
+)
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.sparql_store import SparqlSyntaxError
+from app.core.tests.generate_enpkg_fixture import NS1, extract_fixture, synthetic_fixture
+
+
+TAXON_FEATURES_QUERY = """PREFIX ns1: <https://enpkg.commons-lab.org/kg/>
+SELECT DISTINCT ?feature ?rt WHERE {
+ ?rawMaterial ns1:has_wd_id <http://www.wikidata.org/entity/Q157115> .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?labExtract ns1:has_LCMS ?analysis .
+ ?analysis a ns1:LCMSAnalysisPos .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?feature ns1:has_retention_time ?rt .
+}"""
+
+
+def test_rdf_graph_extracts_the_schema_and_queries_the_local_endpoint(monkeypatch, local_endpoint):
+    monkeypatch.setattr(RdfGraphCustom, "token_counter", len)
+
+    graph = RdfGraph(query_endpoint=local_endpoint.url, standard="rdf")
+
+    assert f"{NS1}LCMSFeatureList" in {c["cls"] for c in graph.classes}
+    # The turtle serializer numbers the generated prefixes in the order the endpoint returns the classes
+    prefix = next(prefix for prefix, uri in graph.namespaces if str(uri) == NS1)
+    assert f"{prefix}:has_lcms_feature_list" in graph.get_schema
+    rows = graph.query(TAXON_FEATURES_QUERY)
+    assert len(rows) == 8
+    assert all(row["feature"].startswith(f"{NS1}VGF000_A01_lcms_pos") for row in rows)
+    assert graph.validate_query(TAXON_FEATURES_QUERY) == []
+    with pytest.raises(SparqlSyntaxError, match="400"):
+        graph.query("SELECT ?s WHERE { ?s ?p }")
+
+
+def test_protocol_formats_and_errors(local_endpoint):
+    url = local_endpoint.url
+
+    construct = requests.get(
+        url,
+        params={"query": f"CONSTRUCT {{ ?s a <{NS1}LabExtract> }} WHERE {{ ?s a <{NS1}LabExtract> }}"},
+        headers={"Accept": "application/n-triples"},
+    )
+    assert construct.headers["Content-Type"].startswith("application/n-triples")
+    assert len(rdflib.Graph().parse(data=construct.text, format="nt")) == 3
+
+    ask = requests.post(
+        url,
+        data=f"ASK {{ ?s a <{NS1}LabExtract> }}",
+        headers={"Content-Type": "application/sparql-query", "Accept": "text/csv, */*;q=0.5"},
+    )
+    assert ask.json()["boolean"] is True
+
+    assert requests.get(url, params={"query": "SELECT ?s WHERE { ?s ?p }"}).status_code == 400
+    assert requests.get(url.replace("ENPKG", "other"), params={"query": "ASK {}"}).status_code == 404
+    assert requests.get(url).status_code == 400
+
+
+def test_content_negotiation_follows_quality_values():
+    accept = "application/sparql-results+xml;q=0.5, text/csv;q=0.9, application/json"
+
+    assert negotiate(accept, SELECT_FORMATS) == ("text/csv", "csv")
+    assert negotiate("*/*", SELECT_FORMATS) == ("application/sparql-results+json", "json")
+    assert negotiate("text/turtle;q=0, application/rdf+xml", GRAPH_FORMATS)[1] == "xml"
+
+
+def test_latency_is_added_to_each_answer():
+    graph = rdflib.Graph()
+    graph.add((NS1.extract, RDF.type, NS1.LabExtract))
+    with LocalSparqlEndpoint(graph, latency_seconds=0.2) as endpoint:
+        start = time.perf_counter()
+        response = requests.get(endpoint.url, params={"query": "SELECT * WHERE { ?s ?p ?o }"})
+
+        assert time.perf_counter() - start >= 0.2
+        assert response.ok
+        assert endpoint.query_count == 1
+
+
+def test_bundled_fixture_is_the_generated_one():
+    bundled = rdflib.Graph().parse(DEFAULT_FIXTURE)
+
+    assert set(bundled) == set(synthetic_fixture(n_taxa=3, n_features=8))
+
+
+def test_fixture_subset_is_extracted_from_an_endpoint(local_endpoint):
+    subset = extract_fixture(local_endpoint.url, n_raw_materials=1, max_values=2)
+
+    assert len(list(subset.subjects(RDF.type, NS1.RawMaterial))) == 1
+    assert (NS1.LCMSFeatureList, RDF.type, RDFS.Class) in subset
+    feature_lists = list(subset.subjects(RDF.type, NS1.LCMSFeatureList))
+    assert len(feature_lists) == 2
+    assert all(len(list(subset.objects(f, NS1.has_lcms_feature))) == 2 for f in feature_lists)
+    assert len(list(subset.subjects(NS1.has_InChIkey2D, None))) > 0
+    assert len(subset) < len(local_endpoint.graph)
+
+
+def test_aggregated_extraction_finds_the_properties_of_the_per_class_extraction(
+    monkeypatch, local_endpoint
+):
+    monkeypatch.setattr(RdfGraphCustom, "token_counter", len)
+    graph = RdfGraph(query_endpoint=local_endpoint.url, standard="rdf")
+    graph.aggregated_chunk_size = 4
+
+    per_class = graph.extract_class_properties([c["cls"] for c in graph.classes])
+    aggregated = graph.extract_class_properties_aggregated([c["cls"] for c in graph.classes])
+
+    # The fixture classes have less than 1000 instances, so both strategies sample all of them
+    assert {uri: sorted(props) for uri, props in aggregated.items()} == {
+        uri: sorted(props) for uri, props in per_class.items()
+    }
@@ -0,0 +1,97 @@
+import pytest
+
+from app.core.agents.sparql.query_library import QueryLibrary, normalize_question
+
+
+ENDPOINT = "http://localhost:7200/repositories/ENPKG"
+TAXON = "Melochia umbellata has the Wikidata IRI http://www.wikidata.org/entity/Q6813281"
+FEATURES_QUERY = """SELECT ?feature WHERE {
+ ?rawMaterial ns1:has_wd_id <http://www.wikidata.org/entity/Q6813281> .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+}"""
+COUNT_QUERY = "SELECT (COUNT(?extract) AS ?count) WHERE { ?extract a ns1:LabExtract . }"
+
+
+@pytest.fixture
+def library(tmp_path):
+    library = QueryLibrary(tmp_path / "library.sqlite3")
+    yield library
+    library.close()
+
+
+def test_questions_are_normalized():
+    assert normalize_question("  How many   LAB extracts?") == "how many lab extracts"
+    assert normalize_question("How many lab extracts") == "how many lab extracts"
+
+
+def test_pairs_are_recorded_once_per_question(library, tmp_path):
+    assert library.record(ENDPOINT, "How many lab extracts?", "", COUNT_QUERY, 1, 0.2)
+    assert library.record(ENDPOINT, "how many  lab extracts", "", f"# again\n{COUNT_QUERY}", 1, 0.1)
+    assert not library.record(ENDPOINT, "Which extracts are empty?", "", COUNT_QUERY, 0, 0.1)
+
+    assert len(library) == 1
+    pair, score = library.similar(ENDPOINT, "How many lab extracts?")[0]
+    assert pair.query == f"# again\n{COUNT_QUERY}"
+    assert pair.verifications == 2
+    assert pair.latency_seconds == 0.1
+    assert score == pytest.approx(1.0)
+    assert len(QueryLibrary(tmp_path / "library.sqlite3")) == 1
+
+
+def test_similar_pairs_are_ranked_and_filtered(library):
+    library.record(ENDPOINT, "How many lab extracts are there?", "", COUNT_QUERY, 1, 0.2)
+    library.record(
+        ENDPOINT, "Which features were detected in Melochia umbellata?", TAXON, FEATURES_QUERY, 8, 1.5
+    )
+    library.record(
+        ENDPOINT, "List the features of Melochia umbellata", TAXON, FEATURES_QUERY, 8, 1.2
+    )
+    library.record("http://other/sparql", "Which features of Melochia umbellata?", TAXON, "x", 1, 1)
+
+    similar = library.similar(
+        ENDPOINT, "Which lab extracts and features were detected in Melochia umbellata?", TAXON
+    )
+
+    # The second pair has the same query as the first one
+    assert [pair.question for pair, _ in similar] == [
+        "Which features were detected in Melochia umbellata?",
+        "How many lab extracts are there?",
+    ]
+    assert similar[0][1] > similar[1][1]
+    assert library.similar(ENDPOINT, "Which features?", TAXON, min_similarity=0.99) == []
+    assert library.similar("http://unknown/sparql", "Which features?") == []
+
+
+def test_index_is_refitted_when_pairs_are_added(library):
+    library.record(ENDPOINT, "How many lab extracts are there?", "", COUNT_QUERY, 1, 0.2)
+    assert library.similar(ENDPOINT, "features of Melochia umbellata") == []
+
+    library.record(ENDPOINT, "Features of Melochia umbellata", TAXON, FEATURES_QUERY, 8, 1.5)
+
+    assert library.similar(ENDPOINT, "features of Melochia umbellata")[0][0].query == FEATURES_QUERY
+
+
+def test_lookup_matches_the_same_question_with_the_same_entities(library):
+    library.record(ENDPOINT, "Which features were detected in Melochia umbellata?", TAXON, FEATURES_QUERY, 8, 1.5)
+    library.record(ENDPOINT, "How many lab extracts are there?", "", COUNT_QUERY, 1, 0.2)
+
+    pair, score = library.lookup(ENDPOINT, "which features were detected in Melochia umbellata", TAXON)
+    assert (pair.query, score) == (FEATURES_QUERY, 1.0)
+    pair, score = library.lookup(ENDPOINT, "What features were detected in Melochia umbellata?", TAXON, 0.7)
+    assert pair.query == FEATURES_QUERY and 0.7 <= score < 1
+    assert library.lookup(ENDPOINT, "What features were detected in Melochia umbellata?", TAXON, 1.01) is None
+    assert library.lookup(ENDPOINT, "Which features were detected in Melochia umbellata?", "", 0.7) is None
+    assert library.lookup(ENDPOINT, "How many features are there?", "", 0.9) is None
+    assert library.lookup("http://other/sparql", "How many lab extracts are there?") is None
+
+
+def test_lookup_misses_questions_with_words_the_library_does_not_know(library):
+    library.record(ENDPOINT, "Which features were detected in Melochia umbellata?", TAXON, FEATURES_QUERY, 8, 1.5)
+
+    # "not", "how" and "many" are in no recorded question, they were ignored by the TF-IDF vectors
+    assert library.lookup(ENDPOINT, "Which features were not detected in Melochia umbellata?", TAXON) is None
+    assert library.lookup(ENDPOINT, "How many features were detected in Melochia umbellata?", TAXON) is None
+    assert library.lookup(ENDPOINT, "Which features were detected in Melochia umbellata", TAXON)[1] == 1.0
+
+    library.record(ENDPOINT, "How many lab extracts are there?", "", COUNT_QUERY, 1, 0.2)
+    assert library.lookup(ENDPOINT, "How many features were detected in Melochia umbellata?", TAXON) is None
@@ -0,0 +1,282 @@
+import rdflib
+from rdflib import Literal, URIRef
+from rdflib.namespace import RDF, XSD
+
+from app.core.graph_management.query_optimizer import (
+    SelectivityEstimator,
+    estimate_query_cost,
+    order_patterns,
+    reorder_triple_patterns,
+)
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_statistics import SchemaStatistics
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+TAXON = "http://www.wikidata.org/entity/Q157115"
+PREFIX = f"PREFIX ns1: <{KG}>\n"
+
+RETENTION_TIME_QUERY = PREFIX + f"""SELECT ?posFeature ?negFeature
+WHERE {{
+ ?posFeatureList ns1:has_lcms_feature ?posFeature .
+ ?posFeature ns1:has_retention_time ?posRT .
+ ?negFeatureList ns1:has_lcms_feature ?negFeature .
+ ?negFeature ns1:has_retention_time ?negRT .
+ ?posAnalysis ns1:has_lcms_feature_list ?posFeatureList .
+ ?posAnalysis a ns1:LCMSAnalysisPos .
+ ?negAnalysis ns1:has_lcms_feature_list ?negFeatureList .
+ ?negAnalysis a ns1:LCMSAnalysisNeg .
+ ?labExtract ns1:has_LCMS ?posAnalysis .
+ ?labExtract ns1:has_LCMS ?negAnalysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+ FILTER (ABS(?posRT - ?negRT) <= 0.5)
+}}"""
+
+EQUIVALENT_QUERIES = [
+    RETENTION_TIME_QUERY,
+    PREFIX + f"""SELECT ?labExtract (COUNT(?feature) AS ?features)
+WHERE {{
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?labExtract ns1:has_LCMS ?analysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+}}
+GROUP BY ?labExtract""",
+    PREFIX + """SELECT DISTINCT ?feature ?inchikey2d
+WHERE {
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?feature ns1:has_retention_time ?rt .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ OPTIONAL {
+  ?feature ns1:has_sirius_annotation ?annotation .
+  ?annotation ns1:has_InChIkey2D ?inchikey2d .
+ }
+ FILTER (?rt > 2)
+}
+ORDER BY ?feature""",
+    PREFIX + f"""SELECT ?feature ?rt2
+WHERE {{
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?feature ns1:has_retention_time ?rt .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?labExtract ns1:has_LCMS ?analysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+ BIND(?rt * 2 AS ?rt2)
+ FILTER(?rt2 > 5)
+}}""",
+    PREFIX + f"""SELECT ?analysis (COUNT(?feature) AS ?features) (MAX(?rt) AS ?maxRT)
+WHERE {{
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?feature ns1:has_retention_time ?rt .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?labExtract ns1:has_LCMS ?analysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+}}
+GROUP BY ?analysis
+HAVING (MAX(?rt) > 4)
+ORDER BY DESC(?features) ?analysis""",
+    PREFIX + f"""SELECT ?labExtract (GROUP_CONCAT(DISTINCT STR(?inchikey2d); separator="|") AS ?structures)
+WHERE {{
+ ?annotation ns1:has_InChIkey2D ?inchikey2d .
+ ?feature ns1:has_sirius_annotation ?annotation .
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?labExtract ns1:has_LCMS ?analysis .
+ ?rawMaterial ns1:has_lab_process ?labExtract .
+ ?rawMaterial ns1:has_wd_id <{TAXON}> .
+}}
+GROUP BY ?labExtract""",
+    PREFIX + f"""SELECT ?feature ?count
+WHERE {{
+ {{
+  SELECT ?featureList (COUNT(?member) AS ?count) WHERE {{
+   ?featureList ns1:has_lcms_feature ?member .
+   ?analysis ns1:has_lcms_feature_list ?featureList .
+   ?analysis a ns1:LCMSAnalysisPos .
+  }}
+  GROUP BY ?featureList
+ }}
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?feature ns1:has_retention_time ?rt .
+ OPTIONAL {{
+  ?annotation ns1:has_InChIkey2D ?inchikey2d .
+  ?feature ns1:has_sirius_annotation ?annotation .
+ }}
+ FILTER (!BOUND(?inchikey2d))
+}}""",
+]
+
+
+def _features_graph() -> rdflib.Graph:
+    graph = rdflib.Graph()
+    ns = rdflib.Namespace(KG)
+    for taxon in range(3):
+        raw_material = ns[f"raw_material_{taxon}"]
+        extract = ns[f"extract_{taxon}"]
+        taxon_iri = URIRef(f"http://www.wikidata.org/entity/Q15711{taxon + 5}")
+        graph.add((raw_material, ns.has_wd_id, taxon_iri))
+        graph.add((raw_material, ns.has_lab_process, extract))
+        for mode, analysis_class in (("pos", ns.LCMSAnalysisPos), ("neg", ns.LCMSAnalysisNeg)):
+            analysis = ns[f"analysis_{mode}_{taxon}"]
+            feature_list = ns[f"feature_list_{mode}_{taxon}"]
+            graph.add((extract, ns.has_LCMS, analysis))
+            graph.add((analysis, RDF.type, analysis_class))
+            graph.add((analysis, ns.has_lcms_feature_list, feature_list))
+            for i in range(8):
+                feature = ns[f"feature_{mode}_{taxon}_{i}"]
+                graph.add((feature_list, ns.has_lcms_feature, feature))
+                graph.add((feature, ns.has_retention_time, Literal(i * 0.7, datatype=XSD.float)))
+                if i % 2:
+                    annotation = ns[f"annotation_{mode}_{taxon}_{i}"]
+                    graph.add((feature, ns.has_sirius_annotation, annotation))
+                    graph.add((annotation, ns.has_InChIkey2D, ns[f"inchikey2d_{i}"]))
+    return graph
+
+
+def _statistics() -> SchemaStatistics:
+    def counts(triples, subjects, objects):
+        return {"triples": triples, "subjects": subjects, "objects": objects}
+
+    return SchemaStatistics(
+        {f"{KG}LCMSAnalysisPos": 3, f"{KG}LCMSAnalysisNeg": 3},
+        {
+            f"{KG}RawMaterial": {
+                f"{KG}has_wd_id": counts(3, 3, 3),
+                f"{KG}has_lab_process": counts(3, 3, 3),
+            },
+            f"{KG}LabExtract": {f"{KG}has_LCMS": counts(6, 3, 6)},
+            f"{KG}LCMSAnalysis": {f"{KG}has_lcms_feature_list": counts(6, 6, 6)},
+            f"{KG}LCMSFeatureList": {f"{KG}has_lcms_feature": counts(48, 6, 48)},
+            f"{KG}LCMSFeature": {
+                f"{KG}has_retention_time": counts(48, 48, 8),
+                f"{KG}has_sirius_annotation": counts(24, 24, 24),
+            },
+            f"{KG}Annotation": {f"{KG}has_InChIkey2D": counts(24, 24, 4)},
+        },
+    )
+
+
+def _rows(graph, query):
+    return sorted(
+        tuple(sorted((str(k), str(v)) for k, v in row.asdict().items()))
+        for row in graph.query(query)
+    )
+
+
+def test_patterns_start_with_the_bound_taxon_and_follow_the_joins():
+    ns = rdflib.Namespace(KG)
+    v = rdflib.Variable
+    patterns = [
+        (v("featureList"), ns.has_lcms_feature, v("feature")),
+        (v("analysis"), ns.has_lcms_feature_list, v("featureList")),
+        (v("labExtract"), ns.has_LCMS, v("analysis")),
+        (v("rawMaterial"), ns.has_lab_process, v("labExtract")),
+        (v("rawMaterial"), ns.has_wd_id, URIRef(TAXON)),
+    ]
+
+    ordered = order_patterns(patterns, SelectivityEstimator(_statistics()))
+
+    assert ordered == list(reversed(patterns))
+
+
+def test_reordered_queries_return_the_same_rows():
+    graph = _features_graph()
+
+    for query in EQUIVALENT_QUERIES:
+        rewritten = reorder_triple_patterns(query, _statistics())
+
+        assert rewritten != query, query
+        assert rewritten.startswith(PREFIX)
+        assert _rows(graph, rewritten) == _rows(graph, query), query
+        assert _rows(graph, query), query
+
+
+def test_only_the_simple_triple_patterns_are_moved():
+    query = PREFIX + f"""SELECT ?feature WHERE {{
+ ?featureList ns1:has_lcms_feature ?feature .
+ ?analysis ns1:has_lcms_feature_list ?featureList .
+ ?feature ns1:has_ionization_mode ?mode .
+ ?rawMaterial ns1:has_lab_process ?labExtract ;
+   ns1:has_wd_id <{TAXON}> .
+ FILTER (?mode IN ("pos", "neg"))
+ VALUES ?mode {{ "pos" "neg" }}
+}}"""
+
+    rewritten = reorder_triple_patterns(query, _statistics())
+
+    assert rewritten.replace("\n", " ").split() != query.replace("\n", " ").split()
+    assert sorted(rewritten.split("\n")) == sorted(query.split("\n"))
+    assert "?rawMaterial ns1:has_lab_process ?labExtract ;\n   ns1:has_wd_id" in rewritten
+    assert reorder_triple_patterns("SELECT ?s WHERE { ?s ?p }", _statistics()) == (
+        "SELECT ?s WHERE { ?s ?p }"
+    )
+    assert reorder_triple_patterns("SELECT ?s WHERE { ?s ?p ?o", _statistics()) == (
+        "SELECT ?s WHERE { ?s ?p ?o"
+    )
+
+
+def test_rdf_graph_reorders_generated_queries_only_when_enabled(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf")
+    assert graph.reorder_triple_patterns is False
+    graph.statistics = _statistics()
+    assert graph.optimize_query(RETENTION_TIME_QUERY) == RETENTION_TIME_QUERY
+
+    graph.reorder_triple_patterns = True
+    assert graph.optimize_query(RETENTION_TIME_QUERY) == reorder_triple_patterns(
+        RETENTION_TIME_QUERY, graph.statistics
+    )
+    graph.statistics = None
+    assert graph.optimize_query(RETENTION_TIME_QUERY) == RETENTION_TIME_QUERY
+
+
+def test_query_cost_grows_with_the_unbound_patterns():
+    bound_to_taxon = estimate_query_cost(EQUIVALENT_QUERIES[1], _statistics())
+    all_taxa = estimate_query_cost(
+        EQUIVALENT_QUERIES[1].replace(f"<{TAXON}>", "?taxon"), _statistics()
+    )
+
+    assert bound_to_taxon.rows == 16
+    assert all_taxa.rows == 48
+    assert all_taxa.cost > bound_to_taxon.cost
+    assert estimate_query_cost("SELECT ?s WHERE { ?s ?p }", _statistics()) is None
+
+
+def test_limit_lowers_the_cost_of_queries_without_blocking_operators():
+    query = EQUIVALENT_QUERIES[2]
+    unordered = query.replace("ORDER BY ?feature", "")
+    full = estimate_query_cost(unordered, _statistics())
+
+    limited = estimate_query_cost(unordered + "\nLIMIT 4", _statistics())
+    ordered = estimate_query_cost(query + "\nLIMIT 4", _statistics())
+
+    assert limited.rows == ordered.rows == 4
+    assert limited.cost < full.cost
+    assert ordered.cost == full.cost
+
+
+def test_joins_on_a_shared_variable_are_not_estimated_as_cartesian_products():
+    subquery = """{
+  SELECT ?featureList WHERE {
+   ?analysis a ns1:LCMSAnalysisPos .
+   ?analysis ns1:has_lcms_feature_list ?featureList .
+  }
+ }"""
+    patterns = "?featureList ns1:has_lcms_feature ?feature . ?feature ns1:has_retention_time ?rt ."
+    joined = estimate_query_cost(
+        PREFIX + f"SELECT ?feature WHERE {{ {subquery} {patterns} }}", _statistics()
+    )
+    unrelated = estimate_query_cost(
+        PREFIX + f"SELECT ?feature WHERE {{ {subquery.replace('featureList', 'list')} {patterns} }}",
+        _statistics(),
+    )
+
+    # 3 positive feature lists of 8 features each (48 features over 6 lists), one retention time each
+    assert joined.rows == 24
+    assert unrelated.rows == 3 * 48
+    assert joined.cost < unrelated.cost
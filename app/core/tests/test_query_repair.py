@@ -0,0 +1,218 @@
+import rdflib
+
+from app.core.graph_management.query_repair import QueryRepairer, shortest_property_path
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_validator import validate_query
+from app.core.tests.test_query_optimizer import _rows
+from app.core.tests.test_schema_validator import ENDPOINT, KG, PREFIX, SCHEMA, _index
+
+
+def _repair(query):
+    repairer = QueryRepairer(_index())
+    repaired = repairer.repair(PREFIX + query)
+    return repaired, repairer.repairs
+
+
+def test_shortest_property_path_follows_the_class_valued_properties():
+    path = shortest_property_path(
+        _index(), {f"{KG}LabExtract"}, {f"{KG}LCMSFeature"}, max_hops=3
+    )
+
+    assert [property_uri for property_uri, _ in path] == [
+        f"{KG}has_LCMS",
+        f"{KG}has_lcms_feature_list",
+        f"{KG}has_lcms_feature",
+    ]
+    assert path[-1][1] == f"{KG}LCMSFeature"
+    assert shortest_property_path(
+        _index(), {f"{KG}LabExtract"}, {f"{KG}LCMSFeature"}, max_hops=2
+    ) is None
+
+
+def test_similar_property_of_the_class_replaces_the_wrong_one():
+    repaired, repairs = _repair(
+        """SELECT ?feature WHERE {
+         ?labExtract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature ?featureList .
+         ?featureList ns1:has_lcms_feature ?feature .
+        }"""
+    )
+
+    assert "?analysis ns1:has_lcms_feature_list ?featureList ." in repaired
+    assert repairs == [
+        "?analysis ns1:has_lcms_feature ?featureList -> ?analysis ns1:has_lcms_feature_list ?featureList"
+    ]
+    assert validate_query(repaired, _index()) == []
+
+
+def test_missing_hops_are_inserted_along_the_shortest_path():
+    repaired, repairs = _repair(
+        """SELECT ?feature WHERE {
+         ?labExtract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_time ?rt .
+        }"""
+    )
+
+    assert "?analysis ns1:has_lcms_feature_list ?lCMSFeatureList .\n" in repaired
+    assert "         ?lCMSFeatureList ns1:has_lcms_feature ?feature ." in repaired
+    assert len(repairs) == 1
+    assert validate_query(repaired, _index()) == []
+
+    repaired, _ = _repair(
+        """SELECT ?list WHERE {
+         ?raw ns1:has_lab_process ?labExtract .
+         ?labExtract ns1:has_lcms_feature_list ?list .
+        }"""
+    )
+    assert "?labExtract ns1:has_LCMS ?" in repaired
+    assert validate_query(repaired, _index()) == []
+
+
+def test_misspelled_properties_are_replaced_and_other_errors_left_to_the_llm():
+    repaired, _ = _repair("SELECT ?rt WHERE { ?f a ns1:LCMSFeature . ?f ns1:has_retention_tme ?rt }")
+    assert repaired == PREFIX + "SELECT ?rt WHERE { ?f a ns1:LCMSFeature . ?f ns1:has_retention_time ?rt }"
+
+    assert _repair('SELECT ?m WHERE { ?m ns1:has_wd_id "Q157115" }') == (None, [])
+    assert _repair("SELECT ?x WHERE { ?x ns1:has_unrelated_property ?y }")[0] is None
+    query = "SELECT ?rt WHERE { ?f ns1:has_retention_time ?rt }"
+    assert _repair(query)[0] == PREFIX + query
+
+
+def test_rdf_graph_repairs_only_when_enabled(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf")
+    graph.schema_graph = rdflib.Graph()
+    graph.schema_graph.parse(data=SCHEMA, format="turtle")
+    query = PREFIX + "SELECT ?rt WHERE { ?f a ns1:LCMSFeature . ?f ns1:has_retention_tme ?rt }"
+
+    graph.validate_queries, graph.repair_queries = True, False
+    assert graph.repair_query(query) is None
+    graph.repair_queries = True
+    assert "ns1:has_retention_time" in graph.repair_query(query)
+
+
+REPAIRED_QUERIES = [
+    # Missing hop between the lab extracts and their analyses
+    (
+        """SELECT ?extract ?feature WHERE {
+         ?extract a ns1:LabExtract .
+         ?extract ns1:has_lcms_feature_list ?list .
+         ?list ns1:has_lcms_feature ?feature .
+        }""",
+        """SELECT ?extract ?feature WHERE {
+         ?extract a ns1:LabExtract .
+         ?extract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature_list ?list .
+         ?list ns1:has_lcms_feature ?feature .
+        }""",
+    ),
+    # Missing hop in an OPTIONAL group, FILTER on the optional variable
+    (
+        """SELECT ?analysis ?feature WHERE {
+         ?analysis a ns1:LCMSAnalysisPos .
+         OPTIONAL { ?analysis ns1:has_lcms_feature ?feature . }
+         FILTER(BOUND(?feature))
+        }""",
+        """SELECT ?analysis ?feature WHERE {
+         ?analysis a ns1:LCMSAnalysisPos .
+         OPTIONAL { ?analysis ns1:has_lcms_feature_list ?list . ?list ns1:has_lcms_feature ?feature . }
+         FILTER(BOUND(?feature))
+        }""",
+    ),
+    # Misspelled property, FILTER on a BIND variable
+    (
+        """SELECT ?feature ?rt2 WHERE {
+         ?extract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature_list ?list .
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_tme ?rt .
+         BIND(?rt * 2 AS ?rt2)
+         FILTER(?rt2 > 1)
+        }""",
+        """SELECT ?feature ?rt2 WHERE {
+         ?extract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature_list ?list .
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_time ?rt .
+         BIND(?rt * 2 AS ?rt2)
+         FILTER(?rt2 > 1)
+        }""",
+    ),
+    # Property of the wrong class in a query with aggregates, HAVING and ORDER BY
+    (
+        """SELECT ?analysis (COUNT(?feature) AS ?features) (MAX(?rt) AS ?maxRt) WHERE {
+         ?analysis a ns1:LCMSAnalysisPos .
+         ?analysis ns1:has_lcms_feature ?list .
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_time ?rt .
+        }
+        GROUP BY ?analysis
+        HAVING (COUNT(?feature) > 2)
+        ORDER BY DESC(?features)""",
+        """SELECT ?analysis (COUNT(?feature) AS ?features) (MAX(?rt) AS ?maxRt) WHERE {
+         ?analysis a ns1:LCMSAnalysisPos .
+         ?analysis ns1:has_lcms_feature_list ?list .
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_time ?rt .
+        }
+        GROUP BY ?analysis
+        HAVING (COUNT(?feature) > 2)
+        ORDER BY DESC(?features)""",
+    ),
+    (
+        """SELECT ?list (GROUP_CONCAT(STR(?rt); separator=",") AS ?rts) WHERE {
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_tme ?rt .
+        }
+        GROUP BY ?list""",
+        """SELECT ?list (GROUP_CONCAT(STR(?rt); separator=",") AS ?rts) WHERE {
+         ?list ns1:has_lcms_feature ?feature .
+         ?feature ns1:has_retention_time ?rt .
+        }
+        GROUP BY ?list""",
+    ),
+]
+
+
+def test_repaired_queries_return_the_rows_of_the_correct_query(local_endpoint):
+    for query, correct in REPAIRED_QUERIES:
+        repaired, repairs = _repair(query)
+
+        assert repairs, query
+        assert repaired.startswith(PREFIX)
+        assert validate_query(repaired, _index()) == []
+        assert _rows(local_endpoint.graph, repaired) == _rows(
+            local_endpoint.graph, PREFIX + correct
+        ), query
+        assert _rows(local_endpoint.graph, repaired), query
+
+    repaired, _ = _repair(REPAIRED_QUERIES[2][0])
+    assert repaired == PREFIX + REPAIRED_QUERIES[2][1]
+
+
+def test_hops_are_not_inserted_in_queries_with_bind_aggregates_or_subqueries():
+    # The missing hop of the first repaired query, in queries the text rewrite could change the meaning of
+    hop = (
+        "?extract a ns1:LabExtract . ?extract ns1:has_lcms_feature_list ?list . "
+        "?list ns1:has_lcms_feature ?feature ."
+    )
+    queries = [
+        f"""SELECT ?feature ?rt2 WHERE {{
+         {hop} ?feature ns1:has_retention_time ?rt .
+         BIND(?rt * 2 AS ?rt2) FILTER(?rt2 > 1)
+        }}""",
+        f"SELECT ?extract (COUNT(?feature) AS ?n) WHERE {{ {hop} }} GROUP BY ?extract",
+        f"""SELECT ?feature WHERE {{
+         {{ SELECT ?extract WHERE {{ ?extract ns1:has_LCMS ?analysis . }} }}
+         {hop}
+        }}""",
+        # Subqueries are left to the LLM even for a misspelled property
+        """SELECT ?rt WHERE {
+         { SELECT ?f WHERE { ?f a ns1:LCMSFeature . } }
+         ?f ns1:has_retention_tme ?rt .
+        }""",
+    ]
+
+    for query in queries:
+        assert _repair(query) == (None, []), query
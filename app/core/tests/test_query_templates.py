@@ -0,0 +1,147 @@
+import pytest
+
+from app.core.agents.sparql.query_templates import (
+    QueryTemplate,
+    QueryTemplateError,
+    TemplateEngine,
+)
+
+
+TAXON = "Datura metel has the Wikidata IRI http://www.wikidata.org/entity/Q157115."
+NPC_CLASS = (
+    "tropane alkaloids has the NPC class IRI https://enpkg.commons-lab.org/kg/npc_Tropane_alkaloids"
+)
+TARGET = (
+    "the target ChEMBLTarget IRI is https://www.ebi.ac.uk/chembl/target_report_card/CHEMBL612348"
+)
+# Entities of the bundled fixture, by slot type
+FIXTURE_ENTITIES = {"taxon": TAXON, "npc_class": NPC_CLASS, "chembl_target": TARGET}
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return TemplateEngine.from_file()
+
+
+def test_bundled_templates_answer_their_example_questions(engine, local_endpoint):
+    for template in engine.templates:
+        entities = "; ".join(
+            FIXTURE_ENTITIES[t] for t in sorted(template.entity_types) if t in FIXTURE_ENTITIES
+        )
+        for question in template.questions:
+            match = engine.match(question, entities)
+
+            assert match is not None and match.template is template, question
+            rows = local_endpoint.graph.query(match.query)
+            if "number" not in {slot["type"] for slot in template.slots.values()}:
+                assert len(rows) > 0, question
+
+
+def test_slots_are_filled_from_the_question_and_its_entities(engine):
+    match = engine.match("Which features were detected in Datura metel in positive mode?", TAXON)
+    assert match.template.id == "taxon_features_by_ionization"
+    assert match.values == {
+        "WDTaxon": "<http://www.wikidata.org/entity/Q157115>",
+        "IonizationMode": '"pos"',
+    }
+    assert 'ns1:has_ionization "pos"' in match.query
+
+    match = engine.match(
+        "How many features are annotated as tropane alkaloids with a probability above 85% in each extract?",
+        NPC_CLASS,
+    )
+    assert match.template.id == "npc_class_features_above_probability"
+    assert "FILTER(?probability > 0.85)" in match.query
+
+    match = engine.match("Which compounds have an IC50 below 500 against this target?", TARGET)
+    assert match.template.id == "chembl_target_activities_of_type_below"
+    assert match.values["ActivityType"] == '"IC50"'
+    assert 'FILTER(?activityType = "IC50")' in match.query
+    assert "FILTER(?activityValue < 500)" in match.query
+
+    match = engine.match("Which compounds have an IC50 below 500 nM against this target?", TARGET)
+    assert match.template.id == "chembl_target_activities_of_type_below_in_unit"
+    assert match.values == {
+        "ChEMBLTarget": "<https://www.ebi.ac.uk/chembl/target_report_card/CHEMBL612348>",
+        "ActivityType": '"IC50"',
+        "ActivityUnit": '"nM"',
+        "MaxActivityValue": "500",
+    }
+    assert 'FILTER(?activityUnit = "nM")' in match.query
+
+
+def test_activity_type_filter_keeps_only_the_activities_of_that_type(engine, local_endpoint):
+    match = engine.match("Which compounds have a Ki below 500 against this target?", TARGET)
+    assert match.template.id == "chembl_target_activities_of_type_below"
+    assert len(local_endpoint.graph.query(match.query)) == 0
+
+    rows = local_endpoint.graph.query(
+        engine.match("Which compounds have an IC50 below 500 against this target?", TARGET).query
+    )
+    assert [(str(row["activityType"]), float(row["activityValue"])) for row in rows] == [
+        ("IC50", 203.4)
+    ]
+
+
+def test_questions_that_no_template_fully_answers_are_not_matched(engine):
+    # No template uses two ionization modes, an InChIKey or two taxa
+    assert engine.match("Which features were detected in positive and negative mode?", TAXON) is None
+    assert engine.match(
+        "What is the SMILES of this compound?",
+        "caffeine has the IRI https://enpkg.commons-lab.org/kg/RYYVLZVUVIJVGH-UHFFFAOYSA-N",
+    ) is None
+    assert engine.match(
+        "Which features were detected in these taxa?",
+        f"{TAXON} Melia azedarach has the Wikidata IRI http://www.wikidata.org/entity/Q157116",
+    ) is None
+    # Two thresholds, and no threshold for the template filtering on the probability
+    assert engine.match("Which compounds have an IC50 between 10 and 100 on this target?", TARGET) is None
+    # The count per extract has no probability filter, and "high" is no threshold
+    assert engine.match(
+        "How many features are annotated as tropane alkaloids with a high probability in each extract?",
+        NPC_CLASS,
+    ) is None
+    assert engine.match(
+        "How many features are annotated as tropane alkaloids in each extract?", NPC_CLASS
+    ).template.id == "npc_class_features_per_extract"
+    # The templates without an activity type or unit slot cannot filter on them
+    assert engine.match("Which compounds have an activity value below 50 nM on this target?", TARGET) is None
+    # Unrelated question shape
+    assert engine.match("What is the Wikidata ID of Datura metel?", TAXON) is None
+
+
+def test_questions_with_intents_the_templates_do_not_declare_are_not_matched(engine):
+    # Counting, filtering and negating the features of a taxon, no template answers these
+    for question in [
+        "How many LCMS features were detected in the extracts of Datura metel?",
+        "Which LCMS features of Datura metel have a retention time above 5 minutes?",
+        "Which LCMS features of Datura metel were NOT annotated by SIRIUS?",
+        "Which compounds without a ChEMBL activity were found in Datura metel?",
+    ]:
+        assert engine.match(question, TAXON) is None, question
+
+    assert engine.match("Which LCMS features were detected in Datura metel?", TAXON).template.id == (
+        "taxon_features"
+    )
+
+
+def test_invalid_templates_are_rejected():
+    query = "SELECT ?feature WHERE { ?feature ns1:has_wd_id <WDTaxon> . }"
+
+    with pytest.raises(QueryTemplateError, match="placeholders"):
+        QueryTemplate("t", query, {"Taxon": {"type": "taxon"}}, ["q"])
+    with pytest.raises(QueryTemplateError, match="unknown slot type"):
+        QueryTemplate("t", query, {"WDTaxon": {"type": "species"}}, ["q"])
+    with pytest.raises(QueryTemplateError, match="same type"):
+        QueryTemplate(
+            "t",
+            f"{query} <OtherTaxon>",
+            {"WDTaxon": {"type": "taxon"}, "OtherTaxon": {"type": "taxon"}},
+            ["q"],
+        )
+    with pytest.raises(QueryTemplateError, match="example question"):
+        QueryTemplate("t", query, {"WDTaxon": {"type": "taxon"}}, [])
+    with pytest.raises(QueryTemplateError, match="unknown intents"):
+        QueryTemplate("t", query, {"WDTaxon": {"type": "taxon"}}, ["q"], intents=["ranking"])
+    with pytest.raises(QueryTemplateError, match=r"intents \['count'\]"):
+        QueryTemplate("t", query, {"WDTaxon": {"type": "taxon"}}, ["How many features?"])
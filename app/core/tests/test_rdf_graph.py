@@ -0,0 +1,469 @@
+import csv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+import pytest
+import rdflib
+from rdflib import URIRef
+
+from app.core.graph_management import RdfGraphCustom
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.sparql_store import (
+    SparqlServerError,
+    SparqlSyntaxError,
+    SparqlTimeoutError,
+)
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+
+def _make_graph(monkeypatch, **kwargs):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf", **kwargs)
+    graph.retry_backoff_seconds = 0
+    return graph
+
+
+def test_get_graph_from_classes_queries_classes_concurrently(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    graph.max_workers = 4
+    running = {"current": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def fake_prop_and_val_types(class_uri):
+        with lock:
+            running["current"] += 1
+            running["peak"] = max(running["peak"], running["current"])
+        time.sleep(0.05)
+        with lock:
+            running["current"] -= 1
+        return [(f"{KG}has_name", "http://www.w3.org/2001/XMLSchema#string")]
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", fake_prop_and_val_types)
+    classes = [{"cls": f"{KG}Class{i}"} for i in range(8)]
+
+    schema_graph = graph.get_graph_from_classes(classes)
+
+    assert running["peak"] > 1
+    assert len(schema_graph) == 8
+    assert set(graph.class_timings) == {cl["cls"] for cl in classes}
+
+
+def test_get_graph_from_classes_retries_failed_classes(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    graph.max_retries = 2
+    calls = {}
+
+    def flaky_prop_and_val_types(class_uri):
+        calls[class_uri] = calls.get(class_uri, 0) + 1
+        if calls[class_uri] < 3:
+            raise SparqlServerError("503 Service Unavailable", transient=True)
+        return [(f"{KG}has_LCMS", f"{KG}LCMSAnalysis")]
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", flaky_prop_and_val_types)
+
+    schema_graph = graph.get_graph_from_classes([{"cls": f"{KG}LabExtract"}])
+
+    assert calls[f"{KG}LabExtract"] == 3
+    assert (
+        URIRef(f"{KG}LabExtract"),
+        URIRef(f"{KG}has_LCMS"),
+        URIRef(f"{KG}LCMSAnalysis"),
+    ) in schema_graph
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        SparqlSyntaxError("400 Bad Request"),
+        SparqlTimeoutError("The query timed out."),
+        SparqlServerError("500 Internal Server Error"),
+        ValueError("Could not parse the result"),
+    ],
+)
+def test_get_graph_from_classes_does_not_retry_errors_that_are_not_transient(monkeypatch, error):
+    graph = _make_graph(monkeypatch)
+    graph.max_retries = 2
+    calls = []
+
+    def failing_prop_and_val_types(class_uri):
+        calls.append(class_uri)
+        raise error
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", failing_prop_and_val_types)
+
+    with pytest.raises(ValueError, match="LabExtract"):
+        graph.get_graph_from_classes([{"cls": f"{KG}LabExtract"}])
+    assert calls == [f"{KG}LabExtract"]
+
+
+def test_get_graph_from_classes_reports_classes_that_keep_failing(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    graph.max_retries = 1
+
+    def failing_prop_and_val_types(class_uri):
+        if class_uri.endswith("Broken"):
+            raise ValueError("server error")
+        return []
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", failing_prop_and_val_types)
+
+    with pytest.raises(ValueError, match="Broken"):
+        graph.get_graph_from_classes([{"cls": f"{KG}Fine"}, {"cls": f"{KG}Broken"}])
+
+
+def test_aggregated_extraction_sends_one_query_per_chunk(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    graph.extraction_strategy = "aggregated"
+    graph.aggregated_chunk_size = 2
+    queries = []
+
+    def fake_query(query, **kwargs):
+        queries.append(query)
+        return [
+            {"cls": uri, "property": f"{KG}has_name", "valueType": "Untyped"}
+            for uri in (f"{KG}A", f"{KG}B", f"{KG}C")
+            if f"<{uri}>" in query
+        ] + [{"cls": f"{KG}A", "property": RDF_TYPE, "valueType": f"{KG}A"}]
+
+    monkeypatch.setattr(graph, "query", fake_query)
+
+    schema_graph = graph.get_graph_from_classes(
+        [{"cls": f"{KG}A"}, {"cls": f"{KG}B"}, {"cls": f"{KG}C"}]
+    )
+
+    assert len(queries) == 2
+    assert all("VALUES ?cls" in query for query in queries)
+    assert len(schema_graph) == 3
+
+
+def test_aggregated_extraction_falls_back_to_per_class_queries(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    graph.extraction_strategy = "aggregated"
+    graph.max_retries = 0
+    per_class_calls = []
+
+    def failing_query(query, **kwargs):
+        raise ValueError("An error occurred while querying the graph: 500")
+
+    def fake_prop_and_val_types(class_uri):
+        per_class_calls.append(class_uri)
+        return [(f"{KG}has_name", "Untyped")]
+
+    monkeypatch.setattr(graph, "query", failing_query)
+    monkeypatch.setattr(graph, "get_prop_and_val_types", fake_prop_and_val_types)
+
+    schema_graph = graph.get_graph_from_classes([{"cls": f"{KG}A"}, {"cls": f"{KG}B"}])
+
+    assert sorted(per_class_calls) == [f"{KG}A", f"{KG}B"]
+    assert len(schema_graph) == 2
+
+
+def test_refresh_schema_only_extracts_changed_classes(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    classes = [
+        {"cls": f"{KG}LabExtract", "com": "", "label": ""},
+        {"cls": f"{KG}LCMSFeature", "com": "", "label": ""},
+    ]
+    graph.restore_schema(
+        {
+            "schema": "old schema",
+            "namespaces": [["ns1", KG]],
+            "classes": classes,
+            "triples": [
+                [f"{KG}LabExtract", f"{KG}has_LCMS", f"{KG}LCMSAnalysis"],
+                [f"{KG}LCMSFeature", f"{KG}has_parent_mass", "Untyped"],
+            ],
+            "fingerprints": {f"{KG}LabExtract": "10:3", f"{KG}LCMSFeature": "100:5"},
+        }
+    )
+    extracted = []
+
+    counts = {f"{KG}LabExtract": ("10", "3"), f"{KG}LCMSFeature": ("120", "6")}
+
+    def fake_query(query, **kwargs):
+        for class_uri, (instances, properties) in counts.items():
+            if query == graph.CLS_FINGERPRINT_RDF.format(class_uri=class_uri):
+                return [{"instances": instances, "properties": properties}]
+        return classes
+
+    def fake_prop_and_val_types(class_uri):
+        extracted.append(class_uri)
+        return [(f"{KG}has_retention_time", "http://www.w3.org/2001/XMLSchema#float")]
+
+    monkeypatch.setattr(graph, "query", fake_query)
+    monkeypatch.setattr(graph, "get_prop_and_val_types", fake_prop_and_val_types)
+    monkeypatch.setattr(RdfGraphCustom, "token_counter", len)
+
+    updated = graph.refresh_schema()
+
+    assert updated == [f"{KG}LCMSFeature"]
+    assert extracted == [f"{KG}LCMSFeature"]
+    assert graph.class_fingerprints[f"{KG}LCMSFeature"] == "120:6"
+    assert "has_retention_time" in graph.get_schema
+    assert "has_parent_mass" not in graph.get_schema
+    assert "has_LCMS" in graph.get_schema
+    assert graph.refresh_schema() == []
+
+
+def test_load_schema_fingerprints_the_sampled_classes_before_extracting_them(monkeypatch):
+    load_schema = RdfGraph.load_schema
+    graph = _make_graph(monkeypatch)
+    graph.collect_statistics = False
+    classes = [{"cls": f"{KG}LabExtract"}, {"cls": f"{KG}LCMSFeature"}]
+    events = []
+
+    def fake_query(query, **kwargs):
+        if query == graph.CLS_RDF:
+            return classes
+        if query == graph.CLS_FINGERPRINT_RDF.format(class_uri=f"{KG}LCMSFeature"):
+            raise RdfGraphCustom.SparqlTimeoutError("timed out")
+        events.append("fingerprint")
+        return [{"instances": "3", "properties": "2"}]
+
+    def fake_prop_and_val_types(class_uri):
+        events.append("extract")
+        return [(f"{KG}has_name", "http://www.w3.org/2001/XMLSchema#string")]
+
+    monkeypatch.setattr(graph, "query", fake_query)
+    monkeypatch.setattr(graph, "get_prop_and_val_types", fake_prop_and_val_types)
+    monkeypatch.setattr(RdfGraphCustom, "token_counter", len)
+
+    load_schema(graph)
+
+    assert events == ["fingerprint", "extract", "extract"]
+    # The class whose fingerprint failed is extracted again at the next refresh
+    assert graph.class_fingerprints == {f"{KG}LabExtract": "3:2"}
+    assert "LIMIT 1000" in graph.CLS_FINGERPRINT_RDF
+
+
+def test_interrupted_extraction_resumes_from_progress_file(monkeypatch, tmp_path):
+    progress_path = tmp_path / "schema.progress.jsonl"
+    graph = _make_graph(monkeypatch, progress_path=progress_path)
+    graph.max_retries = 0
+    calls = []
+    broken = {"failing": True}
+
+    def flaky_prop_and_val_types(class_uri):
+        calls.append(class_uri)
+        if class_uri.endswith("Broken") and broken["failing"]:
+            raise ValueError("timeout")
+        return [(f"{KG}has_name", "Untyped")]
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", flaky_prop_and_val_types)
+    classes = [{"cls": f"{KG}A"}, {"cls": f"{KG}Broken"}, {"cls": f"{KG}B"}]
+
+    with pytest.raises(ValueError):
+        graph.get_graph_from_classes(classes)
+
+    assert graph.failed_classes == [f"{KG}Broken"]
+    assert graph.extraction_progress.failed_classes() == [f"{KG}Broken"]
+    assert progress_path.exists()
+
+    calls.clear()
+    broken["failing"] = False
+    schema_graph = graph.get_graph_from_classes(classes)
+
+    assert calls == [f"{KG}Broken"]
+    assert len(schema_graph) == 3
+    assert not progress_path.exists()
+
+
+def test_retry_failed_classes_only_queries_failed_classes(monkeypatch, tmp_path):
+    graph = _make_graph(monkeypatch, progress_path=tmp_path / "progress.jsonl")
+    graph.extraction_progress.record(f"{KG}A", [(f"{KG}has_name", "Untyped")])
+    graph.extraction_progress.record_failure(f"{KG}Broken", ValueError("timeout"))
+    calls = []
+
+    def fake_prop_and_val_types(class_uri):
+        calls.append(class_uri)
+        return []
+
+    monkeypatch.setattr(graph, "get_prop_and_val_types", fake_prop_and_val_types)
+
+    assert graph.retry_failed_classes() == {f"{KG}Broken": []}
+    assert calls == [f"{KG}Broken"]
+    assert set(graph.extraction_progress.load()) == {f"{KG}A", f"{KG}Broken"}
+
+
+def _local_graph(monkeypatch):
+    graph = _make_graph(monkeypatch)
+    local = rdflib.Graph()
+    local.parse(
+        data=f"""
+        @prefix ns1: <{KG}> .
+        @prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+        ns1:feature1 a ns1:LCMSFeature ;
+            ns1:has_retention_time "1.5"^^xsd:float ;
+            ns1:has_comment "first, with a comma\\nand a new line" ;
+            ns1:has_member [ a ns1:MS2Spectrum ] .
+        ns1:feature2 a ns1:LCMSFeature .
+        """,
+        format="turtle",
+    )
+    graph.graph = local
+    return graph
+
+
+ROWS_QUERY = f"""
+PREFIX ns1: <{KG}>
+SELECT ?feature ?rt ?comment ?member WHERE {{
+    ?feature a ns1:LCMSFeature .
+    OPTIONAL {{ ?feature ns1:has_retention_time ?rt }}
+    OPTIONAL {{ ?feature ns1:has_comment ?comment }}
+    OPTIONAL {{ ?feature ns1:has_member ?member }}
+}} ORDER BY ?feature
+"""
+
+
+def test_query_rows_match_csv_results_format(monkeypatch):
+    graph = _local_graph(monkeypatch)
+    res = graph.graph.query(ROWS_QUERY)
+    csv_rows = list(
+        csv.DictReader(StringIO(res.serialize(format="csv").decode("utf-8")))
+    )
+
+    rows = graph.query(ROWS_QUERY)
+
+    assert rows == csv_rows
+    assert rows[0]["rt"] == "1.5"
+    assert rows[1]["rt"] == ""
+    assert rows[0]["member"].startswith("_:")
+
+
+def test_iter_query_is_lazy_but_reports_errors_immediately(monkeypatch):
+    graph = _local_graph(monkeypatch)
+
+    rows = graph.iter_query(ROWS_QUERY)
+
+    assert not isinstance(rows, list)
+    assert next(rows)["feature"] == f"{KG}feature1"
+    with pytest.raises(ValueError):
+        graph.iter_query("SELECT WHERE {")
+
+
+def _features_graph(monkeypatch, n_features):
+    graph = _make_graph(monkeypatch)
+    local = rdflib.Graph()
+    for i in range(n_features):
+        local.add((URIRef(f"{KG}feature{i:03d}"), rdflib.RDF.type, URIRef(f"{KG}LCMSFeature")))
+    graph.graph = local
+    sent = []
+    query = graph.query
+    monkeypatch.setattr(
+        graph, "query", lambda q, *args: sent.append(q) or query(q, *args)
+    )
+    return graph, sent
+
+
+FEATURES_QUERY = f"""
+PREFIX ns1: <{KG}>
+SELECT ?feature WHERE {{ ?feature a ns1:LCMSFeature }} ORDER BY ?feature"""
+
+
+def test_iter_query_pages_fetches_the_result_page_by_page(monkeypatch):
+    graph, sent = _features_graph(monkeypatch, 25)
+
+    pages = list(graph.iter_query_pages(FEATURES_QUERY, page_size=10))
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [row["feature"] for page in pages for row in page] == [
+        f"{KG}feature{i:03d}" for i in range(25)
+    ]
+    assert sent[1].endswith("LIMIT 10\nOFFSET 10")
+
+
+def test_iter_query_pages_stays_within_the_query_slice(monkeypatch):
+    graph, sent = _features_graph(monkeypatch, 25)
+
+    pages = list(
+        graph.iter_query_pages(FEATURES_QUERY + " LIMIT 12 OFFSET 3", page_size=5)
+    )
+
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert pages[0][0]["feature"] == f"{KG}feature003"
+    assert sent[-1].endswith("LIMIT 2\nOFFSET 13")
+
+
+def test_iter_query_pages_without_pagination_sends_the_query_once(monkeypatch):
+    graph, sent = _features_graph(monkeypatch, 3)
+
+    pages = list(graph.iter_query_pages(FEATURES_QUERY, page_size=0))
+
+    assert [len(page) for page in pages] == [3]
+    assert sent == [FEATURES_QUERY]
+
+
+def test_iter_query_pages_keeps_subquery_limits(monkeypatch):
+    graph, sent = _features_graph(monkeypatch, 5)
+    query = f"""
+PREFIX ns1: <{KG}>
+SELECT ?feature WHERE {{
+    {{ SELECT ?feature WHERE {{ ?feature a ns1:LCMSFeature }} ORDER BY ?feature LIMIT 3 }}
+}} ORDER BY ?feature"""
+
+    pages = list(graph.iter_query_pages(query, page_size=2))
+
+    assert [len(page) for page in pages] == [2, 1]
+    assert sent[0].endswith("LIMIT 2\nOFFSET 0")
+
+
+def _slow_graph(monkeypatch, delay=0.2, fail_first_with=None):
+    graph = _make_graph(monkeypatch)
+    graph.result_cache = None
+    graph.schema = "schema"
+    sent = []
+    lock = threading.Lock()
+
+    def slow_iter_query(query, timeout=None, cancellation=None):
+        with lock:
+            sent.append(query)
+            first = len(sent) == 1
+        time.sleep(delay)
+        if first and fail_first_with is not None:
+            raise fail_first_with
+        return iter([{"feature": f"{KG}feature1"}])
+
+    monkeypatch.setattr(graph, "iter_query", slow_iter_query)
+    return graph, sent
+
+
+def test_concurrent_identical_queries_share_one_request(monkeypatch):
+    graph, sent = _slow_graph(monkeypatch)
+    queries = [FEATURES_QUERY, FEATURES_QUERY.replace("\n", "  \n"), FEATURES_QUERY + " # again"]
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(executor.map(graph.query, queries * 2))
+
+    assert len(sent) == 1
+    assert all(rows == [{"feature": f"{KG}feature1"}] for rows in results)
+
+
+def test_different_queries_are_not_coalesced(monkeypatch):
+    graph, sent = _slow_graph(monkeypatch, delay=0.05)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(graph.query, [FEATURES_QUERY, FEATURES_QUERY + " LIMIT 1"]))
+
+    assert len(sent) == 2
+
+
+def test_waiting_queries_are_sent_again_when_the_first_caller_gives_up(monkeypatch):
+    graph, sent = _slow_graph(
+        monkeypatch, fail_first_with=RdfGraphCustom.SparqlQueryCancelled("cancelled")
+    )
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(graph.query, FEATURES_QUERY)
+        time.sleep(0.05)
+        second = executor.submit(graph.query, FEATURES_QUERY)
+
+        with pytest.raises(RdfGraphCustom.SparqlQueryCancelled):
+            first.result()
+        assert second.result() == [{"feature": f"{KG}feature1"}]
+    assert len(sent) == 2
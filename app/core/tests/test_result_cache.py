@@ -0,0 +1,110 @@
+import rdflib
+from rdflib import URIRef
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.result_cache import ResultCache, normalize_query
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+
+QUERY = f"""PREFIX ns1: <{KG}>
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+# Features of the extract
+SELECT ?feature WHERE {{
+    ?feature rdf:type ns1:LCMSFeature .
+}}"""
+
+SAME_QUERY = f"""prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> PREFIX ns1: <{KG}>
+SELECT ?feature WHERE {{ ?feature rdf:type ns1:LCMSFeature . }}  # all of them
+"""
+
+ROWS = [{"feature": f"{KG}feature1"}, {"feature": f"{KG}feature2"}]
+
+
+def test_normalize_query_ignores_comments_whitespace_and_prefix_order():
+    assert normalize_query(QUERY) == normalize_query(SAME_QUERY)
+
+
+def test_normalize_query_keeps_strings_and_iris():
+    query = 'SELECT ?s WHERE { ?s <http://x.org/p#name> "a  # not a comment" }'
+
+    normalized = normalize_query(query)
+
+    assert "<http://x.org/p#name>" in normalized
+    assert '"a  # not a comment"' in normalized
+    assert normalized != normalize_query(query.replace("a  #", "a #"))
+
+
+def test_cache_returns_rows_of_equivalent_queries(tmp_path):
+    cache = ResultCache(tmp_path / "results.sqlite3")
+
+    assert cache.get(ENDPOINT, "v1", QUERY) is None
+    cache.put(ENDPOINT, "v1", QUERY, ROWS)
+
+    assert cache.get(ENDPOINT, "v1", SAME_QUERY) == ROWS
+    assert cache.get(ENDPOINT, "v2", QUERY) is None
+    assert cache.get("http://other/sparql", "v1", QUERY) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["entries"] == 1
+
+
+def test_cache_is_shared_through_the_database_file(tmp_path):
+    ResultCache(tmp_path / "results.sqlite3").put(ENDPOINT, "v1", QUERY, ROWS)
+
+    assert ResultCache(tmp_path / "results.sqlite3").get(ENDPOINT, "v1", QUERY) == ROWS
+
+
+def test_cache_evicts_least_recently_used_entries(tmp_path, monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr("app.core.graph_management.result_cache.time.time", lambda: clock["now"])
+    entry_size = len(b'[{"feature": "x"}]')
+    cache = ResultCache(tmp_path / "results.sqlite3", max_size_bytes=2 * entry_size, ttl_seconds=0)
+
+    for i in range(2):
+        clock["now"] += 1
+        cache.put(ENDPOINT, "v1", f"SELECT * WHERE {{ ?s ?p {i} }}", [{"feature": "x"}])
+    clock["now"] += 1
+    assert cache.get(ENDPOINT, "v1", "SELECT * WHERE { ?s ?p 0 }") is not None
+    clock["now"] += 1
+    cache.put(ENDPOINT, "v1", "SELECT * WHERE { ?s ?p 2 }", [{"feature": "x"}])
+
+    assert cache.get(ENDPOINT, "v1", "SELECT * WHERE { ?s ?p 0 }") is not None
+    assert cache.get(ENDPOINT, "v1", "SELECT * WHERE { ?s ?p 1 }") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_expires_entries_after_ttl(tmp_path, monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr("app.core.graph_management.result_cache.time.time", lambda: clock["now"])
+    cache = ResultCache(tmp_path / "results.sqlite3", ttl_seconds=60)
+    cache.put(ENDPOINT, "v1", QUERY, ROWS)
+
+    clock["now"] += 61
+
+    assert cache.get(ENDPOINT, "v1", QUERY) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_rdf_graph_query_uses_the_result_cache(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf")
+    graph.schema = "schema"
+    local = rdflib.Graph()
+    for row in ROWS:
+        local.add((URIRef(row["feature"]), rdflib.RDF.type, URIRef(f"{KG}LCMSFeature")))
+    graph.graph = local
+    sent = []
+    iter_query = graph.iter_query
+    monkeypatch.setattr(graph, "iter_query", lambda q, *args: sent.append(q) or iter_query(q, *args))
+
+    assert sorted(graph.query(QUERY), key=str) == ROWS
+    assert sorted(graph.query(SAME_QUERY), key=str) == ROWS
+    assert len(sent) == 1
+
+    graph.schema = "new schema"
+    graph.query(QUERY)
+    graph.query(QUERY, use_cache=False)
+    assert len(sent) == 3
+    assert graph.result_cache.stats()["hits"] == 1
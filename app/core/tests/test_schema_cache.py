@@ -0,0 +1,107 @@
+import configparser
+import json
+
+from rdflib import BNode, URIRef
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_cache import (
+    SCHEMA_OPTIONS,
+    SchemaCache,
+    sparql_config_path,
+)
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+
+
+def _schema_data(schema="schema text"):
+    return {
+        "schema": schema,
+        "namespaces": [["ns1", KG]],
+        "classes": [{"cls": f"{KG}LabExtract", "label": "A LabExtract", "com": ""}],
+        "triples": [
+            [f"{KG}LabExtract", f"{KG}has_LCMS", f"{KG}LCMSAnalysis"],
+            [f"{KG}LabExtract", f"{KG}has_comment", "Untyped"],
+        ],
+    }
+
+
+def test_schema_cache_round_trip(tmp_path):
+    cache = SchemaCache(ENDPOINT, cache_dir=tmp_path)
+
+    assert cache.load() is None
+    path = cache.save(_schema_data())
+
+    assert path.parent == tmp_path
+    assert cache.is_valid()
+    assert cache.load() == _schema_data()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_schema_cache_is_keyed_by_endpoint(tmp_path):
+    SchemaCache(ENDPOINT, cache_dir=tmp_path).save(_schema_data())
+    other = SchemaCache("http://localhost:7200/repositories/other", cache_dir=tmp_path)
+
+    assert other.path != SchemaCache(ENDPOINT, cache_dir=tmp_path).path
+    assert other.load() is None
+
+
+def test_schema_cache_ignores_outdated_or_corrupt_entries(tmp_path):
+    cache = SchemaCache(ENDPOINT, cache_dir=tmp_path)
+    cache.save(_schema_data())
+    entry = json.loads(cache.path.read_text(encoding="utf-8"))
+    entry["format_version"] = 0
+    cache.path.write_text(json.dumps(entry), encoding="utf-8")
+
+    assert cache.load() is None
+
+    cache.path.write_text("{not json", encoding="utf-8")
+
+    assert cache.load() is None
+
+
+def test_rdf_graph_restores_schema_data_without_querying(monkeypatch):
+    def fail_load_schema(self):
+        raise AssertionError("the endpoint should not be queried")
+
+    monkeypatch.setattr(RdfGraph, "load_schema", fail_load_schema)
+
+    graph = RdfGraph(query_endpoint=ENDPOINT, schema_data=_schema_data())
+
+    assert graph.get_schema == "schema text"
+    assert graph.get_namespaces() == [("ns1", URIRef(KG))]
+    assert (
+        URIRef(f"{KG}LabExtract"),
+        URIRef(f"{KG}has_LCMS"),
+        URIRef(f"{KG}LCMSAnalysis"),
+    ) in graph.schema_graph
+    assert any(isinstance(o, BNode) for o in graph.schema_graph.objects())
+    assert graph.to_schema_data() == {**_schema_data(), "fingerprints": {}}
+
+
+def test_bundled_schema_cache_matches_default_endpoint():
+    cache = SchemaCache("https://enpkg.commons-lab.org/graphdb/repositories/ENPKG")
+
+    schema_data = cache.load()
+
+    assert schema_data is not None
+    assert "The RDF graph have the following schema" in schema_data["schema"]
+
+
+def test_schema_cache_is_keyed_by_every_extraction_option(tmp_path):
+    def cache_with(section=None, option=None):
+        config = configparser.ConfigParser()
+        config.read(sparql_config_path)
+        if section:
+            config.set(section, option, f"{config.get(section, option, fallback='')} changed")
+        config_path = tmp_path / f"{option}.ini"
+        with open(config_path, "w", encoding="utf-8") as f:
+            config.write(f)
+        return SchemaCache(ENDPOINT, cache_dir=tmp_path, config_path=config_path)
+
+    default = cache_with()
+
+    for section, option in SCHEMA_OPTIONS:
+        assert cache_with(section, option).path != default.path, option
+    assert cache_with("schemaExtraction", "max_workers").path == default.path
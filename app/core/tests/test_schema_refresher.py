@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.graph_management.schema_cache import SchemaCache
+from app.core.graph_management.schema_refresher import SchemaRefresher
+from app.core.workflow import langraph_workflow
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+
+
+class FakeGraph:
+    def __init__(self, schema="v1", updates=None):
+        self.query_endpoint = ENDPOINT
+        self.schema = schema
+        self.classes = [{"cls": "https://enpkg.commons-lab.org/kg/LabExtract"}]
+        self.updates = list(updates or [])
+        self.refresh_calls = 0
+
+    def to_schema_data(self):
+        return {"schema": self.schema, "classes": self.classes}
+
+    def restore_schema(self, schema_data):
+        self.schema = schema_data["schema"]
+
+    def refresh_schema(self):
+        self.refresh_calls += 1
+        if self.updates:
+            self.schema = self.updates.pop(0)
+            return ["https://enpkg.commons-lab.org/kg/LabExtract"]
+        return []
+
+
+def test_refresh_now_saves_refreshed_schema(tmp_path):
+    cache = SchemaCache(ENDPOINT, cache_dir=tmp_path)
+    graph = FakeGraph(updates=["v2"])
+    refresher = SchemaRefresher(graph, cache, interval_seconds=60)
+
+    assert refresher.refresh_now() == ["https://enpkg.commons-lab.org/kg/LabExtract"]
+    assert cache.load()["schema"] == "v2"
+    assert refresher.refresh_now() == []
+
+
+def test_refresh_now_reloads_cache_written_by_another_process(tmp_path):
+    cache = SchemaCache(ENDPOINT, cache_dir=tmp_path)
+    cache.save({"schema": "v1", "classes": []})
+    graph = FakeGraph()
+    refresher = SchemaRefresher(graph, cache, interval_seconds=60)
+
+    cache.save({"schema": "v2", "classes": []})
+    os.utime(cache.path, (time.time() + 10, time.time() + 10))
+    refresher.refresh_now()
+
+    assert graph.schema == "v2"
+    assert graph.refresh_calls == 0
+
+
+def test_background_refresher_swaps_schema(tmp_path):
+    cache = SchemaCache(ENDPOINT, cache_dir=tmp_path)
+    graph = FakeGraph(updates=["v2"])
+    refresher = SchemaRefresher(graph, cache, interval_seconds=0.01)
+
+    refresher.start()
+    deadline = time.time() + 5
+    while graph.schema != "v2" and time.time() < deadline:
+        time.sleep(0.01)
+    refresher.stop(timeout=5)
+
+    assert graph.schema == "v2"
+    assert not refresher.is_running
+
+
+def test_link_kg_database_shares_graph_per_endpoint(tmp_path, monkeypatch):
+    monkeypatch.setenv("METABOT_SCHEMA_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(langraph_workflow, "_shared_graphs", {})
+    SchemaCache(ENDPOINT).save({"schema": "cached schema"})
+
+    first = langraph_workflow.link_kg_database(ENDPOINT, auth=("user", "password"))
+    second = langraph_workflow.link_kg_database(ENDPOINT, auth=("user", "password"))
+
+    assert first is second
+    assert first.get_schema == "cached schema"
+
+
+def test_link_kg_database_extracts_each_endpoint_without_blocking_the_others(monkeypatch):
+    monkeypatch.delenv("SPARQL_USERNAME", raising=False)
+    monkeypatch.setattr(langraph_workflow, "_shared_graphs", {})
+    monkeypatch.setattr(langraph_workflow, "_graph_locks", {})
+    cached = FakeGraph()
+    langraph_workflow._shared_graphs[("http://cached/sparql", None)] = cached
+    extracting = threading.Event()
+    release = threading.Event()
+    created = []
+
+    def slow_create_kg_graph(endpoint_url, auth, refresh_schema):
+        created.append(endpoint_url)
+        extracting.set()
+        release.wait(5)
+        return FakeGraph()
+
+    monkeypatch.setattr(langraph_workflow, "_create_kg_graph", slow_create_kg_graph)
+    monkeypatch.setattr(langraph_workflow, "_start_schema_refresher", lambda key, graph: None)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(langraph_workflow.link_kg_database, ENDPOINT, ("user", "password"))
+        second = executor.submit(langraph_workflow.link_kg_database, ENDPOINT, ("user", "password"))
+        assert extracting.wait(5)
+        # Another endpoint is served while the schema of the first one is extracted
+        assert langraph_workflow.link_kg_database("http://cached/sparql", None) is cached
+        release.set()
+
+        assert first.result(5) is second.result(5)
+    assert created == [ENDPOINT]
@@ -0,0 +1,107 @@
+import rdflib
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_statistics import RDF_TYPE, SchemaStatistics
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+
+
+def _stats_graph(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf")
+    graph.result_cache = None
+    # Queries of a local graph are parsed by rdflib, which is not thread-safe
+    graph.max_workers = 1
+    local = rdflib.Graph()
+    local.parse(
+        data=f"""
+        @prefix ns1: <{KG}> .
+        ns1:list1 a ns1:LCMSFeatureList ;
+            ns1:has_lcms_feature ns1:feature1, ns1:feature2, ns1:feature3 .
+        ns1:list2 a ns1:LCMSFeatureList ;
+            ns1:has_lcms_feature ns1:feature4 .
+        ns1:feature1 a ns1:LCMSFeature ; ns1:has_row_id 1 .
+        ns1:feature2 a ns1:LCMSFeature ; ns1:has_row_id 2 .
+        ns1:feature3 a ns1:LCMSFeature ; ns1:has_row_id 1 .
+        ns1:feature4 a ns1:LCMSFeature .
+        """,
+        format="turtle",
+    )
+    graph.graph = local
+    graph.classes = [{"cls": f"{KG}LCMSFeatureList"}, {"cls": f"{KG}LCMSFeature"}]
+    return graph
+
+
+def test_update_class_counts_instances_and_property_triples():
+    statistics = SchemaStatistics()
+
+    statistics.update_class(
+        f"{KG}LCMSFeature",
+        [
+            {"property": RDF_TYPE, "triples": "4", "subjects": "4", "objects": "1"},
+            {"property": f"{KG}has_row_id", "triples": "3", "subjects": "3", "objects": "2"},
+        ],
+    )
+
+    assert statistics.get_class_instances(f"{KG}LCMSFeature") == 4
+    assert statistics.get_class_instances(f"{KG}Other") is None
+    assert statistics.get_property_counts(f"{KG}has_row_id", f"{KG}LCMSFeature") == {
+        "triples": 3,
+        "subjects": 3,
+        "objects": 2,
+    }
+    assert statistics.largest_properties(1) == [(f"{KG}LCMSFeature", f"{KG}has_row_id", 3)]
+
+
+def test_property_counts_are_summed_over_classes():
+    statistics = SchemaStatistics(
+        property_counts={
+            f"{KG}ChemicalEntity": {f"{KG}has_wd_id": {"triples": 5, "subjects": 5, "objects": 5}},
+            f"{KG}Taxon": {f"{KG}has_wd_id": {"triples": 2, "subjects": 2, "objects": 2}},
+        }
+    )
+
+    assert statistics.get_property_counts(f"{KG}has_wd_id") == {
+        "triples": 7,
+        "subjects": 7,
+        "objects": 7,
+    }
+    assert statistics.get_property_counts(f"{KG}unknown") is None
+
+
+def test_statistics_round_trip_through_data():
+    statistics = SchemaStatistics({f"{KG}A": 3}, {f"{KG}A": {RDF_TYPE: {"triples": 3}}})
+
+    assert SchemaStatistics.from_data(statistics.to_data()) == statistics
+
+
+def test_extract_statistics_queries_every_class(monkeypatch):
+    graph = _stats_graph(monkeypatch)
+
+    statistics = graph.update_statistics()
+
+    assert graph.statistics is statistics
+    assert statistics.get_class_instances(f"{KG}LCMSFeatureList") == 2
+    assert statistics.get_class_instances(f"{KG}LCMSFeature") == 4
+    assert statistics.get_property_counts(
+        f"{KG}has_lcms_feature", f"{KG}LCMSFeatureList"
+    ) == {"triples": 4, "subjects": 2, "objects": 4}
+    assert statistics.get_property_counts(f"{KG}has_row_id") == {
+        "triples": 3,
+        "subjects": 3,
+        "objects": 2,
+    }
+
+
+def test_statistics_are_stored_with_the_schema_data(monkeypatch):
+    graph = _stats_graph(monkeypatch)
+    graph.schema = "schema"
+    assert "statistics" not in graph.to_schema_data()
+
+    graph.update_statistics()
+    restored = _stats_graph(monkeypatch)
+    restored.restore_schema(graph.to_schema_data())
+
+    assert restored.statistics == graph.statistics
@@ -0,0 +1,133 @@
+import rdflib
+
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_validator import (
+    SchemaDiagnostic,
+    SchemaIndex,
+    validate_query,
+)
+
+
+ENDPOINT = "http://localhost:7200/repositories/test"
+KG = "https://enpkg.commons-lab.org/kg/"
+PREFIX = f"PREFIX ns1: <{KG}>\n"
+
+SCHEMA = f"""
+@prefix ns1: <{KG}> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ns1:RawMaterial ns1:has_lab_process ns1:LabExtract ;
+    ns1:has_wd_id ns1:WDTaxon ;
+    ns1:submitted_taxon xsd:string .
+ns1:LabExtract ns1:has_LCMS ns1:LCMSAnalysisPos, ns1:LCMSAnalysisNeg .
+ns1:LCMSAnalysisPos ns1:has_lcms_feature_list ns1:LCMSFeatureList .
+ns1:LCMSAnalysisNeg ns1:has_lcms_feature_list ns1:LCMSFeatureList .
+ns1:LCMSFeatureList ns1:has_lcms_feature ns1:LCMSFeature .
+ns1:LCMSFeature ns1:has_retention_time xsd:float ;
+    ns1:has_parent_mass xsd:float ;
+    ns1:has_sirius_annotation ns1:SiriusStructureAnnotation .
+ns1:SiriusStructureAnnotation ns1:has_InChIkey2D ns1:InChIkey2D ;
+    ns1:has_sirius_adduct [ ] .
+"""
+
+
+def _index() -> SchemaIndex:
+    graph = rdflib.Graph()
+    graph.parse(data=SCHEMA, format="turtle")
+    return SchemaIndex.from_graph(graph)
+
+
+def _codes(query):
+    return [diagnostic.code for diagnostic in validate_query(PREFIX + query, _index())]
+
+
+def test_queries_following_the_schema_have_no_diagnostics():
+    query = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    SELECT ?feature ?rt WHERE {
+     ?rawMaterial ns1:has_wd_id <http://www.wikidata.org/entity/Q157115> .
+     ?rawMaterial ns1:has_lab_process ?labExtract .
+     ?labExtract ns1:has_LCMS ?analysis .
+     ?analysis a ns1:LCMSAnalysisPos .
+     ?analysis ns1:has_lcms_feature_list ?featureList .
+     ?featureList ns1:has_lcms_feature ?feature .
+     ?feature ns1:has_retention_time ?rt .
+     OPTIONAL { ?feature ns1:has_sirius_annotation ?annotation .
+                ?annotation ns1:has_sirius_adduct "[M+H]+" . }
+     ?labExtract rdfs:label ?label .
+    }"""
+
+    assert _codes(query) == []
+
+
+def test_unknown_property_suggests_close_schema_properties():
+    diagnostics = validate_query(
+        PREFIX + "SELECT ?rt WHERE { ?feature ns1:has_retention_tme ?rt }", _index()
+    )
+
+    assert [d.code for d in diagnostics] == [SchemaDiagnostic.UNKNOWN_PROPERTY]
+    assert diagnostics[0].suggestions[0] == f"{KG}has_retention_time"
+    assert "ns1:has_retention_tme" in diagnostics[0].message
+
+
+def test_property_of_another_class_is_reported_with_its_classes():
+    diagnostics = validate_query(
+        PREFIX
+        + """SELECT ?feature WHERE {
+         ?labExtract ns1:has_LCMS ?analysis .
+         ?analysis ns1:has_lcms_feature ?feature .
+        }""",
+        _index(),
+    )
+
+    assert [d.code for d in diagnostics] == [SchemaDiagnostic.PROPERTY_NOT_ON_CLASS]
+    assert diagnostics[0].suggestions == [f"{KG}LCMSFeatureList"]
+    assert diagnostics[0].to_dict()["pattern"] == ["?analysis", f"<{KG}has_lcms_feature>", "?feature"]
+
+
+def test_properties_of_different_classes_on_one_node_are_reported_once():
+    assert _codes(
+        """SELECT ?x WHERE {
+         ?x ns1:has_retention_time ?rt .
+         ?x ns1:has_lcms_feature_list ?list .
+         ?x ns1:has_wd_id ?taxon .
+        }"""
+    ) == [SchemaDiagnostic.INCOMPATIBLE_PROPERTIES]
+
+
+def test_entity_iris_as_subjects_and_values_of_the_wrong_kind():
+    assert _codes(
+        "SELECT ?m WHERE { <http://www.wikidata.org/entity/Q157115> ns1:has_lab_process ?m }"
+    ) == [SchemaDiagnostic.IRI_AS_SUBJECT]
+    assert _codes('SELECT ?m WHERE { ?m ns1:has_wd_id "Q157115" }') == [
+        SchemaDiagnostic.LITERAL_FOR_CLASS
+    ]
+    assert _codes(
+        "SELECT ?m WHERE { ?m ns1:submitted_taxon <http://www.wikidata.org/entity/Q157115> }"
+    ) == [SchemaDiagnostic.IRI_FOR_LITERAL]
+
+
+def test_service_patterns_and_unparsable_queries_are_not_checked():
+    assert _codes(
+        """SELECT ?m WHERE {
+         ?m ns1:has_wd_id ?taxon .
+         SERVICE <https://query.wikidata.org/sparql> { ?taxon <http://x.org/p171> ?parent . }
+        }"""
+    ) == []
+    assert validate_query("SELECT ?s WHERE { ?s ?p }", _index()) == []
+
+
+def test_rdf_graph_validates_against_its_schema_graph(monkeypatch):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=ENDPOINT, standard="rdf")
+    query = PREFIX + "SELECT ?rt WHERE { ?feature ns1:has_retention_tme ?rt }"
+    assert graph.validate_query(query) == []
+
+    graph.validate_queries = True
+    graph.schema_graph = rdflib.Graph()
+    graph.schema_graph.parse(data=SCHEMA, format="turtle")
+    index = graph.schema_index
+
+    assert [d.code for d in graph.validate_query(query)] == [SchemaDiagnostic.UNKNOWN_PROPERTY]
+    assert graph.schema_index is index
+    graph.schema_graph = rdflib.Graph()
+    assert graph.schema_index is not index
@@ -0,0 +1,290 @@
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app.core.graph_management.admission import AdmissionController
+from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.sparql_store import (
+    NegotiatingSPARQLStore,
+    QueryCancellation,
+    SparqlQueryCancelled,
+    SparqlServerError,
+    SparqlSyntaxError,
+    SparqlTimeoutError,
+    build_accept_header,
+    close_endpoint_sessions,
+    get_endpoint_session,
+)
+
+
+KG = "https://enpkg.commons-lab.org/kg/"
+
+CSV_BODY = (
+    "feature,rt,inchikey2d\r\n"
+    f"{KG}lcms_feature_1,1.5,{KG}ABCDEF\r\n"
+    f"{KG}lcms_feature_2,2.5,\r\n"
+    "_:b0,3.5,\r\n"
+)
+
+JSON_BODY = (
+    '{"head": {"vars": ["feature", "rt", "inchikey2d"]}, "results": {"bindings": ['
+    f'{{"feature": {{"type": "uri", "value": "{KG}lcms_feature_1"}}, '
+    '"rt": {"type": "literal", "value": "1.5", "datatype": "http://www.w3.org/2001/XMLSchema#float"}, '
+    f'"inchikey2d": {{"type": "uri", "value": "{KG}ABCDEF"}}}}, '
+    f'{{"feature": {{"type": "uri", "value": "{KG}lcms_feature_2"}}, '
+    '"rt": {"type": "literal", "value": "2.5", "datatype": "http://www.w3.org/2001/XMLSchema#float"}}, '
+    '{"feature": {"type": "bnode", "value": "b0"}, "rt": {"type": "literal", "value": "3.5"}}'
+    "]}}"
+)
+
+EXPECTED_ROWS = [
+    {"feature": f"{KG}lcms_feature_1", "rt": "1.5", "inchikey2d": f"{KG}ABCDEF"},
+    {"feature": f"{KG}lcms_feature_2", "rt": "2.5", "inchikey2d": ""},
+    {"feature": "_:b0", "rt": "3.5", "inchikey2d": ""},
+]
+
+QUERY = "SELECT ?feature ?rt ?inchikey2d WHERE { ?feature ?p ?rt }"
+
+
+@pytest.fixture
+def endpoint():
+    """Local SPARQL endpoint answering every query with the same result, in CSV or JSON."""
+    requests_seen = []
+    formats = {"supported": ["text/csv", "application/sparql-results+json"]}
+    # Statuses returned by the next requests, and delay before each answer
+    behaviour = {"statuses": [], "delay": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keeps connections open between requests
+        protocol_version = "HTTP/1.1"
+
+        def _answer(self, query):
+            requests_seen.append(
+                {
+                    "headers": dict(self.headers),
+                    "query": query,
+                    "client": self.client_address,
+                }
+            )
+            time.sleep(behaviour["delay"])
+            if behaviour["statuses"]:
+                self.send_response(behaviour["statuses"].pop(0))
+                self.send_header("Content-Length", "5")
+                self.end_headers()
+                self.wfile.write(b"error")
+                return
+            accept = self.headers.get("Accept", "")
+            content_type = next(
+                (f for f in formats["supported"] if f in accept), None
+            )
+            if content_type is None or query is None:
+                self.send_response(406)
+                self.send_header("Content-Length", "14")
+                self.end_headers()
+                self.wfile.write(b"Not acceptable")
+                return
+            body = (CSV_BODY if content_type == "text/csv" else JSON_BODY).encode()
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body)
+                encoding = "gzip"
+            else:
+                encoding = None
+            self.send_response(200)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            self._answer(params.get("query", [None])[0])
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            params = parse_qs(self.rfile.read(length).decode())
+            self._answer(params.get("query", [None])[0])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    # Clients that time out or cancel close their connection before the answer
+    server.handle_error = lambda request, client_address: None
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield {
+        "url": f"http://127.0.0.1:{server.server_port}/sparql",
+        "requests": requests_seen,
+        "formats": formats,
+        "behaviour": behaviour,
+    }
+    close_endpoint_sessions()
+    server.shutdown()
+    server.server_close()
+
+
+def _make_graph(monkeypatch, url, result_formats=None):
+    monkeypatch.setattr(RdfGraph, "load_schema", lambda self: None)
+    graph = RdfGraph(query_endpoint=url, standard="rdf")
+    graph.query_retry_backoff_seconds = 0
+    if result_formats is not None:
+        graph._store.result_formats = result_formats
+        graph._store.accept_header = build_accept_header(result_formats)
+    return graph
+
+
+def test_build_accept_header_orders_formats_by_preference():
+    assert build_accept_header(["csv", "json", "xml"]) == (
+        "text/csv, application/sparql-results+json;q=0.9, application/sparql-results+xml;q=0.8"
+    )
+
+
+def test_store_rejects_unknown_result_format():
+    with pytest.raises(ValueError, match="Invalid result formats"):
+        NegotiatingSPARQLStore(result_formats=["parquet"])
+
+
+def test_query_negotiates_gzipped_csv(monkeypatch, endpoint):
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    assert graph.query(QUERY) == EXPECTED_ROWS
+    headers = endpoint["requests"][0]["headers"]
+    assert headers["Accept"].startswith("text/csv")
+    assert "gzip" in headers["Accept-Encoding"]
+    assert graph._store.negotiated_format == "csv"
+
+
+def test_query_falls_back_to_json_with_the_same_rows(monkeypatch, endpoint):
+    endpoint["formats"]["supported"] = ["application/sparql-results+json"]
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    assert graph.query(QUERY) == EXPECTED_ROWS
+    assert graph._store.negotiated_format == "json"
+
+
+def test_long_queries_are_posted(monkeypatch, endpoint):
+    graph = _make_graph(monkeypatch, endpoint["url"])
+    long_query = QUERY + " #" + "x" * 3000
+
+    assert graph.query(long_query) == EXPECTED_ROWS
+    assert endpoint["requests"][0]["query"] == long_query
+
+
+def test_query_reports_http_errors(monkeypatch, endpoint):
+    endpoint["formats"]["supported"] = []
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    with pytest.raises(ValueError, match="406"):
+        graph.query(QUERY)
+
+
+def test_graphs_of_an_endpoint_share_pooled_connections(monkeypatch, endpoint):
+    graphs = [_make_graph(monkeypatch, endpoint["url"]) for _ in range(2)]
+
+    for _ in range(3):
+        for graph in graphs:
+            assert graph.query(QUERY) == EXPECTED_ROWS
+
+    assert graphs[0]._store.session is graphs[1]._store.session
+    assert len({request["client"] for request in endpoint["requests"]}) == 1
+
+
+def test_endpoint_sessions_are_shared_per_host():
+    try:
+        session = get_endpoint_session("http://127.0.0.1:7200/repositories/a")
+
+        assert get_endpoint_session("http://127.0.0.1:7200/repositories/b") is session
+        assert get_endpoint_session("http://127.0.0.1:7201/repositories/a") is not session
+    finally:
+        close_endpoint_sessions()
+
+
+def test_transient_errors_are_retried(monkeypatch, endpoint):
+    endpoint["behaviour"]["statuses"] = [503, 502]
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    assert graph.query(QUERY) == EXPECTED_ROWS
+    assert len(endpoint["requests"]) == 3
+
+
+def test_transient_errors_are_reported_after_the_last_retry(monkeypatch, endpoint):
+    endpoint["behaviour"]["statuses"] = [503, 503, 503]
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    with pytest.raises(SparqlServerError) as error:
+        graph.query(QUERY)
+
+    assert error.value.transient
+    assert len(endpoint["requests"]) == 3
+
+
+@pytest.mark.parametrize(
+    "status, error_type",
+    [(400, SparqlSyntaxError), (500, SparqlServerError)],
+)
+def test_other_errors_are_not_retried(monkeypatch, endpoint, status, error_type):
+    endpoint["behaviour"]["statuses"] = [status]
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    with pytest.raises(error_type):
+        graph.query(QUERY)
+
+    assert len(endpoint["requests"]) == 1
+
+
+def test_query_times_out_at_its_deadline(monkeypatch, endpoint):
+    endpoint["behaviour"]["delay"] = 2
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    start = time.monotonic()
+    with pytest.raises(SparqlTimeoutError):
+        graph.query(QUERY, timeout=0.3)
+
+    assert time.monotonic() - start < 1.5
+
+
+def test_query_is_cancelled_while_waiting_for_the_endpoint(monkeypatch, endpoint):
+    endpoint["behaviour"]["delay"] = 2
+    graph = _make_graph(monkeypatch, endpoint["url"])
+    cancellation = QueryCancellation()
+    threading.Timer(0.2, cancellation.cancel).start()
+
+    start = time.monotonic()
+    with pytest.raises(SparqlQueryCancelled):
+        graph.query(QUERY, cancellation=cancellation)
+
+    assert time.monotonic() - start < 1.5
+    with pytest.raises(SparqlQueryCancelled):
+        graph.query(QUERY, cancellation=cancellation)
+
+
+def test_cancelled_query_frees_its_slot_and_its_worker(monkeypatch, endpoint):
+    endpoint["behaviour"]["delay"] = 3
+    graph = _make_graph(monkeypatch, endpoint["url"])
+    graph.admission_controller = AdmissionController(endpoint["url"], max_concurrent=1, max_queued=0)
+    cancellation = QueryCancellation()
+    threading.Timer(0.2, cancellation.cancel).start()
+
+    with pytest.raises(SparqlQueryCancelled):
+        graph.query(QUERY, cancellation=cancellation)
+
+    assert graph.admission_controller.stats()["running"] == 0
+    # The only worker thread of the endpoint stopped waiting for the slow answer
+    endpoint["behaviour"]["delay"] = 0
+    start = time.monotonic()
+    assert graph.query(QUERY, cancellation=QueryCancellation()) == EXPECTED_ROWS
+    assert time.monotonic() - start < 1.5
+
+
+def test_query_with_cancellation_returns_rows(monkeypatch, endpoint):
+    graph = _make_graph(monkeypatch, endpoint["url"])
+
+    assert graph.query(QUERY, cancellation=QueryCancellation()) == EXPECTED_ROWS
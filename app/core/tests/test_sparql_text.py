@@ -0,0 +1,54 @@
+from rdflib import RDF, XSD, Literal, URIRef, Variable
+
+from app.core.graph_management.sparql_text import triple_runs, write_term
+
+
+KG = "https://enpkg.commons-lab.org/kg/"
+PREFIX = f"PREFIX ns1: <{KG}>\n"
+
+
+def test_runs_of_simple_triple_patterns_are_found_in_each_group():
+    query = PREFIX + """SELECT ?feature WHERE {
+     ?analysis a ns1:LCMSAnalysisPos .
+     ?analysis ns1:has_lcms_feature_list ?list .
+     BIND("x" AS ?label)
+     ?list ns1:has_lcms_feature ?feature ; ns1:has_id ?id .
+     ?feature ns1:has_retention_time 2.5 .
+     ?feature ns1:has_label "a {b} ?c ." . # ?s ?p ?o .
+     OPTIONAL { ?feature ns1:has_sirius_annotation ?annotation }
+     VALUES ?feature { ns1:f1 ns1:f2 ns1:f3 }
+     { SELECT ?list WHERE { ?list ns1:has_size ?size } GROUP BY ?list ?size ?x }
+    }"""
+
+    runs = triple_runs(query)
+
+    assert [[triple.pattern for triple in run] for run in runs] == [
+        [
+            (Variable("analysis"), RDF.type, URIRef(f"{KG}LCMSAnalysisPos")),
+            (Variable("analysis"), URIRef(f"{KG}has_lcms_feature_list"), Variable("list")),
+        ],
+        [
+            (
+                Variable("feature"),
+                URIRef(f"{KG}has_retention_time"),
+                Literal("2.5", datatype=XSD.decimal),
+            ),
+            (Variable("feature"), URIRef(f"{KG}has_label"), Literal("a {b} ?c .")),
+        ],
+        [(Variable("feature"), URIRef(f"{KG}has_sirius_annotation"), Variable("annotation"))],
+        [(Variable("list"), URIRef(f"{KG}has_size"), Variable("size"))],
+    ]
+    triple = runs[1][0]
+    assert query[triple.start : triple.end] == "?feature ns1:has_retention_time 2.5"
+    assert triple_runs("SELECT ?s WHERE { ?s ?p ?o") is None
+
+
+def test_terms_are_written_with_the_prefixes_of_the_query():
+    namespaces = {"ns1": KG}
+
+    assert write_term(URIRef(f"{KG}has_LCMS"), namespaces) == "ns1:has_LCMS"
+    assert write_term(URIRef("http://www.wikidata.org/entity/Q1"), namespaces) == (
+        "<http://www.wikidata.org/entity/Q1>"
+    )
+    assert write_term(RDF.type, namespaces) == "a"
+    assert write_term(Variable("list"), namespaces) == "?list"
@@ -1,11 +1,31 @@
+import csv
+import os
+import threading
+import time
+
+import pytest
+
 from app.core.agents.sparql import agent as sparql_agent
 from app.core.agents.sparql import tool_sparql
+from app.core.agents.sparql.query_library import QueryLibrary
+from app.core.agents.sparql.query_templates import TemplateEngine
+from app.core.graph_management.query_optimizer import QueryCost
+from app.core.graph_management.schema_validator import SchemaDiagnostic
+from app.core.graph_management.sparql_store import SparqlQueryCancelled, SparqlSyntaxError
 
 
 def _construct_tool(**kwargs):
     return tool_sparql.GraphSparqlQAChain.model_construct(**kwargs)
 
 
+@pytest.fixture(autouse=True)
+def fresh_schema_node_indexes():
+    """Makes each test load the schema node index with its own fakes."""
+    tool_sparql.clear_schema_node_indexes()
+    yield
+    tool_sparql.clear_schema_node_indexes()
+
+
 def test_create_agent_passes_openai_key_to_import_tools(monkeypatch):
     captured = {}
 
@@ -124,3 +144,566 @@ def test_search_nodes_falls_back_to_env_openai_key(monkeypatch):
     assert captured["limit"] == 12
     assert captured["allow_dangerous_deserialization"] is True
     assert result == ["related-node"]
+
+
+def test_schema_node_index_is_loaded_once_and_reloaded_when_its_files_change(
+    monkeypatch, tmp_path
+):
+    loads = []
+
+    class FakeVectorStore:
+        def similarity_search(self, query, limit):
+            return [f"node-{len(loads)}"]
+
+    def fake_load_local(path, embeddings, allow_dangerous_deserialization=False):
+        loads.append(path)
+        time.sleep(0.05)
+        return FakeVectorStore()
+
+    monkeypatch.setattr(tool_sparql, "OpenAIEmbeddings", lambda **kwargs: object())
+    monkeypatch.setattr(tool_sparql.FAISS, "load_local", fake_load_local)
+    monkeypatch.setattr(tool_sparql, "SCHEMA_NODE_INDEX_PATH", tmp_path)
+    index_file = tmp_path / "index.faiss"
+    index_file.write_bytes(b"index")
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(_construct_tool(openai_key="key").search_nodes("q"))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [str(tmp_path)]
+    assert results == [["node-1"]] * 4
+
+    stat = index_file.stat()
+    os.utime(index_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert _construct_tool(openai_key="key").search_nodes("q") == ["node-2"]
+    assert _construct_tool(openai_key="key").search_nodes("q") == ["node-2"]
+    assert len(loads) == 2
+
+
+class FakeChain:
+    def __init__(self, output):
+        self.output = output
+        self.calls = []
+
+    def run(self, inputs):
+        self.calls.append(inputs)
+        return self.output
+
+
+class FakeDatabase:
+    records = []
+
+    def put(self, data, tool_name):
+        self.records.append((tool_name, data))
+
+
+class PagedGraph:
+    get_schema = "schema"
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.queries = []
+
+    def optimize_query(self, query):
+        return query
+
+    def validate_query(self, query):
+        return []
+
+    def repair_query(self, query):
+        return None
+
+    def iter_query_pages(self, query, cancellation=None):
+        self.queries.append(query)
+        return iter(self.pages)
+
+
+def _patch_session(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        tool_sparql, "create_user_session", lambda session_id, user_session_dir: tmp_path
+    )
+    monkeypatch.setattr(tool_sparql, "tools_database", FakeDatabase)
+    monkeypatch.setattr(tool_sparql, "token_counter", len)
+
+
+def test_run_writes_every_page_and_previews_the_first_one(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    pages = [
+        [{"feature": f"feature{i}", "rt": str(i)} for i in range(start, start + 3)]
+        for start in (0, 3, 6)
+    ]
+    graph = PagedGraph(pages)
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain("SELECT ?feature ?rt WHERE {}"),
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert output["result"] == pages[0]
+    assert output["row_count"] == 9
+    assert output["result_is_preview"] is True
+    with open(output["temp_file_path"], newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [row for page in pages for row in page]
+
+
+def test_run_returns_single_page_results_unchanged(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    page = [{"feature": "feature0", "rt": "0"}]
+    tool = _construct_tool(
+        graph=PagedGraph([page]),
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain("SELECT ?feature ?rt WHERE {}"),
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert output["result"] == page
+    assert "result_is_preview" not in output
+
+
+class BlockingGraph(PagedGraph):
+    """Graph whose first query runs until it is cancelled."""
+
+    def __init__(self, pages):
+        super().__init__(pages)
+        self.cancellations = []
+        self.started = threading.Event()
+
+    def iter_query_pages(self, query, cancellation=None):
+        self.cancellations.append(cancellation)
+        if len(self.cancellations) == 1:
+            self.started.set()
+            cancellation.wait(5)
+            cancellation.raise_if_cancelled()
+        return super().iter_query_pages(query, cancellation)
+
+
+def test_cancelling_a_session_aborts_its_question_but_not_the_next_ones(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    page = [{"feature": "feature0", "rt": "0"}]
+    graph = BlockingGraph([page])
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain("SELECT ?feature ?rt WHERE {}"),
+    )
+    errors = []
+
+    def run():
+        try:
+            tool._run("Which features?", "")
+        except SparqlQueryCancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert graph.started.wait(5)
+    assert tool_sparql.cancel_session_queries("other-session") == 0
+    assert tool_sparql.cancel_session_queries("session-123") == 1
+    thread.join(5)
+
+    assert len(errors) == 1
+    output = tool._run("Which features?", "")["result"]
+    assert output["result"] == page
+    first, second = graph.cancellations
+    assert first is not second and not second.is_cancelled
+    assert tool_sparql.cancel_session_queries("session-123") == 0
+
+
+class CostGraph(PagedGraph):
+    def __init__(self, pages, costs):
+        super().__init__(pages)
+        self.costs = costs
+
+    def estimate_query_cost(self, query):
+        return self.costs.get(query)
+
+
+EXPENSIVE_QUERY = "SELECT ?feature ?rt WHERE { ?list <urn:has_feature> ?feature . }"
+CHEAP_QUERY = "SELECT ?feature ?rt WHERE { ?list <urn:has_feature> ?feature . ?list <urn:of> <urn:taxon> . }"
+
+
+def _cost_tool(monkeypatch, tmp_path, policy, reformulation=CHEAP_QUERY):
+    _patch_session(monkeypatch, tmp_path)
+    graph = CostGraph(
+        [[{"feature": "feature0", "rt": "0"}]],
+        {EXPENSIVE_QUERY: QueryCost(10**7, 10**9), CHEAP_QUERY: QueryCost(100, 1000)},
+    )
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain(EXPENSIVE_QUERY),
+        sparql_reformulation_chain=FakeChain(reformulation),
+        max_query_cost=10**6,
+        query_cost_policy=policy,
+        query_cost_max_rows=500,
+    )
+    return tool, graph
+
+
+def test_expensive_queries_are_limited(monkeypatch, tmp_path):
+    tool, graph = _cost_tool(monkeypatch, tmp_path, "limit")
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [f"{EXPENSIVE_QUERY}\nLIMIT 500"]
+    assert output["query"] == graph.queries[0]
+    assert "limited to its first 500 rows" in output["warning"]
+    assert tool.sparql_reformulation_chain.calls == []
+
+
+def test_expensive_queries_are_reformulated(monkeypatch, tmp_path):
+    tool, graph = _cost_tool(monkeypatch, tmp_path, "reformulate")
+
+    output = tool._run("Which features of the taxon?", "taxon has the IRI urn:taxon")["result"]
+
+    assert graph.queries == [CHEAP_QUERY]
+    assert "warning" not in output
+    call = tool.sparql_reformulation_chain.calls[0]
+    assert call["generated_sparql"] == EXPENSIVE_QUERY
+    assert call["estimated_cost"] == "1000000000"
+
+
+def test_expensive_reformulations_fall_back_to_a_limit(monkeypatch, tmp_path):
+    tool, graph = _cost_tool(monkeypatch, tmp_path, "reformulate", reformulation="not sparql")
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [f"{EXPENSIVE_QUERY}\nLIMIT 500"]
+    assert "warning" in output
+
+
+def test_expensive_queries_are_sent_with_a_warning(monkeypatch, tmp_path):
+    tool, graph = _cost_tool(monkeypatch, tmp_path, "warn")
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [EXPENSIVE_QUERY]
+    assert "may time out" in output["warning"]
+
+
+def test_limit_query_keeps_smaller_limits_and_offsets():
+    limit_query = tool_sparql.GraphSparqlQAChain.limit_query
+
+    assert limit_query(f"{EXPENSIVE_QUERY} LIMIT 10", 500) == f"{EXPENSIVE_QUERY} LIMIT 10"
+    assert limit_query(f"{EXPENSIVE_QUERY} OFFSET 20 LIMIT 1000", 500) == (
+        f"{EXPENSIVE_QUERY}\nLIMIT 500\nOFFSET 20"
+    )
+    assert limit_query("ASK { ?s ?p ?o }", 500) == "ASK { ?s ?p ?o }"
+
+
+class ValidatingGraph(PagedGraph):
+    def __init__(self, pages, invalid_queries, repairs=None, code=None, failing_queries=None):
+        super().__init__(pages)
+        self.invalid_queries = invalid_queries
+        self.repairs = repairs or {}
+        self.code = code or SchemaDiagnostic.INCOMPATIBLE_PROPERTIES
+        # Queries returning no results ("empty") or rejected by the endpoint ("error")
+        self.failing_queries = failing_queries or {}
+
+    def validate_query(self, query):
+        if query not in self.invalid_queries:
+            return []
+        return [
+            SchemaDiagnostic(
+                self.code,
+                "ns1:has_lcms_feature is not a property of ns1:LCMSAnalysisPos.",
+                (),
+                ["https://enpkg.commons-lab.org/kg/LCMSFeatureList"],
+            )
+        ]
+
+    def repair_query(self, query):
+        return self.repairs.get(query)
+
+    def iter_query_pages(self, query, cancellation=None):
+        pages = super().iter_query_pages(query, cancellation)
+        outcome = self.failing_queries.get(query)
+        if outcome is None:
+            return pages
+        return self._fail(outcome)
+
+    @staticmethod
+    def _fail(outcome):
+        if outcome == "error":
+            raise SparqlSyntaxError("400 Bad Request")
+        yield from ()
+
+
+def _validating_tool(monkeypatch, tmp_path, invalid_queries, repairs=None, **kwargs):
+    _patch_session(monkeypatch, tmp_path)
+    monkeypatch.setattr(tool_sparql.GraphSparqlQAChain, "search_nodes", lambda self, q: "nodes")
+    monkeypatch.setattr(
+        tool_sparql.GraphSparqlQAChain, "find_similar_query", lambda self, q: "template"
+    )
+    graph = ValidatingGraph(
+        [[{"feature": "feature0", "rt": "0"}]], invalid_queries, repairs, **kwargs
+    )
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain(EXPENSIVE_QUERY),
+        sparql_improvement_chain=FakeChain(CHEAP_QUERY),
+    )
+    return tool, graph
+
+
+def test_invalid_queries_are_corrected_before_querying_the_endpoint(monkeypatch, tmp_path):
+    tool, graph = _validating_tool(monkeypatch, tmp_path, {EXPENSIVE_QUERY})
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [CHEAP_QUERY]
+    assert "validation_errors" not in output
+    diagnostics = tool.sparql_improvement_chain.calls[0]["diagnostics"]
+    assert "not a property of ns1:LCMSAnalysisPos" in diagnostics
+    assert "Candidates: https://enpkg.commons-lab.org/kg/LCMSFeatureList" in diagnostics
+
+
+def test_invalid_corrections_are_not_sent(monkeypatch, tmp_path):
+    tool, graph = _validating_tool(monkeypatch, tmp_path, {EXPENSIVE_QUERY, CHEAP_QUERY})
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == []
+    assert output["result"] == []
+    assert output["validation_errors"] == [
+        "ns1:has_lcms_feature is not a property of ns1:LCMSAnalysisPos."
+    ]
+
+
+def test_repaired_queries_are_sent_without_the_llm(monkeypatch, tmp_path):
+    repaired = EXPENSIVE_QUERY.replace("<urn:has_feature>", "<urn:has_feature_list>")
+    tool, graph = _validating_tool(
+        monkeypatch, tmp_path, {EXPENSIVE_QUERY}, {EXPENSIVE_QUERY: repaired}
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [repaired]
+    assert output["query"] == repaired
+    assert tool.sparql_improvement_chain.calls == []
+
+
+@pytest.mark.parametrize(
+    "code", [SchemaDiagnostic.UNKNOWN_PROPERTY, SchemaDiagnostic.PROPERTY_NOT_ON_CLASS]
+)
+def test_properties_missing_from_the_sampled_schema_still_reach_the_endpoint(
+    monkeypatch, tmp_path, code
+):
+    repaired = EXPENSIVE_QUERY.replace("<urn:has_feature>", "<urn:has_feature_list>")
+    tool, graph = _validating_tool(
+        monkeypatch, tmp_path, {EXPENSIVE_QUERY}, {EXPENSIVE_QUERY: repaired}, code=code
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [EXPENSIVE_QUERY]
+    assert output["query"] == EXPENSIVE_QUERY
+    assert output["result"] == [{"feature": "feature0", "rt": "0"}]
+    assert "validation_errors" not in output
+    assert tool.sparql_improvement_chain.calls == []
+
+
+@pytest.mark.parametrize("outcome", ["empty", "error"])
+def test_schema_warnings_are_used_when_the_query_fails(monkeypatch, tmp_path, outcome):
+    tool, graph = _validating_tool(
+        monkeypatch,
+        tmp_path,
+        {EXPENSIVE_QUERY},
+        code=SchemaDiagnostic.PROPERTY_NOT_ON_CLASS,
+        failing_queries={EXPENSIVE_QUERY: outcome},
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [EXPENSIVE_QUERY, CHEAP_QUERY]
+    assert output["query"] == EXPENSIVE_QUERY
+    assert output["result"] == [{"feature": "feature0", "rt": "0"}]
+    diagnostics = tool.sparql_improvement_chain.calls[0]["diagnostics"]
+    assert "not a property of ns1:LCMSAnalysisPos" in diagnostics
+
+
+def test_queries_with_schema_warnings_are_repaired_when_they_return_nothing(
+    monkeypatch, tmp_path
+):
+    repaired = EXPENSIVE_QUERY.replace("<urn:has_feature>", "<urn:has_feature_list>")
+    tool, graph = _validating_tool(
+        monkeypatch,
+        tmp_path,
+        {EXPENSIVE_QUERY},
+        {EXPENSIVE_QUERY: repaired},
+        code=SchemaDiagnostic.UNKNOWN_PROPERTY,
+        failing_queries={EXPENSIVE_QUERY: "empty"},
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert graph.queries == [EXPENSIVE_QUERY, repaired]
+    assert output["query"] == repaired
+    assert tool.sparql_improvement_chain.calls == []
+
+
+class LibraryGraph(PagedGraph):
+    query_endpoint = "http://localhost:7200/repositories/ENPKG"
+
+
+def test_verified_queries_are_given_as_examples_for_similar_questions(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    library = QueryLibrary(tmp_path / "library.sqlite3")
+    taxon = "Melochia umbellata has the Wikidata IRI http://www.wikidata.org/entity/Q6813281"
+
+    def run(question, pages):
+        tool = _construct_tool(
+            graph=LibraryGraph(pages),
+            session_id="session-123",
+            sparql_generation_select_chain=FakeChain(CHEAP_QUERY),
+            query_library=library,
+            max_examples=3,
+            min_example_similarity=0.2,
+        )
+        tool._run(question, taxon)
+        return tool.sparql_generation_select_chain.calls[0]["examples"]
+
+    examples = run("Which features were detected in Melochia umbellata?", [[{"feature": "f0"}]])
+    assert examples == "No verified query is available for a similar question."
+    pair = library.similar(LibraryGraph.query_endpoint, "Which features?", taxon)[0][0]
+    assert (pair.query, pair.row_count, pair.entities) == (CHEAP_QUERY, 1, taxon)
+
+    examples = run("List the features detected in Melochia umbellata", [[{"feature": "f0"}]])
+    assert examples == (
+        "Question: Which features were detected in Melochia umbellata?\n"
+        f"Entities: {taxon}\n"
+        f"SPARQL query:\n{CHEAP_QUERY}"
+    )
+    assert len(library) == 2
+
+
+def test_questions_asked_again_reuse_their_verified_query(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    library = QueryLibrary(tmp_path / "library.sqlite3")
+    taxon = "Melochia umbellata has the Wikidata IRI http://www.wikidata.org/entity/Q6813281"
+    library.record(
+        LibraryGraph.query_endpoint,
+        "Which features were detected in Melochia umbellata?",
+        taxon,
+        CHEAP_QUERY,
+        1,
+        0.5,
+    )
+
+    def run(question, entities, pages):
+        graph = LibraryGraph(pages)
+        tool = _construct_tool(
+            graph=graph,
+            session_id="session-123",
+            sparql_generation_select_chain=FakeChain(EXPENSIVE_QUERY),
+            query_library=library,
+            question_cache=True,
+            question_cache_min_similarity=0.8,
+        )
+        output = tool._run(question, entities)["result"]
+        return output, graph, tool.sparql_generation_select_chain.calls
+
+    output, graph, calls = run("which features were detected in melochia umbellata", taxon, [[{"f": "0"}]])
+    assert output["cache_hit"] is True
+    assert output["query"] == CHEAP_QUERY
+    assert graph.queries == [CHEAP_QUERY]
+    assert calls == []
+
+    output, _, calls = run("Which features were detected in Melochia umbellata ?", taxon, [[{"f": "0"}]])
+    assert output["cache_hit"] is True and calls == []
+
+    # Same question on another taxon
+    output, graph, calls = run(
+        "Which features were detected in Melochia umbellata?", "taxon has the IRI urn:taxon", [[{"f": "0"}]]
+    )
+    assert output["cache_hit"] is False
+    assert graph.queries == [EXPENSIVE_QUERY] and len(calls) == 1
+
+
+def test_cached_queries_without_results_are_generated_again(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    library = QueryLibrary(tmp_path / "library.sqlite3")
+    library.record(LibraryGraph.query_endpoint, "Which features?", "", CHEAP_QUERY, 1, 0.5)
+    graph = LibraryGraph([])
+    graph.iter_query_pages = lambda query, cancellation=None: (
+        graph.queries.append(query) or iter([] if query == CHEAP_QUERY else [[{"f": "0"}]])
+    )
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain(EXPENSIVE_QUERY),
+        query_library=library,
+        question_cache=True,
+        question_cache_min_similarity=0.8,
+    )
+
+    output = tool._run("Which features?", "")["result"]
+
+    assert output["cache_hit"] is False
+    assert graph.queries == [CHEAP_QUERY, EXPENSIVE_QUERY]
+    assert library.lookup(LibraryGraph.query_endpoint, "Which features?")[0].query == EXPENSIVE_QUERY
+
+
+def test_questions_matching_a_template_are_answered_without_generation(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    taxon = "Datura metel has the Wikidata IRI http://www.wikidata.org/entity/Q157115"
+
+    def run(question, entities):
+        graph = LibraryGraph([])
+        tool = _construct_tool(
+            graph=graph,
+            session_id="session-123",
+            sparql_generation_select_chain=FakeChain(CHEAP_QUERY),
+            template_engine=TemplateEngine.from_file(),
+        )
+        monkeypatch.setattr(
+            graph, "iter_query_pages", lambda query, cancellation=None: iter([[{"f": query}]])
+        )
+        return tool._run(question, entities)["result"], tool.sparql_generation_select_chain.calls
+
+    output, calls = run("Which features were detected in Datura metel in negative mode?", taxon)
+    assert output["template_id"] == "taxon_features_by_ionization"
+    assert "<http://www.wikidata.org/entity/Q157115>" in output["query"]
+    assert output["result"][0]["f"] == output["query"]
+    assert calls == []
+
+    output, calls = run("Which features were detected in Datura metel in both modes?", "")
+    assert "template_id" not in output
+    assert output["query"] == CHEAP_QUERY and len(calls) == 1
+
+
+def test_templates_without_results_fall_back_to_generation(monkeypatch, tmp_path):
+    _patch_session(monkeypatch, tmp_path)
+    graph = LibraryGraph([])
+    tool = _construct_tool(
+        graph=graph,
+        session_id="session-123",
+        sparql_generation_select_chain=FakeChain(CHEAP_QUERY),
+        template_engine=TemplateEngine.from_file(),
+    )
+    graph.iter_query_pages = lambda query, cancellation=None: (
+        graph.queries.append(query) or iter([[{"f": "0"}]] if query == CHEAP_QUERY else [])
+    )
+
+    output = tool._run(
+        "Which features were detected in Datura metel in negative mode?",
+        "Datura metel has the Wikidata IRI http://www.wikidata.org/entity/Q157115",
+    )["result"]
+
+    assert "template_id" not in output
+    assert len(graph.queries) == 2 and "<http://www.wikidata.org/entity/Q157115>" in graph.queries[0]
+    assert output["query"] == CHEAP_QUERY
+    assert tool.sparql_generation_select_chain.calls
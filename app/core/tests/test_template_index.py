@@ -0,0 +1,162 @@
+import json
+import shutil
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app.core.agents.sparql import template_index as template_index_module
+from app.core.agents.sparql.template_index import (
+    QUERIES_PATH,
+    TemplateIndex,
+    clear_template_indexes,
+    get_template_index,
+    index_paths,
+)
+
+
+@pytest.fixture
+def queries_path(tmp_path):
+    path = tmp_path / "queries.json"
+    shutil.copy(QUERIES_PATH, path)
+    clear_template_indexes()
+    yield path
+    clear_template_indexes()
+
+
+def _templates(path):
+    return json.loads(path.read_text())["queries"]
+
+
+def _forbid_refit(monkeypatch):
+    def build(*args, **kwargs):
+        raise AssertionError("the index must not be refitted")
+
+    monkeypatch.setattr(TemplateIndex, "build", build)
+
+
+def test_query_vectors_match_the_fitted_vectorizer(queries_path):
+    templates = _templates(queries_path)
+    index = TemplateIndex.load(queries_path)
+    vectorizer = TfidfVectorizer().fit([t["query"] for t in templates])
+    query = templates[3]["query"].replace("?featureList", "?list") + " ns1:unknown_term"
+
+    assert np.allclose(index.vectorize(query).toarray(), vectorizer.transform([query]).toarray())
+
+
+def test_search_returns_the_top_k_templates_with_their_scores(queries_path):
+    templates = _templates(queries_path)
+    index = TemplateIndex.load(queries_path)
+
+    results = index.search(templates[6]["query"], k=3)
+
+    assert [t["id"] for t, _ in results][0] == templates[6]["id"]
+    assert results[0][1] == pytest.approx(1.0)
+    scores = [score for _, score in results]
+    assert scores == sorted(scores, reverse=True) and len(scores) == 3
+    assert len(index.search("SELECT", k=100)) == len(templates)
+
+
+def test_saved_index_is_reloaded_until_the_templates_change(queries_path, monkeypatch):
+    TemplateIndex.load(queries_path)
+    assert all(path.exists() for path in index_paths(queries_path))
+
+    with monkeypatch.context() as patched:
+        _forbid_refit(patched)
+        reloaded = TemplateIndex.load(queries_path)
+    assert len(reloaded.templates) == len(_templates(queries_path))
+
+    content = json.loads(queries_path.read_text())
+    content["queries"] = content["queries"][:5]
+    queries_path.write_text(json.dumps(content))
+    rebuilt = TemplateIndex.load(queries_path)
+    assert rebuilt.matrix.shape[0] == 5
+
+
+@pytest.mark.parametrize("truncated", ["matrix", "metadata"])
+def test_truncated_index_files_are_rebuilt(queries_path, truncated):
+    TemplateIndex.load(queries_path)
+    metadata_path, matrix_path = index_paths(queries_path)
+    path = matrix_path if truncated == "matrix" else metadata_path
+    path.write_bytes(path.read_bytes()[:100])
+
+    index = TemplateIndex.load(queries_path)
+
+    assert index.matrix.shape[0] == len(_templates(queries_path))
+    assert TemplateIndex.load(queries_path).search("SELECT ?feature")
+
+
+def test_index_files_of_different_saves_are_not_paired(queries_path):
+    TemplateIndex.load(queries_path)
+    metadata_path, matrix_path = index_paths(queries_path)
+    old_matrix = matrix_path.read_bytes()
+    content = json.loads(queries_path.read_text())
+    content["queries"] = content["queries"][:5]
+    queries_path.write_text(json.dumps(content))
+    TemplateIndex.load(queries_path)
+    # A save interrupted after writing the matrix of the whole templates file
+    matrix_path.write_bytes(old_matrix)
+
+    assert TemplateIndex.load(queries_path).matrix.shape[0] == 5
+
+
+def test_failed_saves_keep_the_previous_index_files(queries_path, monkeypatch):
+    TemplateIndex.load(queries_path)
+    paths = index_paths(queries_path)
+    saved = [path.read_bytes() for path in paths]
+
+    def failing_replace(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(template_index_module.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        TemplateIndex.load(queries_path).save()
+
+    assert [path.read_bytes() for path in paths] == saved
+    assert sorted(p.name for p in queries_path.parent.iterdir()) == sorted(
+        [queries_path.name, *(path.name for path in paths)]
+    )
+
+
+def test_added_templates_are_searchable_and_saved_without_refit(queries_path, monkeypatch):
+    index = TemplateIndex.load(queries_path)
+    vocabulary_size = len(index.vocabulary)
+    _forbid_refit(monkeypatch)
+    new_query = (
+        "PREFIX ns1: <https://enpkg.commons-lab.org/kg/>\n"
+        "SELECT ?mass WHERE { ?feature ns1:has_parent_mass ?mass ; ns1:has_spec2vec_doc ?doc . }"
+    )
+
+    original = queries_path.read_text()
+
+    index.add([{"query": new_query}])
+
+    # The templates already in the file keep their formatting
+    assert queries_path.read_text().startswith(original[: original.rfind("]")].rstrip())
+    assert len(index.vocabulary) == vocabulary_size
+    best, score = index.search(new_query)[0]
+    assert best == {"id": 14, "query": new_query}
+    assert score == pytest.approx(1.0)
+    assert _templates(queries_path)[-1] == best
+    assert TemplateIndex.load(queries_path).search(new_query)[0][0] == best
+
+
+def test_shared_index_is_loaded_once_and_reloaded_when_the_file_changes(
+    queries_path, monkeypatch
+):
+    loads = []
+    load = TemplateIndex.load.__func__
+    monkeypatch.setattr(
+        TemplateIndex,
+        "load",
+        classmethod(lambda cls, path: loads.append(path) or load(cls, path)),
+    )
+
+    first = get_template_index(queries_path)
+    assert get_template_index(queries_path) is first
+    assert len(loads) == 1
+
+    first.add([{"query": "SELECT ?s WHERE { ?s ?p ?o }"}])
+    assert get_template_index(queries_path) is not first
+    assert len(loads) == 2
+    assert template_index_module._template_indexes
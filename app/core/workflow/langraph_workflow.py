@@ -1,6 +1,7 @@
 # langchain imports for agent and prompt handling
 import functools
 import os
+import threading
 
 import operator
 from typing import (
@@ -14,7 +15,6 @@ from typing import (
     Optional,
     Tuple,
 )
-import pickle
 from pathlib import Path
 
 from langchain.schema import HumanMessage
@@ -25,12 +25,22 @@ from langgraph.graph import StateGraph
 from app.core.memory.database_manager import memory_database, tools_database
 from app.core.utils import load_config, setup_logger
 from app.core.graph_management.RdfGraphCustom import RdfGraph
+from app.core.graph_management.schema_cache import SchemaCache
+from app.core.graph_management.schema_refresher import SchemaRefresher
 from app.core.agents.agents_factory import create_all_agents
 from app.core.llm_handler import llm_creation
 
 logger = setup_logger(__name__)
 parent_dir = Path(__file__).resolve().parent.parent.parent
-graph_path = parent_dir / "graphs" / "graph.pkl"
+
+# RdfGraph instances shared by all the workflows of the process, keyed by (endpoint URL, auth)
+_shared_graphs: Dict[Tuple[str, Optional[Tuple[str, str]]], RdfGraph] = {}
+_schema_refreshers: Dict[Tuple[str, Optional[Tuple[str, str]]], SchemaRefresher] = {}
+# Held while looking up the dictionaries above, never during a schema extraction
+_shared_graphs_lock = threading.Lock()
+# Held during the extraction or refresh of the schema of one (endpoint URL, auth), so that the
+# sessions of other endpoints are not blocked
+_graph_locks: Dict[Tuple[str, Optional[Tuple[str, str]]], threading.Lock] = {}
 
 
 class AgentState(TypedDict):
@@ -40,40 +50,23 @@ class AgentState(TypedDict):
     # The 'next' field indicates where to route to next
     next: str
 
-# def link_kg_database(endpoint_url: str):
-#     """
-#     Checks if an RDF graph is already created, and if not, it initializes and saves a new RDF graph object using a specified endpoint URL.
-
-#     Returns:
-#         RdfGraph: An RDF graph object.
-#     """
-
-#     graph_path = parent_dir / "graphs" / "graph.pkl"
-
-#     # check if the graph is already created if not create it.
-#     try:
-#         with open(graph_path, "rb") as input_file:
-#             graph = pickle.load(input_file)
-#             # logger.info(f"schema: {graph.get_schema}")
-#             return graph
-#     except FileNotFoundError:
-#         pass
-
-#     # Initialize the RdfGraph object with the given endpoint and the standard set to 'rdf'
-#     graph = RdfGraph(query_endpoint=endpoint_url, standard="rdf")
-
-#     with open(graph_path, "wb") as output_file:
-#         pickle.dump(graph, output_file)
-#     # logger.info(f"schema: {graph.get_schema}")
-#     return graph
-def link_kg_database(endpoint_url: str, auth: Optional[Tuple[str, str]] = None):
+def link_kg_database(
+    endpoint_url: str,
+    auth: Optional[Tuple[str, str]] = None,
+    refresh_schema: bool = False,
+):
     """
-    Checks if an RDF graph is already created, and if not, it initializes and saves a new RDF graph object using a specified endpoint URL.
+    Returns the RDF graph object of an endpoint, shared by all the workflows of the process.
+    The schema is read from the endpoint's schema cache entry when it is valid, otherwise it is
+    extracted from the endpoint and saved to the cache. If `interval_seconds` is set in the
+    `schemaRefresh` section of sparql.ini, a background `SchemaRefresher` keeps the schema up to date.
     
     Args:
         endpoint_url (str): The URL of the SPARQL endpoint.
         auth (Optional[Tuple[str, str]]): Optional tuple of (username, password) for authentication.
             If not provided, will try to use SPARQL_USERNAME and SPARQL_PASSWORD from environment.
+        refresh_schema (bool): Whether to incrementally update a cached schema with the classes that
+            changed in the endpoint since it was extracted.
 
     Returns:
         RdfGraph: An RDF graph object.
@@ -86,24 +79,78 @@ def link_kg_database(endpoint_url: str, auth: Optional[Tuple[str, str]] = None):
         if username and password:
             auth = (username, password)
 
-    # check if the graph is already created if not create it.
-    try:
-        with open(graph_path, "rb") as input_file:
-            graph = pickle.load(input_file)
-            # logger.info(f"schema: {graph.get_schema}")
+    key = (endpoint_url, auth)
+    with _shared_graphs_lock:
+        graph = _shared_graphs.get(key)
+        if graph is not None and not refresh_schema:
             return graph
-    except FileNotFoundError:
-        pass
+        graph_lock = _graph_locks.setdefault(key, threading.Lock())
+
+    with graph_lock:
+        # Another session may have created the graph while this one was waiting
+        with _shared_graphs_lock:
+            graph = _shared_graphs.get(key)
+        if graph is None:
+            graph = _create_kg_graph(endpoint_url, auth, refresh_schema)
+            with _shared_graphs_lock:
+                _shared_graphs[key] = graph
+            _start_schema_refresher(key, graph)
+        elif refresh_schema and graph.refresh_schema():
+            _save_schema_cache(SchemaCache(endpoint_url), graph)
+    return graph
+
+
+def _create_kg_graph(
+    endpoint_url: str, auth: Optional[Tuple[str, str]], refresh_schema: bool
+) -> RdfGraph:
+    # check if the schema of the endpoint is already cached, if not extract it.
+    schema_cache = SchemaCache(endpoint_url)
+    schema_data = schema_cache.load()
 
     # Initialize the RdfGraph object with the given endpoint and the standard set to 'rdf'
-    graph = RdfGraph(query_endpoint=endpoint_url, standard="rdf", auth=auth)
+    # An interrupted extraction resumes from the classes saved in the progress file
+    graph = RdfGraph(
+        query_endpoint=endpoint_url,
+        standard="rdf",
+        auth=auth,
+        schema_data=schema_data,
+        progress_path=schema_cache.progress_path,
+    )
+
+    if schema_data is not None:
+        updated = bool(refresh_schema and graph.refresh_schema())
+        # Statistics enabled after the schema was cached
+        if graph.collect_statistics and graph.statistics is None:
+            graph.update_statistics()
+            updated = True
+        if not updated:
+            return graph
 
-    with open(graph_path, "wb") as output_file:
-        pickle.dump(graph, output_file)
-    # logger.info(f"schema: {graph.get_schema}")
+    _save_schema_cache(schema_cache, graph)
     return graph
 
 
+def _save_schema_cache(schema_cache: SchemaCache, graph: RdfGraph) -> None:
+    try:
+        schema_cache.save(graph.to_schema_data())
+    except OSError as e:
+        logger.error(f"Could not save the schema cache: {e}")
+
+
+def _start_schema_refresher(
+    key: Tuple[str, Optional[Tuple[str, str]]], graph: RdfGraph
+) -> None:
+    interval_seconds = graph.config.getfloat(
+        "schemaRefresh", "interval_seconds", fallback=0
+    )
+    if interval_seconds <= 0:
+        return
+    refresher = SchemaRefresher(graph, SchemaCache(key[0]), interval_seconds)
+    refresher.start()
+    with _shared_graphs_lock:
+        _schema_refreshers[key] = refresher
+
+
 def create_workflow(
     models: Dict,
     session_id: Optional[str] = None,
@@ -48,6 +48,7 @@ from langchain.callbacks.manager import tracing_v2_enabled
 from streamlit_webapp.streamlit_utils import check_characters_api_key, test_sparql_endpoint, test_openai_key, new_process_langgraph_output, create_zip_buffer, is_true
 from app.core.workflow.langraph_workflow import create_workflow
 from app.core.main import llm_creation
+from app.core.agents.sparql.tool_sparql import cancel_session_queries
 
 
 def add_videos_to_content():
@@ -564,6 +565,11 @@ if st.session_state.openai_key_success == True and st.session_state.endpoint_url
                     st.session_state.logger.error(error_message)
                     st.session_state.messages.append({"role": "assistant", "content": output_history, "image": fig_index, "url": "", "spectra": spec_index, "error": error_message})
 
+                except BaseException:
+                    # Stopping or rerunning the script interrupts the question, its queries are cancelled
+                    cancel_session_queries(st.session_state.session_id)
+                    raise
+
                 finally:
                     st.session_state.is_processing = False
 